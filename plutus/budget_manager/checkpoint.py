@@ -0,0 +1,198 @@
+from plutus.lib.constants import APP
+from plutus.lib.mysql import (
+    finish_run,
+    get_reconcile_states,
+    start_or_resume_run,
+    upsert_reconcile_state,
+)
+import datetime
+import hashlib
+import json
+import logging
+import markus
+import time
+
+log = logging.getLogger(f"{APP}.checkpoint")
+metrics = markus.get_metrics(f"{APP}.checkpoint")
+
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+
+def config_hash(budget_dict):
+    """Stable hash of the yaml config, so a run is only resumed with the same config."""
+    config = json.dumps(budget_dict, sort_keys=True, default=str)
+    return hashlib.sha256(config.encode("utf-8")).hexdigest()
+
+
+class ReconcileRun:
+    """
+    Tracks the outcome of every project in a budget manager run.
+
+    Outcomes are checkpointed to the reconcile_state table as they happen. When a run is
+    interrupted, the next run with the same config resumes it and skips projects that were
+    already reconciled. Failed projects are retried on later runs with exponential backoff.
+    Pass mysql_conn=None (e.g. for dry runs) to only keep the report in memory.
+
+    After deadline seconds, every project still to come is skipped. The run is then left
+    unfinished, so the next run resumes it instead of starting over.
+
+    Fields:
+    -------
+    run_id - str - Id of this run, or of the interrupted run being resumed
+    resumed - bool - Whether an interrupted run is being resumed
+    succeeded - list(tuple) - (config_type, project_id) of reconciled projects
+    failed - list(tuple) - (config_type, project_id, error) of failed projects and config entries
+    skipped - list(tuple) - (config_type, project_id, reason) of projects not attempted
+    """
+
+    def __init__(
+        self,
+        mysql_conn,
+        budget_dict,
+        resume_window=3600,
+        retry_base=600,
+        retry_max=21600,
+        deadline=None,
+    ):
+        self.mysql_conn = mysql_conn
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.deadline = time.monotonic() + deadline if deadline else None
+        self.deadline_reached = False
+
+        self.succeeded = []
+        self.failed = []
+        self.skipped = []
+
+        self.states = {}
+        self.resumed = False
+        self.run_id = None
+        if mysql_conn is not None:
+            with mysql_conn.cursor() as mysql_cursor:
+                self.run_id, self.resumed = start_or_resume_run(
+                    mysql_cursor, config_hash(budget_dict), resume_window
+                )
+                self.states = get_reconcile_states(mysql_cursor)
+
+        if self.resumed:
+            log.info(f"Resuming interrupted run {self.run_id}")
+
+    def past_deadline(self):
+        """Returns True once the run's deadline has passed, when no new work should start."""
+        if self.deadline is None or self.deadline_reached:
+            return self.deadline_reached
+        if time.monotonic() >= self.deadline:
+            log.warning("Run deadline reached, skipping the rest of the run")
+            metrics.incr("deadline_reached_count")
+            self.deadline_reached = True
+        return self.deadline_reached
+
+    def should_skip(self, project):
+        """Returns the reason project should be skipped this run, or None."""
+        if self.past_deadline():
+            reason = "run deadline reached"
+            self.record_skipped(project.config_type, project.project_id, reason)
+            return reason
+
+        key = (project.config_type, project.project_id)
+        state = self.states.get(key)
+        if state is None:
+            return None
+
+        last_run_id, status, attempts, next_attempt = state
+        if self.resumed and last_run_id == self.run_id and status == STATUS_DONE:
+            reason = "already reconciled by this run"
+        elif (
+            status == STATUS_FAILED
+            and next_attempt is not None
+            and next_attempt > datetime.datetime.utcnow()
+        ):
+            reason = f"failed {attempts} time(s), retrying after {next_attempt}"
+        else:
+            return None
+
+        self.record_skipped(project.config_type, project.project_id, reason)
+        return reason
+
+    def record_skipped(self, config_type, entry, reason):
+        """Records a project, config entry or section that wasn't attempted. Not checkpointed."""
+        log.info(f"Skipping {config_type} {entry}: {reason}")
+        self.skipped.append((config_type, entry, reason))
+
+    def record_success(self, project):
+        self.succeeded.append((project.config_type, project.project_id))
+        self._checkpoint(project, STATUS_DONE, 0, entry_hash=project.entry_hash)
+
+    def record_failure(self, project, err):
+        log.error(f"Failed reconciling {project.project_id}: {err}")
+        self.failed.append((project.config_type, project.project_id, str(err)))
+        metrics.incr(
+            "project_failed_count",
+            tags=[
+                f"config_type:{project.config_type}",
+                f"project_id:{project.project_id}",
+            ],
+        )
+
+        state = self.states.get((project.config_type, project.project_id))
+        attempts = (
+            state[2] + 1 if state is not None and state[1] == STATUS_FAILED else 1
+        )
+        backoff = min(self.retry_base * 2 ** (attempts - 1), self.retry_max)
+        next_attempt = datetime.datetime.utcnow() + datetime.timedelta(seconds=backoff)
+        self._checkpoint(project, STATUS_FAILED, attempts, str(err), next_attempt)
+
+    def record_config_error(self, config_type, entry, err):
+        """Records a config entry that failed verification or expansion. Not checkpointed."""
+        log.error(f"Failed {config_type} config entry {entry}: {err}")
+        self.failed.append((config_type, entry, str(err)))
+
+    def _checkpoint(
+        self,
+        project,
+        status,
+        attempts,
+        last_error=None,
+        next_attempt=None,
+        entry_hash=None,
+    ):
+        if self.mysql_conn is None:
+            return
+        with self.mysql_conn.cursor() as mysql_cursor:
+            upsert_reconcile_state(
+                mysql_cursor,
+                self.run_id,
+                project.project_id,
+                project.config_type,
+                status,
+                attempts,
+                last_error,
+                next_attempt,
+                entry_hash,
+            )
+
+    def finish(self):
+        """Marks the run finished and logs the run report. Returns True if nothing failed."""
+        status = "complete" if not self.failed else "complete_with_errors"
+        if self.deadline_reached:
+            # Left 'running', so the next run resumes where this one stopped
+            log.warning(f"Run {self.run_id} stopped at its deadline, it will be resumed")
+        elif self.mysql_conn is not None:
+            with self.mysql_conn.cursor() as mysql_cursor:
+                finish_run(mysql_cursor, self.run_id, status)
+
+        log.info(
+            f"Run report: {len(self.succeeded)} succeeded, {len(self.failed)} failed, "
+            f"{len(self.skipped)} skipped."
+        )
+        for config_type, project_id, err in self.failed:
+            log.error(f"  failed: {config_type} {project_id}: {err}")
+        for config_type, project_id, reason in self.skipped:
+            log.info(f"  skipped: {config_type} {project_id}: {reason}")
+
+        metrics.gauge("run_succeeded_count", value=len(self.succeeded))
+        metrics.gauge("run_failed_count", value=len(self.failed))
+        metrics.gauge("run_skipped_count", value=len(self.skipped))
+
+        return not self.failed
@@ -0,0 +1,88 @@
+import click
+
+import datetime
+import logging
+import pymysql
+import sys
+import time
+
+from plutus.budget_manager.main import setup_metrics
+from plutus.lib.constants import APP
+from plutus.lib.forecast import ANOMALY_RATIO, run_forecast, WINDOW_HOURS
+from plutus.lib.metrics import DEFAULT_TAG_ALLOWLIST, flush_metrics
+from plutus.lib.spend_history import HOURLY_LOOKBACK, rollup_hourly
+
+log = logging.getLogger(APP)
+
+
+@click.command()
+@click.option("--mysql-host", envvar="MYSQL_HOST", default="localhost")
+@click.option("--mysql-port", envvar="MYSQL_PORT", default="3306")
+@click.option("--mysql-user", envvar="MYSQL_USER", default="root")
+@click.option("--mysql-pass", envvar="MYSQL_PASS", default="secret")
+@click.option("--mysql-db", envvar="MYSQL_DB", default="plutus")
+@click.option(
+    "--statsd-host",
+    envvar="STATSD_HOST",
+    default="prod-statsd-telegraf.influx.svc.cluster.local",
+)
+@click.option(
+    "--metrics-tag-allowlist",
+    envvar="METRICS_TAG_ALLOWLIST",
+    default=",".join(DEFAULT_TAG_ALLOWLIST),
+)
+# Seconds between forecasts. 0 forecasts once and exits, e.g. for a cronjob
+@click.option("--interval", envvar="FORECAST_INTERVAL", default=0)
+@click.option("--window-hours", envvar="FORECAST_WINDOW_HOURS", default=WINDOW_HOURS)
+@click.option("--anomaly-ratio", envvar="FORECAST_ANOMALY_RATIO", default=ANOMALY_RATIO)
+def main(
+    mysql_host,
+    mysql_port,
+    mysql_user,
+    mysql_pass,
+    mysql_db,
+    statsd_host,
+    metrics_tag_allowlist,
+    interval,
+    window_hours,
+    anomaly_ratio,
+):
+    """Projects month end spend for every budget into the spend_forecasts table."""
+    logformat = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO, format=logformat)
+    logging.getLogger("datadog.dogstatsd").setLevel(logging.ERROR)
+
+    setup_metrics(statsd_host, [t for t in metrics_tag_allowlist.split(",") if t])
+
+    mysql_conn = pymysql.connect(
+        host=mysql_host,
+        port=int(mysql_port),
+        user=mysql_user,
+        password=mysql_pass,
+        database=mysql_db,
+        autocommit=True,
+    )
+
+    try:
+        while True:
+            started = time.monotonic()
+            mysql_conn.ping(reconnect=True)
+            # Pick up the hours since the budget manager's last --spend-rollup
+            with mysql_conn.cursor() as mysql_cursor:
+                rollup_hourly(
+                    mysql_cursor, datetime.datetime.utcnow() - HOURLY_LOOKBACK
+                )
+            run_forecast(
+                mysql_conn, window_hours=window_hours, anomaly_ratio=anomaly_ratio
+            )
+            flush_metrics()
+
+            if not interval:
+                break
+            time.sleep(max(interval - (time.monotonic() - started), 0))
+    finally:
+        mysql_conn.close()
+
+
+if __name__ == "__main__":
+    main()
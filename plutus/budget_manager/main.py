@@ -15,10 +15,6 @@ from plutus.budget_manager.verify import (
     # verify_default_yaml
 )
 
-from google.cloud import asset_v1
-from google.cloud.billing.budgets_v1.services.budget_service import BudgetServiceClient
-from google.cloud import resourcemanager_v3
-from google.cloud import storage
 from google.protobuf.json_format import MessageToDict
 
 from plutus.lib.constants import (
@@ -29,9 +25,45 @@ from plutus.lib.constants import (
     # PLUTUS_CONFIG_TYPE_DEFAULT
 )
 
+from plutus.lib import clients
+from plutus.lib.exceptions import CircuitOpenError, MigrationError, ProjectError
+from plutus.lib.metrics import DEFAULT_TAG_ALLOWLIST, flush_metrics
+from plutus.lib.migrations import migrate, MIGRATIONS_DIR
 from plutus.lib.mysql import upsert_budget
-from plutus.lib.gcp_helper import GcpHelper
+from plutus.lib.spend_history import rollup_spend_history
+from plutus.lib.gcp_helper import (
+    API_ASSET,
+    API_BILLING,
+    API_RESOURCE_MANAGER,
+    GcpHelper,
+    parse_deadlines,
+)
+from plutus.lib.profiling import (
+    profiler,
+    PHASE_CONFIG_LOAD,
+    PHASE_EXPANSION,
+    PHASE_GC,
+    PHASE_MYSQL,
+    PHASE_RECONCILE,
+)
+from plutus.lib.tracing import (
+    configure_tracing,
+    tracer,
+    SPAN_PROJECT,
+    SPAN_RUN,
+    SPAN_SECTION,
+)
+from plutus.budget_manager.checkpoint import ReconcileRun
 from plutus.budget_manager.project_budget import ProjectBudget
+from plutus.budget_manager.run_lock import RunLock
+from plutus.budget_manager.scheduler import PRIORITY_NAMES, ReconcileScheduler
+from plutus.budget_manager.targets import (
+    folder_id,
+    matching_entries,
+    parse_label_selector,
+    select_entries,
+    TargetProject,
+)
 
 log = logging.getLogger(APP)
 metrics = markus.get_metrics(APP)
@@ -55,10 +87,64 @@ metrics = markus.get_metrics(APP)
     envvar="STATSD_HOST",
     default="prod-statsd-telegraf.influx.svc.cluster.local",
 )
+# Tag keys sent to statsd as is. Other tags (e.g. project_id) are dropped, or hashed into
+# --metrics-tag-buckets buckets, to bound the number of series in influx.
+@click.option(
+    "--metrics-tag-allowlist",
+    envvar="METRICS_TAG_ALLOWLIST",
+    default=",".join(DEFAULT_TAG_ALLOWLIST),
+)
+@click.option("--metrics-tag-buckets", envvar="METRICS_TAG_BUCKETS", default=0)
 # Used for local testing without container, and without using gcs file
 # Local mode loads config file from filesystem
 @click.option("--local-mode", is_flag=True, default=False)
 @click.option("--dry-run", is_flag=True, default=False)
+# Resume an interrupted run that started less than --resume-window seconds ago. Projects that
+# failed are retried after --retry-backoff seconds, doubling on each consecutive failure.
+@click.option("--resume-window", envvar="RESUME_WINDOW", default=3600)
+@click.option("--retry-backoff", envvar="RETRY_BACKOFF", default=600)
+# Write per project/rpc spans as json lines to a file, or OTLP/JSON to a collector
+@click.option("--trace-file", envvar="TRACE_FILE", default=None)
+@click.option("--trace-otlp-endpoint", envvar="TRACE_OTLP_ENDPOINT", default=None)
+# Profile cpu (cProfile) and memory (tracemalloc) per run phase into --profile-dir
+@click.option("--profile", is_flag=True, default=False)
+@click.option("--profile-dir", envvar="PROFILE_DIR", default="/tmp/plutus-profile")
+# Roll the budget monitor's spend_history up into spend_hourly/spend_daily, and drop history
+# partitions older than --spend-history-retention days
+@click.option("--spend-rollup/--no-spend-rollup", envvar="SPEND_ROLLUP", default=False)
+@click.option("--spend-history-retention", envvar="SPEND_HISTORY_RETENTION", default=35)
+# Apply pending schema migrations from --migrations-dir before reconciling
+@click.option(
+    "--migrate/--no-migrate", "migrate_schema", envvar="MIGRATE", default=True
+)
+@click.option("--migrations-dir", envvar="MIGRATIONS_DIR", default=MIGRATIONS_DIR)
+# Skip the run if another run holds the run lock after waiting --run-lock-wait seconds for
+# it. The lock expires --run-lock-ttl seconds after its holder stopped renewing it
+@click.option("--run-lock/--no-run-lock", envvar="RUN_LOCK", default=True)
+@click.option("--run-lock-wait", envvar="RUN_LOCK_WAIT", default=0)
+@click.option("--run-lock-ttl", envvar="RUN_LOCK_TTL", default=120)
+# Stop starting new work after --run-deadline seconds (0 for no deadline); the run is resumed
+# next time. GCP calls time out per method, e.g. --gcp-deadlines list_budgets=120, and each
+# API's circuit breaker opens after --breaker-threshold consecutive failures
+@click.option("--run-deadline", envvar="RUN_DEADLINE", default=0)
+@click.option("--gcp-deadlines", envvar="GCP_DEADLINES", default="")
+@click.option("--breaker-threshold", envvar="BREAKER_THRESHOLD", default=5)
+# gRPC channels per Google API, and seconds between keepalive pings on idle channels
+@click.option("--grpc-pool-size", envvar="GRPC_POOL_SIZE", default=clients.POOL_SIZE)
+@click.option(
+    "--grpc-keepalive",
+    envvar="GRPC_KEEPALIVE",
+    default=clients.KEEPALIVE_TIME_MS // 1000,
+)
+# Projects whose budget wasn't verified for --stale-after seconds are reconciled before
+# others, after new projects and changed config entries
+@click.option("--stale-after", envvar="STALE_AFTER", default=86400)
+# Reconcile only the budgets of these projects, of the projects in these folders, or of the
+# projects matching labels entries that require these key=value labels, e.g. to try a config
+# change or push an urgent one. Each can be repeated. Defunct budgets aren't cleaned up.
+@click.option("--only-project", multiple=True)
+@click.option("--only-folder", multiple=True)
+@click.option("--only-label", multiple=True)
 def main(
     gcs_bucket,
     gcs_file_path,
@@ -70,8 +156,32 @@ def main(
     mysql_pass,
     mysql_db,
     statsd_host,
+    metrics_tag_allowlist,
+    metrics_tag_buckets,
     local_mode,
     dry_run,
+    resume_window,
+    retry_backoff,
+    trace_file,
+    trace_otlp_endpoint,
+    profile,
+    profile_dir,
+    spend_rollup,
+    spend_history_retention,
+    migrate_schema,
+    migrations_dir,
+    run_lock,
+    run_lock_wait,
+    run_lock_ttl,
+    run_deadline,
+    gcp_deadlines,
+    breaker_threshold,
+    grpc_pool_size,
+    grpc_keepalive,
+    stale_after,
+    only_project,
+    only_folder,
+    only_label,
 ):
     logformat = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
     logging.basicConfig(stream=sys.stdout, level=logging.INFO, format=logformat)
@@ -80,73 +190,411 @@ def main(
     # Remove this line to see WARNINGs
     logging.getLogger("datadog.dogstatsd").setLevel(logging.ERROR)
 
+    configure_tracing(trace_file=trace_file, otlp_endpoint=trace_otlp_endpoint)
+    clients.configure(pool_size=grpc_pool_size, keepalive_time_ms=grpc_keepalive * 1000)
+
+    if profile:
+        profiler.start(profile_dir)
+
+    tag_allowlist = [t for t in metrics_tag_allowlist.split(",") if t]
+    try:
+        only_labels = parse_label_selector(only_label)
+    except ValueError as err:
+        raise click.BadParameter(str(err), param_hint="--only-label")
+    targeted = bool(only_project or only_folder or only_labels)
+
     # Load config.yaml file
+    with profiler.phase(PHASE_CONFIG_LOAD):
+        budget_dict = load_budget_config(local_mode, gcs_bucket, gcs_file_path)
+        if local_mode:
+            if gcs_bucket is not None or gcs_file_path is not None:
+                log.warning(
+                    f"You are using local mode, and gcs_bucket ({gcs_bucket}) and gcs_file_path ({gcs_file_path}) will not be used."
+                )
+
+            setup_metrics("localhost", tag_allowlist, metrics_tag_buckets)
+        else:
+            # Setup metrics with configured statsd host
+            setup_metrics(statsd_host, tag_allowlist, metrics_tag_buckets)
+
+    # Setup gcp helper
+    gcp = GcpHelper(
+        clients.billing_client(),
+        clients.projects_client(),
+        deadlines=parse_deadlines(gcp_deadlines),
+        breaker_threshold=breaker_threshold,
+    )
+
+    # Setup mysql connection pool
+    with profiler.phase(PHASE_MYSQL):
+        pool = PooledDB(
+            creator=pymysql,
+            host=mysql_host,
+            user=mysql_user,
+            password=mysql_pass,
+            database=mysql_db,
+            autocommit=True,
+            blocking=True,
+            maxconnections=5,
+        )
+        mysql_conn = pool.connection()
+
+        if migrate_schema:
+            try:
+                migrate(mysql_conn, migrations_dir, dry_run=dry_run)
+            except MigrationError as err:
+                log.error(f"Not running against an unmigrated schema: {err}")
+                metrics.incr("error_count", tags=["type:migration"])
+                flush_metrics()
+                sys.exit(1)
+
+    # Dry runs don't write anything, so they don't need the lock either. Targeted runs don't
+    # wait for a full run, and reconciling a project twice at once is harmless
+    lock = None
+    if run_lock and not dry_run and not targeted:
+        lock = RunLock(pool.connection, ttl=run_lock_ttl)
+        if not lock.acquire(wait=run_lock_wait):
+            profiler.stop()
+            flush_metrics()
+            return
+
+    # Dry runs don't write anything, so they don't checkpoint either. Nor do targeted runs,
+    # which would otherwise resume or finish an interrupted full run, or skip a project in
+    # failure backoff
+    run = ReconcileRun(
+        None if dry_run or targeted else mysql_conn,
+        budget_dict,
+        resume_window=resume_window,
+        retry_base=retry_backoff,
+        deadline=run_deadline,
+    )
+    # Expanding every config entry first lets the scheduler order the run's work by priority
+    scheduler = ReconcileScheduler.load(mysql_conn, stale_after=stale_after)
+
+    try:
+        with tracer.span(SPAN_RUN, dry_run=dry_run, run_id=run.run_id):
+            if targeted:
+                with tracer.span(SPAN_SECTION, section="targets"), profiler.phase(
+                    PHASE_EXPANSION
+                ):
+                    reconcile_targets(
+                        run,
+                        scheduler,
+                        budget_dict,
+                        only_project,
+                        only_folder,
+                        only_labels,
+                        gcp,
+                        mysql_conn,
+                        billing_account_id,
+                        default_pubsub_topic,
+                        dry_run,
+                    )
+            else:
+                with tracer.span(SPAN_SECTION, section="projects"), profiler.phase(
+                    PHASE_EXPANSION
+                ):
+                    reconcile_projects(
+                        run,
+                        scheduler,
+                        budget_dict["projects"],
+                        gcp,
+                        mysql_conn,
+                        billing_account_id,
+                        default_pubsub_topic,
+                        dry_run,
+                    )
+
+                with tracer.span(
+                    SPAN_SECTION, section="parent_folders"
+                ), profiler.phase(PHASE_EXPANSION):
+                    reconcile_parent_folders(
+                        run,
+                        scheduler,
+                        budget_dict["parent_folders"],
+                        gcp,
+                        mysql_conn,
+                        billing_account_id,
+                        default_pubsub_topic,
+                        dry_run,
+                    )
+
+                with tracer.span(SPAN_SECTION, section="labels"), profiler.phase(
+                    PHASE_EXPANSION
+                ):
+                    reconcile_labels(
+                        run,
+                        scheduler,
+                        budget_dict["labels"],
+                        gcp,
+                        mysql_conn,
+                        billing_account_id,
+                        default_pubsub_topic,
+                        dry_run,
+                    )
+
+            with tracer.span(SPAN_SECTION, section="reconcile"), profiler.phase(
+                PHASE_RECONCILE
+            ):
+                run_scheduled(run, scheduler)
+
+            # Default logic removed for now because it will create hundreds of budgets
+            # And we need to decide good thresholds for this
+            """
+            default_dict = budget_dict['default']
+            config_type = PLUTUS_CONFIG_TYPE_DEFAULT
+
+            if verify_default_yaml(default_dict):
+            ## Query for all projects. If no budget exists for project, add a default budget
+                for p in resource_manager_client.list_projects():
+                    project_id = p.project_id
+                    project_number = gcp.get_project_number(project_id)
+                    if project_number is not None:
+                        budgets = gcp.get_budgets_by_project(project, project_number)
+                        if len(budgets) == 0:
+                            # No budget exists for this project, so we create one
+                            default_dict['project_id'] = project_id
+
+                            # TODO - add and test, also add dry_run logic
+                            # project = ProjectBudget(default_dict, config_type,
+                            #           billing_account_id, default_pubsub_topic)
+                            log.info(f"Creating default budget for plutus-default-{project_id}")
+                            # budget = gcp.create_budget(project)
+                            # metrics.incr("default_budget_created_count", tags=[])
+
+                            # if budget is not None:
+                            #    with mysql_conn.cursor() as mysql_cursor:
+                            #        upsert_budget(mysql_cursor, budget, project.project_id,
+                            #                      config_type, project.alert_emails)
+
+                            # TODO - delete plutus-default budget if > 1 budget
+                        elif len(budgets) > 1:
+                            # TODO - if one of the budgets is a plutus-default, delete via API and in Mysql
+                            pass
+
+            else:
+                log.error("Default config verification failed.")
+                metrics.incr("error_count", tags=["type:misconfig", f"config_type:{config_type}"])
+                sys.exit(1)
+            """
+
+            if targeted:
+                skip_reason = "targeted run"
+            else:
+                skip_reason = section_skip_reason(
+                    run, gcp, API_RESOURCE_MANAGER, API_BILLING
+                )
+            if skip_reason is not None:
+                run.record_skipped("section", "defunct_budgets", skip_reason)
+            else:
+                with tracer.span(
+                    SPAN_SECTION, section="defunct_budgets"
+                ), profiler.phase(PHASE_GC):
+                    delete_defunct_budgets(gcp, billing_account_id, dry_run)
+
+            if spend_rollup and not dry_run:
+                skip_reason = (
+                    "targeted run" if targeted else section_skip_reason(run, gcp)
+                )
+                if skip_reason is not None:
+                    run.record_skipped("section", "spend_rollup", skip_reason)
+                else:
+                    with tracer.span(
+                        SPAN_SECTION, section="spend_rollup"
+                    ), profiler.phase(PHASE_MYSQL):
+                        rollup_spend_history(mysql_conn, spend_history_retention)
+
+        ok = run.finish()
+    finally:
+        if lock is not None:
+            lock.release()
+        # Flush any buffered spans, profiles and metrics, even when a section exits early
+        tracer.shutdown()
+        profiler.stop()
+        clients.report_channel_stats()
+        flush_metrics()
+
+    log.info("Plutus run complete.")
+
+    if not ok:
+        sys.exit(1)
+
+
+def load_budget_config(local_mode, gcs_bucket, gcs_file_path):
+    """Loads the budgets yaml config, from /app/config.yaml in local mode or else from gcs."""
     if local_mode:
-        if gcs_bucket is not None or gcs_file_path is not None:
-            log.warning(
-                f"You are using local mode, and gcs_bucket ({gcs_bucket}) and gcs_file_path ({gcs_file_path}) will not be used."
+        with open("/app/config.yaml", "r") as f:
+            return yaml.load(f, Loader=yaml.SafeLoader)
+
+    # Load yaml configuration file from GCS
+    gcs_client = clients.storage_client()
+    bucket = gcs_client.bucket(gcs_bucket)
+    blob = bucket.blob(gcs_file_path)
+    yaml_string = blob.download_as_string()
+    return yaml.load(yaml_string, Loader=yaml.SafeLoader)
+
+
+def get_labels_filter(label_dict):
+    """Returns a labels config entry's label_list as {"labels.key": value}."""
+    labels_filter = {}
+    for row in label_dict["label_list"]:
+        for key in row:
+            labels_filter[f"labels.{key}"] = row[key]
+    return labels_filter
+
+
+def update_or_create_and_record(gcp, mysql_conn, project, config_type):
+    """Gets and updates or creates the budget for project, then records it in mysql."""
+    budget = gcp.get_and_update_or_create_budget(project)
+
+    if budget is not None:
+        with profiler.phase(PHASE_MYSQL), mysql_conn.cursor() as mysql_cursor:
+            upsert_budget(
+                mysql_cursor,
+                gcp,
+                budget,
+                project.project_id,
+                config_type,
+                project.alert_emails,
+                project.alert_slack_channel_id,
             )
 
-        with open("/app/config.yaml", "r") as f:
-            budget_dict = yaml.load(f, Loader=yaml.SafeLoader)
 
-        setup_metrics("localhost")
+def section_skip_reason(run, gcp, *apis):
+    """Returns why a section calling apis shouldn't start, or None if it can."""
+    if run.past_deadline():
+        return "run deadline reached"
+    for api in apis:
+        if gcp.breakers[api].open:
+            return f"{api} API circuit breaker open"
+    return None
+
+
+def reconcile_project(run, project, func, *args, **span_attributes):
+    """
+    Reconciles a single project by calling func(*args). A failure is recorded in the run
+    report and checkpointed for retry instead of aborting the run.
+    """
+    if run.should_skip(project) is not None:
+        return
+
+    with tracer.span(
+        SPAN_PROJECT, project_id=project.project_id, **span_attributes
+    ) as span:
+        try:
+            func(*args)
+        except CircuitOpenError as err:
+            # The API is down rather than anything being wrong with the project
+            span.status = "error"
+            run.record_skipped(project.config_type, project.project_id, str(err))
+        except Exception as err:
+            span.status = "error"
+            span.set_attribute("error", str(err))
+            run.record_failure(project, err)
+        else:
+            run.record_success(project)
+
+
+def run_scheduled(run, scheduler):
+    """Reconciles the scheduler's work, most urgent first, until the run deadline."""
+    for work in scheduler.ordered():
+        reconcile_project(
+            run,
+            work.project,
+            work.func,
+            *work.args,
+            priority=PRIORITY_NAMES[work.priority],
+            **work.span_attributes,
+        )
+
+
+def reconcile_project_budget(gcp, mysql_conn, project, dry_run):
+    if dry_run:
+        log.info(
+            f"Dry run: would have ran get_and_update_or_create_budget for project: {project.project_id}"
+        )
     else:
-        # Load yaml configuration file from GCS
-        gcs_client = storage.Client()
-        bucket = gcs_client.bucket(gcs_bucket)
-        blob = bucket.blob(gcs_file_path)
-        yaml_string = blob.download_as_string()
-        budget_dict = yaml.load(yaml_string, Loader=yaml.SafeLoader)
-        # Setup metrics with configured statsd host
-        setup_metrics(statsd_host)
+        log.info(f"Processing project: {project.project_id}...")
+        update_or_create_and_record(gcp, mysql_conn, project, project.config_type)
 
-    # Setup gcp helper
-    billing_client = BudgetServiceClient()
-    resource_manager_client = resourcemanager_v3.ProjectsClient()
 
-    gcp = GcpHelper(billing_client, resource_manager_client)
+def reconcile_parent_project_budget(gcp, mysql_conn, project, dry_run):
+    parent_id = project.parent_id
+    existing_project_budget_id = gcp.has_existing_project_budget(project)
 
-    # Setup mysql connection pool
-    pool = PooledDB(
-        creator=pymysql,
-        host=mysql_host,
-        user=mysql_user,
-        password=mysql_pass,
-        database=mysql_db,
-        autocommit=True,
-        blocking=True,
-        maxconnections=5,
-    )
-    mysql_conn = pool.connection()
+    if existing_project_budget_id is None:
+        # No project one off budget configured for this projectid
+        if dry_run:
+            log.info(
+                f"Dry run (parent folders): would have ran get_and_update_or_create_budget for project: {project.project_id}"
+            )
+        else:
+            log.info(
+                f"Processing parent_id: {parent_id}, project: {project.project_id}..."
+            )
+            update_or_create_and_record(gcp, mysql_conn, project, project.config_type)
+    else:
+        log.info(f"Skipping creating parent project budget for \
+                  {project.project_id} since existing plutus project budget found.")
+
+        existing_parent_budget_id = gcp.has_existing_parent_budget(parent_id, project)
+        if existing_parent_budget_id is not None:
+            # We have a configured plutus project budget. Delete parent budget
+            gcp.delete_budget(existing_parent_budget_id)
+
+
+def reconcile_label_project_budget(gcp, mysql_conn, project, labels_filter, dry_run):
+    existing_project_budget_id = gcp.has_existing_project_budget(project)
+
+    if existing_project_budget_id is None:
+        # No project one off budget configured for this projectid
+        if dry_run:
+            log.info(
+                f"Dry run (labels): would have ran get_and_update_or_create_budget for project: {project.project_id}"
+            )
+        else:
+            log.info(
+                f"Processing labels: {labels_filter}, project: {project.project_id}..."
+            )
+            update_or_create_and_record(gcp, mysql_conn, project, project.config_type)
+    else:
+        log.info(f"Skipping creating label project budget for \
+                  {project.project_id} since existing plutus project budget found.")
+
+        existing_labels_budget_id = gcp.has_existing_labels_budget(project)
+        if existing_labels_budget_id is not None:
+            # We have a configured plutus project budget. Delete labels budget
+            gcp.delete_budget(existing_labels_budget_id)
 
-    # Iterate over all configured project budgets
-    for project_dict in budget_dict["projects"]:
-        config_type = PLUTUS_CONFIG_TYPE_PROJECT
 
+def reconcile_projects(
+    run,
+    scheduler,
+    project_dicts,
+    gcp,
+    mysql_conn,
+    billing_account_id,
+    default_pubsub_topic,
+    dry_run,
+):
+    """Queue all configured project budgets"""
+    config_type = PLUTUS_CONFIG_TYPE_PROJECT
+
+    for project_dict in project_dicts:
         if verify_project_yaml(project_dict):
             project = ProjectBudget(
                 project_dict, config_type, billing_account_id, default_pubsub_topic
             )
 
-            if dry_run:
-                log.info(
-                    f"Dry run: would have ran get_and_update_or_create_budget for project: {project.project_id}"
-                )
-            else:
-                log.info(f"Processing project: {project.project_id}...")
-                budget = gcp.get_and_update_or_create_budget(project)
-
-                if budget is not None:
-                    with mysql_conn.cursor() as mysql_cursor:
-                        upsert_budget(
-                            mysql_cursor,
-                            budget,
-                            project.project_id,
-                            config_type,
-                            project.alert_emails,
-                            project.alert_slack_channel_id,
-                        )
+            scheduler.add(
+                project,
+                reconcile_project_budget,
+                gcp,
+                mysql_conn,
+                project,
+                dry_run,
+                section="projects",
+            )
 
         else:
             log.error("Project config verification failed.")
@@ -154,63 +602,76 @@ def main(
                 "error_count",
                 tags=[
                     "type:misconfig",
-                    f"project_id:{project.project_id}",
+                    f"project_id:{project_dict.get('project_id')}",
                     f"config_type:{config_type}",
                 ],
             )
-            sys.exit(1)
+            run.record_config_error(
+                config_type,
+                project_dict.get("project_id"),
+                "Project config verification failed",
+            )
+
+
+def reconcile_parent_folders(
+    run,
+    scheduler,
+    parent_dicts,
+    gcp,
+    mysql_conn,
+    billing_account_id,
+    default_pubsub_topic,
+    dry_run,
+):
+    """Queue budgets for the projects under all configured parent folders"""
+    config_type = PLUTUS_CONFIG_TYPE_PARENT
+
+    for parent_dict in parent_dicts:
+        parent_id = parent_dict.get("parent_folder_id")
 
-    # Iterate over all configured parent folder id budgets
-    for parent_dict in budget_dict["parent_folders"]:
-        parent_id = parent_dict["parent_folder_id"]
-        config_type = PLUTUS_CONFIG_TYPE_PARENT
+        skip_reason = section_skip_reason(run, gcp, API_RESOURCE_MANAGER)
+        if skip_reason is not None:
+            run.record_skipped(config_type, parent_id, skip_reason)
+            continue
 
         if verify_parent_yaml(parent_dict):
             parent_filter = f"folders/{parent_id}"
 
-            for p in resource_manager_client.list_projects(parent=parent_filter):
+            try:
+                with profiler.phase(PHASE_EXPANSION):
+                    parent_projects = gcp.call(
+                        API_RESOURCE_MANAGER,
+                        "list_projects",
+                        gcp.resource_manager_client.list_projects,
+                        paged=True,
+                        parent=parent_filter,
+                    )
+            except Exception as err:
+                log.error(f"Error listing projects under {parent_filter}: {err}")
+                metrics.incr(
+                    "error_count",
+                    tags=["type:resource_manager.list", f"parent_id:{parent_id}"],
+                )
+                run.record_config_error(config_type, parent_id, err)
+                continue
+
+            for p in parent_projects:
                 # Overwrite 'project_id' key for each project under parent folder
                 parent_dict["project_id"] = p.project_id
                 project = ProjectBudget(
                     parent_dict, config_type, billing_account_id, default_pubsub_topic
                 )
 
-                existing_project_budget_id = gcp.has_existing_project_budget(project)
-
-                if existing_project_budget_id is None:
-                    # No project one off budget configured for this projectid
-                    if dry_run:
-                        log.info(
-                            f"Dry run (parent folders): would have ran get_and_update_or_create_budget for project: {project.project_id}"
-                        )
-                    else:
-                        log.info(
-                            f"Processing parent_id: {parent_id}, project: {project.project_id}..."
-                        )
-                        budget = gcp.get_and_update_or_create_budget(project)
-
-                        if budget is not None:
-                            with mysql_conn.cursor() as mysql_cursor:
-                                upsert_budget(
-                                    mysql_cursor,
-                                    budget,
-                                    project.project_id,
-                                    config_type,
-                                    project.alert_emails,
-                                    project.alert_slack_channel_id,
-                                )
-                else:
-                    log.info(
-                        f"Skipping creating parent project budget for \
-                              {p.project_id} since existing plutus project budget found."
-                    )
-
-                    existing_parent_budget_id = gcp.has_existing_parent_budget(
-                        parent_id, project
-                    )
-                    if existing_parent_budget_id is not None:
-                        # We have a configured plutus project budget. Delete parent budget
-                        gcp.delete_budget(existing_parent_budget_id)
+                scheduler.add(
+                    project,
+                    reconcile_parent_project_budget,
+                    gcp,
+                    mysql_conn,
+                    project,
+                    dry_run,
+                    parent_id=parent_id,
+                    section="parent_folders",
+                )
 
         else:
             log.error("Parent folder config verification failed.")
@@ -222,25 +683,40 @@ def main(
                     f"config_type:{config_type}",
                 ],
             )
-            sys.exit(1)
+            run.record_config_error(
+                config_type, parent_id, "Parent folder config verification failed"
+            )
+
 
-    # Iterate over all configured label budgets
-    for label_dict in budget_dict["labels"]:
-        config_type = PLUTUS_CONFIG_TYPE_LABEL
+def reconcile_labels(
+    run,
+    scheduler,
+    label_dicts,
+    gcp,
+    mysql_conn,
+    billing_account_id,
+    default_pubsub_topic,
+    dry_run,
+):
+    """Queue budgets for the projects matching all configured labels"""
+    config_type = PLUTUS_CONFIG_TYPE_LABEL
+
+    for label_dict in label_dicts:
+        skip_reason = section_skip_reason(run, gcp, API_ASSET)
+        if skip_reason is not None:
+            run.record_skipped(config_type, label_dict.get("label_list"), skip_reason)
+            continue
 
         if verify_labels_yaml(label_dict):
 
-            labels_filter = {}
-            for row in label_dict["label_list"]:
-                for key in row:
-                    labels_filter[f"labels.{key}"] = row[key]
+            labels_filter = get_labels_filter(label_dict)
 
             # Find projects that match the labels
             # In the old resource manager api v0.30.5, we used list_projects with a labels filter
             # Now in the new resource manager 1.10.x, the list_projects doesn't support it anymore.
             # And search_projects(), will return projects that match ANY of the labels rather than doing a
             # logical AND. So lets try the new beta cloud asset inventory api
-            asset_client = asset_v1.AssetServiceClient()
+            asset_client = clients.asset_client()
             scope = "organizations/442341870013"
             asset_types = ["cloudresourcemanager.googleapis.com/Project"]
             order_by = "project"
@@ -251,14 +727,27 @@ def main(
 
             log.info(f"query filter is: {query}")
 
-            response = asset_client.search_all_resources(
-                request={
-                    "scope": scope,
-                    "query": query,
-                    "asset_types": asset_types,
-                    "order_by": order_by,
-                }
-            )
+            try:
+                with tracer.span(
+                    "asset.search_all_resources", query=query
+                ), profiler.phase(PHASE_EXPANSION):
+                    response = gcp.call(
+                        API_ASSET,
+                        "search_all_resources",
+                        asset_client.search_all_resources,
+                        paged=True,
+                        request={
+                            "scope": scope,
+                            "query": query,
+                            "asset_types": asset_types,
+                            "order_by": order_by,
+                        },
+                    )
+            except Exception as err:
+                log.error(f"Error searching projects matching {query}: {err}")
+                metrics.incr("error_count", tags=["type:asset_inventory.search_all"])
+                run.record_config_error(config_type, query, err)
+                continue
 
             for p in response:
                 proto_dict = MessageToDict(p._pb)
@@ -281,89 +770,153 @@ def main(
                     label_dict, config_type, billing_account_id, default_pubsub_topic
                 )
 
-                existing_project_budget_id = gcp.has_existing_project_budget(project)
-
-                if existing_project_budget_id is None:
-                    # No project one off budget configured for this projectid
-                    if dry_run:
-                        log.info(
-                            f"Dry run (labels): would have ran get_and_update_or_create_budget for project: {project.project_id}"
-                        )
-                    else:
-                        log.info(
-                            f"Processing labels: {labels_filter}, project: {project.project_id}..."
-                        )
-                        budget = gcp.get_and_update_or_create_budget(project)
-
-                        if budget is not None:
-                            with mysql_conn.cursor() as mysql_cursor:
-                                upsert_budget(
-                                    mysql_cursor,
-                                    budget,
-                                    project.project_id,
-                                    config_type,
-                                    project.alert_emails,
-                                    project.alert_slack_channel_id,
-                                )
-                else:
-                    log.info(
-                        f"Skipping creating label project budget for \
-                              {p.project_id} since existing plutus project budget found."
-                    )
-
-                    existing_labels_budget_id = gcp.has_existing_labels_budget(project)
-                    if existing_labels_budget_id is not None:
-                        # We have a configured plutus project budget. Delete labels budget
-                        gcp.delete_budget(existing_labels_budget_id)
+                scheduler.add(
+                    project,
+                    reconcile_label_project_budget,
+                    gcp,
+                    mysql_conn,
+                    project,
+                    labels_filter,
+                    dry_run,
+                    section="labels",
+                )
 
         else:
             log.error("Labels config verification failed.")
             metrics.incr(
                 "error_count", tags=["type:misconfig", f"config_type:{config_type}"]
             )
-            sys.exit(1)
+            run.record_config_error(
+                config_type,
+                label_dict.get("label_list"),
+                "Labels config verification failed",
+            )
 
-    # Default logic removed for now because it will create hundreds of budgets
-    # And we need to decide good thresholds for this
-    """
-    default_dict = budget_dict['default']
-    config_type = PLUTUS_CONFIG_TYPE_DEFAULT
-
-    if verify_default_yaml(default_dict):
-    ## Query for all projects. If no budget exists for project, add a default budget
-        for p in resource_manager_client.list_projects():
-            project_id = p.project_id
-            project_number = gcp.get_project_number(project_id)
-            if project_number is not None:
-                budgets = gcp.get_budgets_by_project(project, project_number)
-                if len(budgets) == 0:
-                    # No budget exists for this project, so we create one
-                    default_dict['project_id'] = project_id
-
-                    # TODO - add and test, also add dry_run logic
-                    # project = ProjectBudget(default_dict, config_type,
-                    #           billing_account_id, default_pubsub_topic)
-                    log.info(f"Creating default budget for plutus-default-{project_id}")
-                    # budget = gcp.create_budget(project)
-                    # metrics.incr("default_budget_created_count", tags=[])
-
-                    # if budget is not None:
-                    #    with mysql_conn.cursor() as mysql_cursor:
-                    #        upsert_budget(mysql_cursor, budget, project.project_id,
-                    #                      config_type, project.alert_emails)
-
-                    # TODO - delete plutus-default budget if > 1 budget
-                elif len(budgets) > 1:
-                    # TODO - if one of the budgets is a plutus-default, delete via API and in Mysql
-                    pass
 
-    else:
-        log.error("Default config verification failed.")
-        metrics.incr("error_count", tags=["type:misconfig", f"config_type:{config_type}"])
-        sys.exit(1)
+def lookup_project(gcp, project_id):
+    """Returns the TargetProject of project_id, from a single resource manager lookup."""
+    project = gcp.call(
+        API_RESOURCE_MANAGER,
+        "get_project",
+        gcp.resource_manager_client.get_project,
+        name=f"projects/{project_id}",
+    )
+    if project.state.name != "ACTIVE":
+        raise ProjectError(f"Project {project_id} is {project.state.name}")
+    return TargetProject(
+        project.project_id, folder_id(project.parent), dict(project.labels)
+    )
+
+
+def reconcile_targets(
+    run,
+    scheduler,
+    budget_dict,
+    project_ids,
+    folder_ids,
+    labels,
+    gcp,
+    mysql_conn,
+    billing_account_id,
+    default_pubsub_topic,
+    dry_run,
+):
     """
+    Queue budgets for the targeted projects, folders and labels only. Each project is
+    looked up on its own, and matched against every config section like the project
+    change feed does. Folders and labels only expand their own entries.
+    """
+    for project_id in project_ids:
+        try:
+            target = lookup_project(gcp, project_id)
+        except Exception as err:
+            log.error(f"Error looking up project {project_id}: {err}")
+            metrics.incr("error_count", tags=["type:resource_manager.get"])
+            run.record_config_error(PLUTUS_CONFIG_TYPE_PROJECT, project_id, err)
+            continue
+
+        entries = matching_entries(budget_dict, target)
+        if not entries:
+            run.record_config_error(
+                PLUTUS_CONFIG_TYPE_PROJECT, project_id, "No budget configured"
+            )
+
+        for config_type, entry in entries:
+            project = ProjectBudget(
+                dict(entry, project_id=project_id),
+                config_type,
+                billing_account_id,
+                default_pubsub_topic,
+            )
+            if config_type == PLUTUS_CONFIG_TYPE_PROJECT:
+                scheduler.add(
+                    project,
+                    reconcile_project_budget,
+                    gcp,
+                    mysql_conn,
+                    project,
+                    dry_run,
+                    section="projects",
+                )
+            elif config_type == PLUTUS_CONFIG_TYPE_PARENT:
+                scheduler.add(
+                    project,
+                    reconcile_parent_project_budget,
+                    gcp,
+                    mysql_conn,
+                    project,
+                    dry_run,
+                    parent_id=target.parent_id,
+                    section="parent_folders",
+                )
+            else:
+                scheduler.add(
+                    project,
+                    reconcile_label_project_budget,
+                    gcp,
+                    mysql_conn,
+                    project,
+                    get_labels_filter(entry),
+                    dry_run,
+                    section="labels",
+                )
 
-    # Start delete defunct project logic here #
+    selected = select_entries(budget_dict, folder_ids, labels)
+    configured = {str(d["parent_folder_id"]) for d in selected["parent_folders"]}
+    for parent_id in folder_ids:
+        if str(parent_id) not in configured:
+            run.record_config_error(
+                PLUTUS_CONFIG_TYPE_PARENT, parent_id, "No budget configured"
+            )
+    if labels and not selected["labels"]:
+        run.record_config_error(
+            PLUTUS_CONFIG_TYPE_LABEL, labels, "No budget configured"
+        )
+
+    reconcile_parent_folders(
+        run,
+        scheduler,
+        selected["parent_folders"],
+        gcp,
+        mysql_conn,
+        billing_account_id,
+        default_pubsub_topic,
+        dry_run,
+    )
+    reconcile_labels(
+        run,
+        scheduler,
+        selected["labels"],
+        gcp,
+        mysql_conn,
+        billing_account_id,
+        default_pubsub_topic,
+        dry_run,
+    )
+
+
+def delete_defunct_budgets(gcp, billing_account_id, dry_run):
+    """Deletes plutus budgets whose project no longer exists."""
     # Save a list of all project's project numbers. e.g. projects/12345
     all_gcp_project_numbers = []
 
@@ -372,17 +925,27 @@ def main(
     # The search_projects() function call is eventually consistent. From google docs: "this means
     # that a newly created project may not appear in the results or recent updates to an existing
     # project may not be reflected in the results.
-    page_result = resource_manager_client.search_projects()
-    for response in page_result:
-        all_gcp_project_numbers.append(response.name)
+    with tracer.span("gcp.search_all_projects"):
+        page_result = gcp.call(
+            API_RESOURCE_MANAGER,
+            "search_projects",
+            gcp.resource_manager_client.search_projects,
+            paged=True,
+        )
+        for response in page_result:
+            all_gcp_project_numbers.append(response.name)
 
     all_gcp_projects_count = len(all_gcp_project_numbers)
     log.info(f"total number of gcp projects is: {all_gcp_projects_count}")
     metrics.gauge("plutus.all_gcp_projects_count", value=int(all_gcp_projects_count))
 
     # Iterate over all budgets and rm budgets attached to defunct projects
-    list_budgets_result = billing_client.list_budgets(
-        parent=f"billingAccounts/{billing_account_id}"
+    list_budgets_result = gcp.call(
+        API_BILLING,
+        "list_budgets",
+        gcp.billing_client.list_budgets,
+        paged=True,
+        parent=f"billingAccounts/{billing_account_id}",
     )
 
     delete_count = 0
@@ -428,21 +991,29 @@ def main(
     # Count total budgets for gauge metric
     metrics.gauge("plutus.budget_count", value=int(budget_count))
 
-    log.info("Plutus run complete.")
-
 
-def setup_metrics(statsd_host):
+def setup_metrics(statsd_host, tag_allowlist=None, tag_buckets=0, flush_interval=0):
     markus.configure(
         backends=[
             {
-                # Log metrics to statd to telegraf to influx.
-                # We use datadog backend class to get support for tags and histograms
-                # https://github.com/willkg/markus/blob/master/markus/backends/statsd.py#L58-L64
-                "class": "markus.backends.datadog.DatadogMetrics",
+                # Aggregate metrics in process and send them once per flush_metrics(),
+                # instead of one udp packet per metrics call
+                "class": "plutus.lib.metrics.BufferedMetrics",
                 "options": {
-                    "statsd_host": statsd_host,
-                    "statsd_port": 8125,
-                    "statsd_namespace": "influx",
+                    "tag_allowlist": tag_allowlist,
+                    "tag_buckets": tag_buckets,
+                    "flush_interval": flush_interval,
+                    "backend": {
+                        # Log metrics to statd to telegraf to influx.
+                        # We use datadog backend class to get support for tags and histograms
+                        # https://github.com/willkg/markus/blob/master/markus/backends/statsd.py#L58-L64
+                        "class": "markus.backends.datadog.DatadogMetrics",
+                        "options": {
+                            "statsd_host": statsd_host,
+                            "statsd_port": 8125,
+                            "statsd_namespace": "influx",
+                        },
+                    },
                 },
             }
         ]
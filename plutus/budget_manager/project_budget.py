@@ -1,3 +1,5 @@
+from plutus.budget_manager.checkpoint import config_hash
+from plutus.lib.exceptions import ProjectError
 from plutus.lib.constants import (
     APP,
     PLUTUS_CONFIG_TYPE_PROJECT,
@@ -7,7 +9,6 @@ from plutus.lib.constants import (
 )
 import logging
 import markus
-import sys
 
 metrics = markus.get_metrics(f"{APP}.projectbudget")
 
@@ -34,6 +35,7 @@ class ProjectBudget:
     config_type - str - The type of budget. Either project, parent, label, or default
     parent_id - str - Optional - GCP parent folder id. For use with config_type parent
     label_list - str - Optional - list of label k/v pairs. For use with config_type label
+    entry_hash - str - Hash of the config entry, to tell when it changed since the last run
 
     """
 
@@ -46,6 +48,11 @@ class ProjectBudget:
             setattr(self, key, project_dict[key])
 
         self.billing_account_id = billing_account_id
+        # Parent folder and label entries are shared by their projects, whose project_id
+        # is set on the entry for each, so it's left out
+        self.entry_hash = config_hash(
+            {k: v for k, v in project_dict.items() if k != "project_id"}
+        )
 
         if "pubsub_topic" not in project_dict:
             self.pubsub_topic = default_pubsub_topic
@@ -74,7 +81,7 @@ class ProjectBudget:
                     f"config_type:{config_type}",
                 ],
             )
-            sys.exit(1)
+            raise ProjectError(f"Unknown plutus config type: {config_type}")
 
     def __str__(self):
         return f"""{self.project_id}, {self.budget_type}, {self.budget_amount},
@@ -0,0 +1,125 @@
+from plutus.lib.constants import APP
+from plutus.lib.mysql import acquire_lease, release_lease, renew_lease
+import logging
+import markus
+import os
+import socket
+import threading
+import time
+import uuid
+
+log = logging.getLogger(f"{APP}.run_lock")
+metrics = markus.get_metrics(f"{APP}.run_lock")
+
+RUN_LOCK_NAME = "budget_manager"
+
+
+class RunLock:
+    """
+    Lease in the run_locks table held for the length of a budget manager run, so a run that
+    starts while another is still going (e.g. the next cron run, or a second replica) skips
+    or waits instead of reconciling the same projects twice.
+
+    The lease expires ttl seconds after it was last renewed, and a heartbeat thread renews it
+    every ttl / 4 seconds on its own connection from connect(). A run that dies without
+    releasing it only blocks others until it expires.
+
+    Fields:
+    -------
+    holder - str - Unique id of this run's process, host:pid:random
+    acquired - bool - Whether this run holds the lease
+    lost - threading.Event - Set if the heartbeat found the lease taken by someone else
+    """
+
+    def __init__(self, connect, name=RUN_LOCK_NAME, ttl=120, poll_interval=10):
+        self.connect = connect
+        self.name = name
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.acquired = False
+        self.lost = threading.Event()
+        self._stop = threading.Event()
+        self._heartbeat = None
+        self._acquired_at = None
+
+    def acquire(self, wait=0):
+        """
+        Takes the lease, waiting up to wait seconds for the current holder's to end.
+        Returns True if this run may go ahead: it holds the lease, or the lease table
+        couldn't be used, in which case the run goes ahead unlocked.
+        """
+        started = time.monotonic()
+        conn = self.connect()
+        try:
+            while True:
+                with conn.cursor() as mysql_cursor:
+                    lease = acquire_lease(
+                        mysql_cursor, self.name, self.holder, self.ttl
+                    )
+                if lease is None:
+                    log.warning("Run lock unavailable, running without it")
+                    return True
+                if lease[0] == self.holder:
+                    break
+
+                waited = time.monotonic() - started
+                if waited + self.poll_interval > wait:
+                    metrics.timing("wait_time", waited * 1000)
+                    metrics.incr("skipped_count")
+                    log.warning(
+                        f"Run lock held by {lease[0]} until {lease[1]}, skipping this run"
+                    )
+                    return False
+                time.sleep(self.poll_interval)
+        finally:
+            conn.close()
+
+        metrics.timing("wait_time", (time.monotonic() - started) * 1000)
+        log.info(f"Took run lock as {self.holder}")
+        self.acquired = True
+        self._acquired_at = time.monotonic()
+        self._heartbeat = threading.Thread(
+            target=self._renew_periodically, name="run-lock-heartbeat", daemon=True
+        )
+        self._heartbeat.start()
+        return True
+
+    def _renew_periodically(self):
+        while not self._stop.wait(self.ttl / 4):
+            try:
+                conn = self.connect()
+                try:
+                    with conn.cursor() as mysql_cursor:
+                        renewed = renew_lease(
+                            mysql_cursor, self.name, self.holder, self.ttl
+                        )
+                finally:
+                    conn.close()
+            except Exception as err:
+                log.error(f"Error renewing run lock: {err}")
+                metrics.incr("error_count", tags=["type:lock_heartbeat"])
+                continue
+
+            if not renewed:
+                # Another run took over after a missed renewal. There is no safe point to
+                # stop this one at, so report it, the runs overlap from here on
+                log.error(f"Run lock {self.name} was taken over by another run")
+                metrics.incr("lost_count")
+                self.lost.set()
+                return
+
+    def release(self):
+        if not self.acquired:
+            return
+        self._stop.set()
+        self._heartbeat.join()
+        metrics.timing("hold_time", (time.monotonic() - self._acquired_at) * 1000)
+        if not self.lost.is_set():
+            conn = self.connect()
+            try:
+                with conn.cursor() as mysql_cursor:
+                    release_lease(mysql_cursor, self.name, self.holder)
+            finally:
+                conn.close()
+        self.acquired = False
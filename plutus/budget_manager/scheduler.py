@@ -0,0 +1,106 @@
+from plutus.lib.constants import APP
+from plutus.lib.mysql import get_reconcile_priorities
+from collections import namedtuple
+import datetime
+import logging
+import markus
+
+log = logging.getLogger(f"{APP}.scheduler")
+metrics = markus.get_metrics(f"{APP}.scheduler")
+
+# Most urgent first
+PRIORITY_NEW = 0
+PRIORITY_CHANGED = 1
+PRIORITY_STALE = 2
+PRIORITY_FRESH = 3
+PRIORITY_NAMES = {
+    PRIORITY_NEW: "new",
+    PRIORITY_CHANGED: "changed",
+    PRIORITY_STALE: "stale",
+    PRIORITY_FRESH: "fresh",
+}
+
+# Reconcile work for one project of a config entry. func(*args) reconciles it.
+Work = namedtuple(
+    "Work", ["project", "func", "args", "span_attributes", "priority", "verified"]
+)
+
+
+class ReconcileScheduler:
+    """
+    Orders a run's reconcile work by priority rather than config order, so that when the run
+    deadline cuts a run short, what's left undone is the work that mattered least:
+
+    1. new - projects plutus never reconciled, e.g. newly created projects without budgets
+    2. changed - projects whose config entry changed since they were last reconciled
+    3. stale - projects whose budget was last verified more than stale_after seconds ago
+    4. fresh - everything else
+
+    Within a priority, projects verified longest ago come first. Work left undone carries
+    over: the next run resumes this one, or if it starts over, finds that work the least
+    recently verified. So every project is verified at least every few runs, however many
+    projects there are.
+
+    All work for a project runs together, in config order, at its most urgent priority. A
+    project in both projects and a parent folder keeps its project budget reconciled first.
+
+    priorities - dict - (config_type, project_id) -> (entry_hash, verified), see load()
+    """
+
+    def __init__(self, priorities, stale_after=86400, now=None):
+        self.priorities = priorities
+        now = now or datetime.datetime.utcnow()
+        self.stale_before = now - datetime.timedelta(seconds=stale_after)
+        self.work = []
+
+    @classmethod
+    def load(cls, mysql_conn, stale_after=86400):
+        """Creates a scheduler with the priorities in reconcile_state. mysql_conn may be None."""
+        priorities = {}
+        if mysql_conn is not None:
+            with mysql_conn.cursor() as mysql_cursor:
+                priorities = get_reconcile_priorities(mysql_cursor)
+        return cls(priorities, stale_after)
+
+    def priority(self, project):
+        """Returns (priority, verified) of project, verified is None if it never was."""
+        state = self.priorities.get((project.config_type, project.project_id))
+        if state is None:
+            return PRIORITY_NEW, None
+
+        entry_hash, verified = state
+        # No hash yet means it predates the scheduler rather than that it changed
+        if entry_hash is not None and entry_hash != project.entry_hash:
+            return PRIORITY_CHANGED, verified
+        if verified is None or verified < self.stale_before:
+            return PRIORITY_STALE, verified
+        return PRIORITY_FRESH, verified
+
+    def add(self, project, func, *args, **span_attributes):
+        """Queues func(*args) to reconcile project."""
+        priority, verified = self.priority(project)
+        self.work.append(Work(project, func, args, span_attributes, priority, verified))
+
+    def ordered(self):
+        """Returns the queued work, most urgent first."""
+        groups = {}
+        for work in self.work:
+            groups.setdefault(work.project.project_id, []).append(work)
+
+        def urgency(work):
+            return work.priority, work.verified or datetime.datetime.min
+
+        # sorted() is stable, so ties keep config order
+        ordered = sorted(groups.values(), key=lambda group: min(map(urgency, group)))
+
+        counts = {name: 0 for name in PRIORITY_NAMES.values()}
+        for group in ordered:
+            counts[PRIORITY_NAMES[min(w.priority for w in group)]] += len(group)
+        log.info(
+            "Reconcile work by priority: "
+            + ", ".join(f"{count} {name}" for name, count in counts.items())
+        )
+        for name, count in counts.items():
+            metrics.gauge("queued_count", count, tags=[f"type:{name}"])
+
+        return [work for group in ordered for work in group]
@@ -0,0 +1,99 @@
+"""
+Selecting the config entries that apply to given projects, folders or labels, for runs that
+reconcile a few projects rather than the whole config: the project change feed (watch.py)
+and main.py's --only-project, --only-folder and --only-label.
+"""
+
+from plutus.budget_manager.verify import (
+    verify_labels_yaml,
+    verify_parent_yaml,
+    verify_project_yaml,
+)
+from plutus.lib.constants import (
+    PLUTUS_CONFIG_TYPE_LABEL,
+    PLUTUS_CONFIG_TYPE_PARENT,
+    PLUTUS_CONFIG_TYPE_PROJECT,
+)
+from collections import namedtuple
+import re
+
+# What config matches a project on. parent_id is the direct parent folder id, if any
+TargetProject = namedtuple("TargetProject", ["project_id", "parent_id", "labels"])
+
+
+def folder_id(parent):
+    """Returns the folder id of a "folders/123" parent name, or None for other parents."""
+    match = re.search(r"folders/(\d+)$", parent or "")
+    return match.group(1) if match else None
+
+
+def parse_label_selector(selectors):
+    """Returns "key=value" label selectors as {key: value}. Raises ValueError if malformed."""
+    labels = {}
+    for selector in selectors:
+        key, sep, value = selector.partition("=")
+        if not sep or not key or not value:
+            raise ValueError(f"Expected key=value, got {selector!r}")
+        labels[key] = value
+    return labels
+
+
+def labels_filter_matches(label_dict, labels):
+    """Returns True if a labels entry requires every one of labels, with the same value."""
+    required = {
+        key: str(value)
+        for row in label_dict["label_list"]
+        for key, value in row.items()
+    }
+    return all(required.get(key) == value for key, value in labels.items())
+
+
+def matching_entries(budget_dict, project):
+    """
+    Returns (config_type, entry) for every config entry matching project, a TargetProject
+    or anything else with its fields (e.g. a watch.ProjectChange), in config order.
+    """
+    entries = []
+    for project_dict in budget_dict.get("projects") or []:
+        matches = project_dict.get("project_id") == project.project_id
+        if matches and verify_project_yaml(project_dict):
+            entries.append((PLUTUS_CONFIG_TYPE_PROJECT, project_dict))
+
+    if project.parent_id is not None:
+        for parent_dict in budget_dict.get("parent_folders") or []:
+            matches = str(parent_dict.get("parent_folder_id")) == project.parent_id
+            if matches and verify_parent_yaml(parent_dict):
+                entries.append((PLUTUS_CONFIG_TYPE_PARENT, parent_dict))
+
+    for label_dict in budget_dict.get("labels") or []:
+        if not verify_labels_yaml(label_dict):
+            continue
+        if all(
+            project.labels.get(key) == str(value)
+            for row in label_dict["label_list"]
+            for key, value in row.items()
+        ):
+            entries.append((PLUTUS_CONFIG_TYPE_LABEL, label_dict))
+
+    return entries
+
+
+def select_entries(budget_dict, folder_ids=(), labels=None):
+    """
+    Returns a copy of budget_dict with only the parent_folders entries of folder_ids and
+    the labels entries requiring all of labels, and no projects entries.
+    """
+    folder_ids = {str(f) for f in folder_ids}
+    return {
+        "projects": [],
+        "parent_folders": [
+            d
+            for d in budget_dict.get("parent_folders") or []
+            if str(d.get("parent_folder_id")) in folder_ids
+        ],
+        "labels": [
+            d
+            for d in budget_dict.get("labels") or []
+            if labels and verify_labels_yaml(d) and labels_filter_matches(d, labels)
+        ],
+    }
@@ -0,0 +1,428 @@
+"""
+Event driven reconcile from a Cloud Asset Inventory feed of project changes. The feed
+publishes a message to pubsub whenever a project is created, moved, relabelled or deleted,
+and each change is reconciled for that project alone, so a new project gets its budget
+within seconds instead of at the next full run of main.py. Full runs are still needed as a
+safety net, e.g. for changes made while this wasn't running and the feed's retention passed.
+
+For every change the project is matched against the current config, like a full run would:
+
+* projects        the project_id is configured
+* parent_folders  the project's direct parent is the configured folder
+* labels          the project has every configured label, with the same value
+
+and each matching entry's budget is reconciled in that order. A deleted project's plutus
+budgets are deleted, as the defunct budget cleanup of a full run does.
+
+Messages of a change that failed (e.g. a new project not yet searchable) aren't acked, so
+pubsub redelivers them after the ack deadline. Create the feed with:
+
+    gcloud asset feeds create plutus-projects --organization=ORG_ID \\
+        --content-type=resource \\
+        --asset-types=cloudresourcemanager.googleapis.com/Project \\
+        --pubsub-topic=projects/PROJECT/topics/TOPIC
+
+Set PUBSUB_EMULATOR_HOST to pull from the pubsub emulator.
+"""
+
+import click
+
+from collections import namedtuple
+import json
+import logging
+import markus
+import pymysql
+import re
+import signal
+import sys
+import threading
+import time
+
+from plutus.budget_manager.main import (
+    get_labels_filter,
+    load_budget_config,
+    reconcile_label_project_budget,
+    reconcile_parent_project_budget,
+    reconcile_project_budget,
+    setup_metrics,
+)
+from plutus.budget_manager.project_budget import ProjectBudget
+from plutus.budget_manager.targets import matching_entries
+from plutus.lib import clients
+from plutus.lib.constants import (
+    APP,
+    PLUTUS_CONFIG_TYPE_PARENT,
+    PLUTUS_CONFIG_TYPE_PROJECT,
+)
+from plutus.lib.gcp_helper import API_BILLING, GcpHelper
+from plutus.lib.metrics import DEFAULT_TAG_ALLOWLIST, flush_metrics
+from plutus.lib.tracing import tracer, SPAN_PROJECT
+
+log = logging.getLogger(f"{APP}.watch")
+metrics = markus.get_metrics(f"{APP}.watch")
+
+PROJECT_ASSET_TYPE = "cloudresourcemanager.googleapis.com/Project"
+# Seconds a pull waits for messages
+PULL_TIMEOUT = 30
+# Seconds an open circuit breaker fails fast before letting a call through again
+BREAKER_COOLDOWN = 60
+
+CHANGE_CREATED = "created"
+CHANGE_UPDATED = "updated"
+CHANGE_DELETED = "deleted"
+
+# A project as of one feed message. parent_id is the direct parent folder id, if any
+ProjectChange = namedtuple(
+    "ProjectChange",
+    [
+        "project_id",
+        "project_number",
+        "parent_id",
+        "labels",
+        "active",
+        "change",
+        "update_time",
+    ],
+)
+
+
+def _project_fields(asset):
+    """Returns (project_id, project_number, parent_id, labels, active) of a feed asset."""
+    data = asset["resource"]["data"]
+    # v1 resources have a {"type": "folder", "id": ...} parent, v3 a "folders/..." name
+    parent = data.get("parent") or asset["resource"].get("parent", "")
+    if isinstance(parent, dict):
+        parent_id = parent["id"] if parent.get("type") == "folder" else None
+    else:
+        match = re.search(r"folders/(\d+)$", parent)
+        parent_id = match.group(1) if match else None
+    state = data.get("lifecycleState", data.get("state", "ACTIVE"))
+    return (
+        data["projectId"],
+        str(data.get("projectNumber") or asset["name"].rsplit("/", 1)[-1]),
+        parent_id,
+        data.get("labels") or {},
+        state == "ACTIVE",
+    )
+
+
+def parse_change(data):
+    """
+    Returns the ProjectChange in a feed message's json data, or None if it isn't one worth
+    reconciling: not a project, or a change that can't affect which config matches it.
+    Raises KeyError or ValueError for malformed messages.
+    """
+    asset = data["asset"]
+    if asset.get("assetType") != PROJECT_ASSET_TYPE:
+        return None
+
+    update_time = data.get("window", {}).get("startTime", "")
+    prior = data.get("priorAsset")
+    if data.get("deleted"):
+        if prior is None:
+            # Only the number is known, which is what plutus budgets filter on anyway
+            project_id, number = None, asset["name"].rsplit("/", 1)[-1]
+        else:
+            project_id, number = _project_fields(prior)[:2]
+        return ProjectChange(
+            project_id, number, None, {}, False, CHANGE_DELETED, update_time
+        )
+
+    fields = _project_fields(asset)
+    if prior is None or data.get("priorAssetState") != "PRESENT":
+        return ProjectChange(*fields, CHANGE_CREATED, update_time)
+    if _project_fields(prior)[2:] == fields[2:]:
+        # e.g. a name change, the folder, labels and state that config matches on are the same
+        return None
+    return ProjectChange(*fields, CHANGE_UPDATED, update_time)
+
+
+def delete_project_budgets(gcp, billing_account_id, project_number, dry_run):
+    """Deletes the plutus budgets of a deleted project."""
+    list_budgets_result = gcp.call(
+        API_BILLING,
+        "list_budgets",
+        gcp.billing_client.list_budgets,
+        paged=True,
+        parent=f"billingAccounts/{billing_account_id}",
+    )
+    for response in list_budgets_result:
+        projects = list(response.budget_filter.projects)
+        if not response.display_name.startswith("plutus-"):
+            continue
+        if projects != [f"projects/{project_number}"]:
+            continue
+
+        if dry_run:
+            log.info(
+                f"Dry run is set. We would have deleted budget: {response.display_name}"
+            )
+        else:
+            log.info(f"Deleting budget of deleted project: {response.display_name}")
+            gcp.delete_budget(response.name)
+            metrics.incr("deleted_budget_count")
+
+
+class ChangeReconciler:
+    """
+    Reconciles project changes against the budgets config, reloaded by load_config() every
+    config_refresh seconds so config changes are picked up without a restart.
+    """
+
+    def __init__(
+        self,
+        gcp,
+        mysql_conn,
+        load_config,
+        billing_account_id,
+        default_pubsub_topic,
+        dry_run=False,
+        config_refresh=300,
+    ):
+        self.gcp = gcp
+        self.mysql_conn = mysql_conn
+        self.load_config = load_config
+        self.billing_account_id = billing_account_id
+        self.default_pubsub_topic = default_pubsub_topic
+        self.dry_run = dry_run
+        self.config_refresh = config_refresh
+        self.budget_dict = None
+        self.loaded = 0
+
+    def config(self):
+        if self.budget_dict is None or (
+            time.monotonic() - self.loaded >= self.config_refresh
+        ):
+            try:
+                self.budget_dict = self.load_config()
+                self.loaded = time.monotonic()
+            except Exception as err:
+                if self.budget_dict is None:
+                    raise
+                log.error(f"Error reloading config, keeping the previous one: {err}")
+                metrics.incr("error_count", tags=["type:config_reload"])
+        return self.budget_dict
+
+    def reconcile(self, change):
+        """Reconciles the budgets of change's project. Raises if any of them failed."""
+        metrics.incr("change_count", tags=[f"type:{change.change}"])
+        if change.change == CHANGE_DELETED:
+            delete_project_budgets(
+                self.gcp, self.billing_account_id, change.project_number, self.dry_run
+            )
+            return
+
+        if not change.active:
+            log.info(f"Skipping project {change.project_id}, it is being deleted")
+            return
+
+        entries = matching_entries(self.config(), change)
+        if not entries:
+            log.info(f"No budget configured for project {change.project_id}")
+            return
+
+        for config_type, entry in entries:
+            project = ProjectBudget(
+                dict(entry, project_id=change.project_id),
+                config_type,
+                self.billing_account_id,
+                self.default_pubsub_topic,
+            )
+            if config_type == PLUTUS_CONFIG_TYPE_PROJECT:
+                reconcile_project_budget(
+                    self.gcp, self.mysql_conn, project, self.dry_run
+                )
+            elif config_type == PLUTUS_CONFIG_TYPE_PARENT:
+                reconcile_parent_project_budget(
+                    self.gcp, self.mysql_conn, project, self.dry_run
+                )
+            else:
+                reconcile_label_project_budget(
+                    self.gcp,
+                    self.mysql_conn,
+                    project,
+                    get_labels_filter(entry),
+                    self.dry_run,
+                )
+
+    def handle(self, received):
+        """
+        Reconciles the changes in pulled messages, one reconcile per project. Returns the
+        ack ids to ack: the messages of changes that were reconciled, or that are malformed
+        or irrelevant and would be again if redelivered.
+        """
+        metrics.incr("message_count", len(received))
+        ack_ids = []
+        # project number -> (latest change, its messages' ack ids)
+        changes = {}
+        for received_message in received:
+            message = received_message.message
+            try:
+                change = parse_change(json.loads(message.data))
+            except (KeyError, TypeError, ValueError) as err:
+                log.error(f"Dropping malformed message {message.message_id}: {err}")
+                metrics.incr("error_count", tags=["type:malformed_message"])
+                ack_ids.append(received_message.ack_id)
+                continue
+
+            if change is None:
+                metrics.incr("change_count", tags=["type:skipped"])
+                ack_ids.append(received_message.ack_id)
+                continue
+
+            latest, change_ack_ids = changes.get(change.project_number, (None, []))
+            if latest is None or change.update_time >= latest.update_time:
+                latest = change
+            changes[change.project_number] = (latest, change_ack_ids)
+            change_ack_ids.append(received_message.ack_id)
+
+        for change, change_ack_ids in changes.values():
+            with tracer.span(
+                SPAN_PROJECT, project_id=change.project_id, change=change.change
+            ) as span:
+                try:
+                    self.reconcile(change)
+                except Exception as err:
+                    span.status = "error"
+                    span.set_attribute("error", str(err))
+                    log.error(
+                        f"Error reconciling {change.change} project "
+                        f"{change.project_id or change.project_number}: {err}"
+                    )
+                    metrics.incr("error_count", tags=["type:change_reconcile"])
+                    continue
+            ack_ids.extend(change_ack_ids)
+
+        return ack_ids
+
+
+def run(client, subscription, reconciler, max_messages=10, stop=None):
+    """Pulls and reconciles project changes until stop is set."""
+    stop = stop or threading.Event()
+    log.info(f"Pulling project changes from {subscription}")
+    while not stop.is_set():
+        try:
+            response = client.pull(
+                request={"subscription": subscription, "max_messages": max_messages},
+                timeout=PULL_TIMEOUT,
+            )
+        except Exception as err:
+            # Includes deadline exceeded on an idle subscription
+            log.info(f"Pull failed: {err}")
+            stop.wait(1)
+            continue
+
+        if not response.received_messages:
+            continue
+
+        reconciler.mysql_conn.ping(reconnect=True)
+        ack_ids = reconciler.handle(response.received_messages)
+        if ack_ids:
+            client.acknowledge(
+                request={"subscription": subscription, "ack_ids": ack_ids}
+            )
+        clients.report_channel_stats()
+
+
+@click.command()
+@click.option("--subscription", envvar="FEED_SUBSCRIPTION", required=True)
+@click.option("--gcs-bucket", envvar="GCS_BUCKET", default=None)  # Without the gs://
+@click.option("--gcs-file-path", envvar="GCS_FILE_PATH", default=None)
+@click.option("--billing-account-id", envvar="BILLING_ACCOUNT_ID", default=None)
+@click.option(
+    "--default-pubsub-topic",
+    default="projects/moz-fx-data-dataops/topics/plutus-budget-notifications",
+)
+@click.option("--mysql-host", envvar="MYSQL_HOST", default="localhost")
+@click.option("--mysql-port", envvar="MYSQL_PORT", default="3306")
+@click.option("--mysql-user", envvar="MYSQL_USER", default="root")
+@click.option("--mysql-pass", envvar="MYSQL_PASS", default="secret")
+@click.option("--mysql-db", envvar="MYSQL_DB", default="plutus")
+@click.option(
+    "--statsd-host",
+    envvar="STATSD_HOST",
+    default="prod-statsd-telegraf.influx.svc.cluster.local",
+)
+@click.option(
+    "--metrics-tag-allowlist",
+    envvar="METRICS_TAG_ALLOWLIST",
+    default=",".join(DEFAULT_TAG_ALLOWLIST),
+)
+@click.option("--local-mode", is_flag=True, default=False)
+@click.option("--dry-run", is_flag=True, default=False)
+# Max messages per pull. Each project change takes a few API calls to reconcile, so keep
+# a batch well within the subscription's ack deadline
+@click.option("--max-messages", envvar="FEED_MAX_MESSAGES", default=10)
+# Seconds between config reloads
+@click.option("--config-refresh", envvar="CONFIG_REFRESH", default=300)
+def main(
+    subscription,
+    gcs_bucket,
+    gcs_file_path,
+    billing_account_id,
+    default_pubsub_topic,
+    mysql_host,
+    mysql_port,
+    mysql_user,
+    mysql_pass,
+    mysql_db,
+    statsd_host,
+    metrics_tag_allowlist,
+    local_mode,
+    dry_run,
+    max_messages,
+    config_refresh,
+):
+    """Reconciles the budgets of projects as they change, from a Cloud Asset feed."""
+    logformat = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO, format=logformat)
+    logging.getLogger("datadog.dogstatsd").setLevel(logging.ERROR)
+
+    # Long running, so metrics are flushed in the background rather than once per run
+    setup_metrics(
+        "localhost" if local_mode else statsd_host,
+        [t for t in metrics_tag_allowlist.split(",") if t],
+        flush_interval=60,
+    )
+
+    from google.cloud import pubsub_v1
+
+    gcp = GcpHelper(
+        clients.billing_client(),
+        clients.projects_client(),
+        breaker_cooldown=BREAKER_COOLDOWN,
+    )
+    mysql_conn = pymysql.connect(
+        host=mysql_host,
+        port=int(mysql_port),
+        user=mysql_user,
+        password=mysql_pass,
+        database=mysql_db,
+        autocommit=True,
+    )
+    reconciler = ChangeReconciler(
+        gcp,
+        mysql_conn,
+        lambda: load_budget_config(local_mode, gcs_bucket, gcs_file_path),
+        billing_account_id,
+        default_pubsub_topic,
+        dry_run=dry_run,
+        config_refresh=config_refresh,
+    )
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+
+    client = pubsub_v1.SubscriberClient()
+    try:
+        run(client, subscription, reconciler, max_messages=max_messages, stop=stop)
+    finally:
+        client.close()
+        mysql_conn.close()
+        tracer.shutdown()
+        flush_metrics()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+Cold start benchmark for the budget monitor. Each run starts a fresh interpreter, imports
+main.py and handles one routine spend notification (no threshold exceeded), the way a new
+cloud function instance would. Reports import and first notification times, which heavy
+modules got loaded, and for reference what importing those heavy modules costs. The
+notification is handled again with SPEND_HISTORY on, against a local mysql whose statements
+each take about MYSQL_LATENCY seconds, to report what recording spend history costs.
+
+Run with: python bench_cold_start.py [runs]
+"""
+
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+HEAVY_MODULES = ["boto3", "pymysql", "pypd", "slack"]
+
+MYSQL_LATENCY = 0.005
+
+# main.py reads these at import
+ENV = {
+    "OAUTH_TOKEN": "bench",
+    "CHANNEL_ID": "bench",
+    "MYSQL_HOST": "bench",
+    "MYSQL_USER": "bench",
+    "MYSQL_PASS": "bench",
+    "MYSQL_DB": "bench",
+    "SMTP_EMAIL": "bench",
+    "AWS_ACCESS_KEY_ID": "bench",
+    "AWS_SECRET_ACCESS_KEY": "bench",
+    "PAGERDUTY_KEY": "bench",
+}
+
+COLD_START = """
+import base64, json, sys, time
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+data = {
+    "attributes": {"billingAccountId": "bench", "budgetId": "bench"},
+    "data": base64.b64encode(json.dumps({
+        "budgetDisplayName": "plutus-bench",
+        "costAmount": 1.0,
+        "budgetAmount": 100.0,
+    }).encode()),
+}
+main.process_pubsub(data, None)
+handled = time.perf_counter()
+print(json.dumps({
+    "import_ms": (imported - started) * 1000,
+    "notify_ms": (handled - imported) * 1000,
+    "heavy_loaded": [m for m in %(heavy)r if m in sys.modules],
+}))
+"""
+
+SPEND_HISTORY_START = """
+import base64, json, os, time
+os.environ["SPEND_HISTORY"] = "1"
+import main
+from local_mysql import LocalMySQL
+from loadtest import Faults
+
+db = LocalMySQL(Faults(latency=%(latency)r))
+class LocalPool(main.ConnectionPool):
+    def _connect(self):
+        return db.connect()
+main.mysql_pool = LocalPool(1, 60)
+
+data = {
+    "attributes": {"billingAccountId": "bench", "budgetId": "bench"},
+    "data": base64.b64encode(json.dumps({
+        "budgetDisplayName": "plutus-bench",
+        "costAmount": 1.0,
+        "budgetAmount": 100.0,
+    }).encode()),
+}
+context = type("Context", (), {"event_id": "bench-message"})
+started = time.perf_counter()
+main.process_pubsub(data, context)
+handled = time.perf_counter()
+round_trips = sum(db.round_trips.values())
+# A redelivery, which the warm instance drops without a query
+main.process_pubsub(data, context)
+print(json.dumps({
+    "notify_ms": (handled - started) * 1000,
+    "round_trips": round_trips,
+    "redelivery_round_trips": sum(db.round_trips.values()) - round_trips,
+    "history_rows": len(db.spend_history),
+}))
+"""
+
+HEAVY_IMPORT = """
+import importlib, json, time
+started = time.perf_counter()
+for name in %(heavy)r:
+    try:
+        importlib.import_module(name)
+    except ImportError:
+        pass
+print(json.dumps({"heavy_import_ms": (time.perf_counter() - started) * 1000}))
+"""
+
+
+def run_child(code):
+    here = os.path.dirname(os.path.abspath(__file__))
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            code % {"heavy": HEAVY_MODULES, "latency": MYSQL_LATENCY},
+        ],
+        cwd=here,
+        env=dict(os.environ, **ENV),
+        stdout=subprocess.PIPE,
+        check=True,
+        universal_newlines=True,
+    )
+    # The last line is ours, anything before it is the monitor's own logging
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def summarize(name, values):
+    print(
+        f"{name:>28}: median {statistics.median(values):7.1f} ms, "
+        f"max {max(values):7.1f} ms"
+    )
+
+
+def main(runs):
+    results = [run_child(COLD_START) for _ in range(runs)]
+    history = [run_child(SPEND_HISTORY_START) for _ in range(runs)]
+    heavy = [run_child(HEAVY_IMPORT) for _ in range(runs)]
+
+    print(f"{runs} cold starts")
+    summarize("import main", [r["import_ms"] for r in results])
+    summarize("first routine notification", [r["notify_ms"] for r in results])
+    summarize("with spend history", [r["notify_ms"] for r in history])
+    print(
+        f"{'spend history mysql queries':>28}: {history[0]['round_trips']}, "
+        f"{history[0]['redelivery_round_trips']} for a redelivery "
+        f"({MYSQL_LATENCY * 1000:.0f} ms each)"
+    )
+    summarize("(import heavy modules)", [r["heavy_import_ms"] for r in heavy])
+    loaded = sorted({m for r in results for m in r["heavy_loaded"]})
+    print(f"{'heavy modules loaded':>28}: {', '.join(loaded) or 'none'}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10)
@@ -0,0 +1,555 @@
+"""
+Replay and load test harness for the budget monitor. Replays recorded or synthetic budget
+notifications into process_pubsub (--mode function) or the batch subscriber (--mode batch)
+at a given rate and concurrency. Slack, ses, pagerduty and mysql are replaced by in process
+stand-ins with configurable latency and error rates, so a run needs no credentials and
+sends nothing.
+
+Reports throughput, p50/p99 latency per stage, mysql round trips per message and duplicate
+alerts, i.e. a budget alerted more than once on a channel that should alert it once.
+
+Synthetic runs model a month start burst: every budget's cost climbs through its
+notifications, and --alert-fraction of the budgets cross the 50/90/100% thresholds.
+Failed messages are redelivered, and --duplicate-rate of the messages are delivered twice,
+as pubsub may.
+
+Run with e.g.: python loadtest.py --messages 5000 --budgets 500 --rate 200 --concurrency 8
+--record burst.jsonl saves the notifications (one pubsub message per line: messageId,
+attributes and base64 data, as in a push envelope), and --replay burst.jsonl replays them.
+"""
+
+import argparse
+import base64
+import collections
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from types import SimpleNamespace
+
+from bench_cold_start import ENV
+
+BILLING_ACCOUNT_ID = "LOADTEST-000000-000000"
+DEFAULT_CHANNEL_ID = "loadtest-default"
+THRESHOLDS = [0.5, 0.9, 1.0]
+
+BUDGET_ID = re.compile(r"budget_id: ([^,\s]+),")
+THRESHOLD = re.compile(r"alert_threshold_exceeded: ([\d.]+)")
+
+
+class Faults:
+    """Latency and errors injected into each call to a stand-in."""
+
+    def __init__(self, latency=0.0, error_rate=0.0, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.random = random.Random(seed)
+
+    def inject(self, error):
+        """Sleeps for about latency seconds, then raises error() error_rate of the time."""
+        with self.lock:
+            jitter = self.random.uniform(0.5, 1.5)
+            fail = self.random.random() < self.error_rate
+        if self.latency:
+            time.sleep(self.latency * jitter)
+        if fail:
+            raise error()
+
+
+class LocalSlack:
+    """Stand-in for the slack WebClient."""
+
+    def __init__(self, faults):
+        self.faults = faults
+        self.lock = threading.Lock()
+        self.posted = []
+
+    def chat_postMessage(self, channel, text):
+        from slack.errors import SlackApiError
+
+        self.faults.inject(
+            lambda: SlackApiError(
+                "injected error", SimpleNamespace(status_code=500, headers={})
+            )
+        )
+        with self.lock:
+            self.posted.append((channel, text))
+
+
+class LocalPagerDuty:
+    """Stand-in for pypd.EventV2."""
+
+    def __init__(self, faults):
+        self.faults = faults
+        self.lock = threading.Lock()
+        self.events = []
+
+    def create(self, data):
+        self.faults.inject(lambda: RuntimeError("pagerduty: injected error"))
+        with self.lock:
+            self.events.append(data)
+
+
+def faulty_ses(faults):
+    from botocore.exceptions import ClientError
+    from local_ses import LocalSES
+
+    class FaultySES(LocalSES):
+        def _call(self, api):
+            faults.inject(
+                lambda: ClientError(
+                    {"Error": {"Code": "Throttling", "Message": "injected error"}}, api
+                )
+            )
+            super()._call(api)
+
+    return FaultySES()
+
+
+class Samples:
+    """Monitor metrics for the whole run, fed by metrics.sink, and the harness' own."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = collections.Counter()
+        self.timings = collections.defaultdict(list)
+
+    def sink(self, counters, timings):
+        with self.lock:
+            self.counters.update(counters)
+            for name, values in timings.items():
+                self.timings[name].extend(values)
+
+    def timing(self, name, ms):
+        with self.lock:
+            self.timings[name].append(ms)
+
+    def incr(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def synthetic(messages, budgets, alert_fraction, seed):
+    """Returns month start burst notifications as pubsub messages."""
+    rng = random.Random(seed)
+    month_start = datetime.utcnow().strftime("%Y-%m-01T00:00:00Z")
+    amounts = [rng.choice([100.0, 500.0, 1000.0, 5000.0]) for _ in range(budgets)]
+    peaks = [
+        (
+            rng.uniform(1.0, 1.5)
+            if rng.random() < alert_fraction
+            else rng.uniform(0.05, 0.45)
+        )
+        for _ in range(budgets)
+    ]
+    order = [rng.randrange(budgets) for _ in range(messages)]
+    totals = collections.Counter(order)
+    seen = collections.Counter()
+
+    result = []
+    for i, budget in enumerate(order):
+        seen[budget] += 1
+        ratio = peaks[budget] * seen[budget] / totals[budget]
+        data = {
+            "budgetDisplayName": f"plutus-project-{budget}",
+            "costAmount": round(amounts[budget] * ratio, 2),
+            "budgetAmount": amounts[budget],
+            "costIntervalStart": month_start,
+            "currencyCode": "USD",
+        }
+        exceeded = [t for t in THRESHOLDS if t <= ratio]
+        if exceeded:
+            data["alertThresholdExceeded"] = exceeded[-1]
+        result.append(
+            {
+                "messageId": f"loadtest-{i}",
+                "attributes": {
+                    "billingAccountId": BILLING_ACCOUNT_ID,
+                    "budgetId": f"budget-{budget}",
+                },
+                "data": base64.b64encode(json.dumps(data).encode()).decode(),
+            }
+        )
+    return result
+
+
+def load_replay(path):
+    with open(path) as f:
+        lines = [json.loads(line) for line in f if line.strip()]
+    # Accept whole push envelopes too
+    return [line.get("message", line) for line in lines]
+
+
+def with_duplicates(messages, duplicate_rate, seed):
+    """Delivers duplicate_rate of the messages a second time, somewhat later."""
+    rng = random.Random(seed)
+    deliveries = list(messages)
+    for i, message in enumerate(messages):
+        if rng.random() < duplicate_rate:
+            deliveries.insert(rng.randint(i + 1, len(deliveries)), message)
+    return deliveries
+
+
+def seed_budgets(db, messages, seed):
+    """Adds every budget in messages to the budgets table, routed like production ones."""
+    rng = random.Random(seed)
+    budget_ids = sorted({m["attributes"]["budgetId"] for m in messages})
+    for i, budget_id in enumerate(budget_ids):
+        full_budget_id = (
+            f"billingAccounts/{messages[0]['attributes']['billingAccountId']}"
+            f"/budgets/{budget_id}"
+        )
+        # A few budgets are missing from the db, which alerts the default channel about it
+        if rng.random() < 0.05:
+            continue
+        db.add_budget(
+            full_budget_id,
+            f"owner-{i}@example.com",
+            f"C{i:06d}" if rng.random() < 0.25 else "None",
+            f"project-{i}",
+        )
+
+
+def paced(deliveries, rate):
+    """Yields (message, due time) at rate messages per second, 0 for no pacing."""
+    started = time.perf_counter()
+    for i, message in enumerate(deliveries):
+        due = started + i / rate if rate else time.perf_counter()
+        wait = due - time.perf_counter()
+        if wait > 0:
+            time.sleep(wait)
+        yield message, due
+
+
+def run_function(main, deliveries, args, samples):
+    """Each message is a process_pubsub call on one of --concurrency threads."""
+
+    def deliver(message, due):
+        data = {"attributes": message["attributes"], "data": message["data"]}
+        context = SimpleNamespace(event_id=message.get("messageId"))
+        for attempt in range(args.max_attempts):
+            started = time.perf_counter()
+            try:
+                main.process_pubsub(data, context)
+                return
+            except Exception:
+                samples.incr("redeliveries")
+            finally:
+                samples.timing("process_pubsub", (time.perf_counter() - started) * 1000)
+                if attempt == 0:
+                    samples.timing("queue_wait", (started - due) * 1000)
+        samples.incr("given_up")
+
+    def deliver_timed(message, due):
+        try:
+            deliver(message, due)
+        finally:
+            samples.timing("notify", (time.perf_counter() - due) * 1000)
+
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        for message, due in paced(deliveries, args.rate):
+            pool.submit(deliver_timed, message, due)
+
+
+def run_batch(main, deliveries, args, samples):
+    """Messages are pulled in batches by --concurrency subscriber.run threads."""
+    import subscriber
+    from local_pubsub import LocalSubscriber
+
+    class TimedSubscriber(LocalSubscriber):
+        """Records publish to ack latency, and redelivers after an ack deadline."""
+
+        def __init__(self):
+            super().__init__()
+            self.published = {}
+            self.pulled = {}
+
+        def publish_at(self, message, due):
+            message_id = self.publish(
+                base64.b64decode(message["data"]),
+                message_id=message["messageId"],
+                **message["attributes"],
+            )
+            with self.lock:
+                self.published.setdefault(message_id, []).append(due)
+
+        def pull(self, request, timeout=None):
+            response = super().pull(request, timeout)
+            now = time.perf_counter()
+            with self.lock:
+                for received in response.received_messages:
+                    self.pulled[received.ack_id] = now
+            return response
+
+        def acknowledge(self, request):
+            super().acknowledge(request)
+            now = time.perf_counter()
+            with self.lock:
+                for ack_id in request["ack_ids"]:
+                    self.pulled.pop(ack_id, None)
+                first_acked = len(self.acked) - len(request["ack_ids"])
+                for message in self.acked[first_acked:]:
+                    due = self.published[message.message_id].pop(0)
+                    samples.timing("notify", (now - due) * 1000)
+
+        def redeliver_expired(self, deadline):
+            now = time.perf_counter()
+            with self.lock:
+                expired = [a for a, t in self.pulled.items() if now - t > deadline]
+                for ack_id in expired:
+                    del self.pulled[ack_id]
+                    self.queue.append(self.unacked.pop(ack_id))
+            samples.incr("redeliveries", len(expired))
+
+    client = TimedSubscriber()
+    stop = threading.Event()
+    threads = [
+        threading.Thread(
+            target=subscriber.run,
+            args=(client, "loadtest"),
+            kwargs={"max_messages": args.batch_size, "stop": stop},
+        )
+        for _ in range(args.concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+
+    for message, due in paced(deliveries, args.rate):
+        client.publish_at(message, due)
+
+    # Wait for every delivery to be acked, giving up on messages that keep failing
+    acked, progressed = 0, time.perf_counter()
+    while len(client.acked) < len(deliveries):
+        time.sleep(0.05)
+        client.redeliver_expired(args.ack_deadline)
+        if len(client.acked) > acked:
+            acked, progressed = len(client.acked), time.perf_counter()
+        elif time.perf_counter() - progressed > args.max_attempts * args.ack_deadline:
+            samples.incr("given_up", len(deliveries) - len(client.acked))
+            break
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+
+def duplicates(keys):
+    return sum(count - 1 for count in collections.Counter(keys).values())
+
+
+def report(args, deliveries, elapsed, samples, db, slack, ses, pagerduty, channel_id):
+    slack_alerts = [
+        BUDGET_ID.search(text).group(1)
+        for channel, text in slack.posted
+        if channel == channel_id
+        and not text.startswith("Plutus")
+        and BUDGET_ID.search(text)
+    ]
+    email_alerts = [
+        BUDGET_ID.search(email["body"]).group(1)
+        for email in ses.sent
+        if BUDGET_ID.search(email["body"])
+    ]
+    pagerduty_alerts = [
+        (
+            event["dedup_key"],
+            THRESHOLD.search(event["payload"]["summary"]).group(1),
+        )
+        for event in pagerduty.events
+    ]
+    stages = {
+        name: {
+            "count": len(values),
+            "p50_ms": percentile(values, 50),
+            "p99_ms": percentile(values, 99),
+            "max_ms": max(values),
+        }
+        for name, values in sorted(samples.timings.items())
+        if values
+    }
+    mysql = [ms for values in db.timings.values() for ms in values]
+    if mysql:
+        stages["mysql"] = {
+            "count": len(mysql),
+            "p50_ms": percentile(mysql, 50),
+            "p99_ms": percentile(mysql, 99),
+            "max_ms": max(mysql),
+        }
+    round_trips = sum(db.round_trips.values())
+    return {
+        "mode": args.mode,
+        "deliveries": len(deliveries),
+        "messages": len({m["messageId"] for m in deliveries}),
+        "elapsed_s": elapsed,
+        "throughput_per_s": len(deliveries) / elapsed,
+        "redeliveries": samples.counters["redeliveries"],
+        "given_up": samples.counters["given_up"],
+        "stages": stages,
+        "mysql_round_trips": round_trips,
+        "mysql_round_trips_per_message": round_trips / len(deliveries),
+        "mysql_round_trips_by_kind": dict(db.round_trips.most_common()),
+        "spend_history_rows": len(db.spend_history),
+        "alerts": {
+            "slack": len(slack_alerts),
+            "email": len(email_alerts),
+            "pagerduty": len(pagerduty_alerts),
+        },
+        "duplicate_alerts": {
+            "slack": duplicates(slack_alerts),
+            "email": duplicates(email_alerts),
+            "pagerduty": duplicates(pagerduty_alerts),
+        },
+        "monitor_counters": dict(sorted(samples.counters.items())),
+    }
+
+
+def print_report(result):
+    print(
+        f"{result['mode']} mode: {result['deliveries']} deliveries of "
+        f"{result['messages']} messages in {result['elapsed_s']:.1f} s, "
+        f"{result['throughput_per_s']:.1f}/s, {result['redeliveries']} redeliveries, "
+        f"{result['given_up']} given up"
+    )
+    print(f"\n{'stage':>24} {'count':>8} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for name, stage in result["stages"].items():
+        print(
+            f"{name:>24} {stage['count']:>8} {stage['p50_ms']:>9.1f} "
+            f"{stage['p99_ms']:>9.1f} {stage['max_ms']:>9.1f}"
+        )
+    print(
+        f"\nmysql round trips: {result['mysql_round_trips']}, "
+        f"{result['mysql_round_trips_per_message']:.2f} per delivery"
+    )
+    for kind, count in result["mysql_round_trips_by_kind"].items():
+        print(f"{kind:>24} {count:>8}")
+    print()
+    for channel, count in result["alerts"].items():
+        print(
+            f"{channel + ' alerts':>24} {count:>8}, "
+            f"{result['duplicate_alerts'][channel]} duplicate"
+        )
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().splitlines()[0],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    source = parser.add_argument_group("notifications")
+    source.add_argument("--replay", help="json lines file of pubsub messages to replay")
+    source.add_argument("--record", help="write the notifications to this file")
+    source.add_argument("--messages", type=int, default=2000)
+    source.add_argument("--budgets", type=int, default=200)
+    source.add_argument("--alert-fraction", type=float, default=0.3)
+    source.add_argument("--duplicate-rate", type=float, default=0.02)
+    source.add_argument("--seed", type=int, default=1)
+
+    run = parser.add_argument_group("run")
+    run.add_argument("--mode", choices=["function", "batch"], default="function")
+    run.add_argument("--rate", type=float, default=0, help="deliveries/s, 0 unpaced")
+    run.add_argument("--concurrency", type=int, default=8)
+    run.add_argument("--batch-size", type=int, default=100)
+    run.add_argument("--max-attempts", type=int, default=5)
+    run.add_argument("--ack-deadline", type=float, default=10)
+    run.add_argument("--spend-history", action="store_true")
+    run.add_argument("--json", help="also write the report as json to this file")
+
+    standins = parser.add_argument_group("stand-ins, latency in seconds")
+    for name, latency in [
+        ("mysql", 0.002),
+        ("slack", 0.1),
+        ("ses", 0.08),
+        ("pagerduty", 0.15),
+    ]:
+        standins.add_argument(f"--{name}-latency", type=float, default=latency)
+        standins.add_argument(f"--{name}-error-rate", type=float, default=0.0)
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+
+    # main.py reads its configuration at import
+    for name, value in dict(
+        ENV,
+        CHANNEL_ID=DEFAULT_CHANNEL_ID,
+        MYSQL_POOL_SIZE=str(args.concurrency),
+        DELIVERY_WORKERS=str(args.concurrency * 4),
+        SPEND_HISTORY="1" if args.spend_history else "0",
+    ).items():
+        os.environ.setdefault(name, value)
+    import main as monitor
+    from local_mysql import LocalMySQL
+
+    if args.replay:
+        messages = load_replay(args.replay)
+    else:
+        messages = synthetic(
+            args.messages, args.budgets, args.alert_fraction, args.seed
+        )
+    if args.record:
+        with open(args.record, "w") as f:
+            for message in messages:
+                f.write(json.dumps(message) + "\n")
+    deliveries = with_duplicates(messages, args.duplicate_rate, args.seed)
+
+    db = LocalMySQL(Faults(args.mysql_latency, args.mysql_error_rate, args.seed))
+    seed_budgets(db, messages, args.seed)
+    slack = LocalSlack(Faults(args.slack_latency, args.slack_error_rate, args.seed))
+    ses = faulty_ses(Faults(args.ses_latency, args.ses_error_rate, args.seed))
+    pagerduty = LocalPagerDuty(
+        Faults(args.pagerduty_latency, args.pagerduty_error_rate, args.seed)
+    )
+
+    class LocalPool(monitor.ConnectionPool):
+        def _connect(self):
+            monitor.metrics.incr("mysql_connect_count")
+            return db.connect()
+
+    monitor.mysql_pool = LocalPool(monitor.MYSQL_POOL_SIZE, monitor.MYSQL_PING_AFTER)
+    monitor.slack_client = slack
+    monitor.ses_client = ses
+    monitor.pagerduty_events = pagerduty
+    samples = Samples()
+    monitor.metrics.sink = samples.sink
+
+    started = time.perf_counter()
+    if args.mode == "function":
+        run_function(monitor, deliveries, args, samples)
+    else:
+        run_batch(monitor, deliveries, args, samples)
+    elapsed = time.perf_counter() - started
+    monitor.spend_history.flush()
+    monitor.metrics.flush()
+
+    result = report(
+        args,
+        deliveries,
+        elapsed,
+        samples,
+        db,
+        slack,
+        ses,
+        pagerduty,
+        monitor.DEFAULT_CHANNEL_ID,
+    )
+    print_report(result)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+    return result
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
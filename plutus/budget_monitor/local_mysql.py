@@ -0,0 +1,328 @@
+import collections
+import re
+import threading
+import time
+
+import pymysql
+
+
+def lost_connection():
+    return pymysql.err.OperationalError(
+        2013, "Lost connection to MySQL server (injected)"
+    )
+
+
+class LocalMySQL:
+    """
+    In memory stand-in for the budget monitor's mysql database, for local runs and load
+    tests. Understands exactly the statements main.py issues, and counts each round trip
+    (statement, begin, commit, rollback) by kind.
+
+    Statements take one database wide lock, and a transaction holds it from begin() to
+    commit(), so concurrent claims serialize like they do on the real row locks. When
+    given, faults.inject(error) is called before every statement, to add latency or raise.
+    """
+
+    def __init__(self, faults=None):
+        self.faults = faults
+        self.lock = threading.RLock()
+        self.budgets = {}
+        self.alerts = {}
+        self.incidents = {}
+        self.processed_messages = {}
+        self.spend_history = []
+        # budget_id -> (projected_cost, budget_amount, cost_amount, burn_rate,
+        # baseline_rate, anomaly, alerted)
+        self.spend_forecasts = {}
+        self.stats_lock = threading.Lock()
+        self.round_trips = collections.Counter()
+        # kind -> statement durations in ms, including lock waits and injected latency
+        self.timings = collections.defaultdict(list)
+
+    def add_budget(self, budget_id, emails, slack_channel, project_id):
+        self.budgets[budget_id] = (emails, slack_channel, project_id)
+
+    def add_forecast(self, budget_id, *forecast, anomaly=False):
+        self.spend_forecasts[budget_id] = tuple(forecast) + (anomaly, None)
+
+    def connect(self, **kwargs):
+        return LocalConnection(self)
+
+    def _record(self, kind, started):
+        with self.stats_lock:
+            self.round_trips[kind] += 1
+            self.timings[kind].append((time.perf_counter() - started) * 1000)
+
+    def _tables(self):
+        return {
+            "alerts": self.alerts,
+            "incidents": self.incidents,
+            "processed_messages": self.processed_messages,
+            "spend_forecasts": self.spend_forecasts,
+        }
+
+    def snapshot(self):
+        return {name: dict(table) for name, table in self._tables().items()}, len(
+            self.spend_history
+        )
+
+    def restore(self, snapshot):
+        tables, history = snapshot
+        for name, table in self._tables().items():
+            table.clear()
+            table.update(tables[name])
+        del self.spend_history[history:]
+
+    def run(self, sql, args, many):
+        """Executes a statement. Returns (rowcount, rows)."""
+        for kind, pattern, handler in STATEMENTS:
+            if pattern.search(sql):
+                started = time.perf_counter()
+                try:
+                    if self.faults is not None:
+                        self.faults.inject(lost_connection)
+                    with self.lock:
+                        if many:
+                            results = [handler(self, tuple(a)) for a in args]
+                            return sum(r[0] for r in results), []
+                        return handler(self, tuple(args or ()))
+                finally:
+                    self._record(kind, started)
+        raise pymysql.err.ProgrammingError(1064, f"LocalMySQL can't run: {sql[:80]}")
+
+    # Statement handlers, each takes the statement's args and returns (rowcount, rows)
+
+    def _routing(self, budget_id):
+        return self.budgets.get(budget_id, (None, None, None))
+
+    def claim_alert(self, args):
+        budget_id, now, cutoff = args
+        last_alert = self.alerts.get(budget_id)
+        claimed = last_alert is None or last_alert < cutoff
+        if claimed:
+            self.alerts[budget_id] = now
+        row = (int(claimed), self.alerts[budget_id]) + self._routing(budget_id)
+        return 1, [row]
+
+    def insert_ignore_alert(self, args):
+        budget_id, last_alert = args
+        inserted = budget_id not in self.alerts
+        self.alerts.setdefault(budget_id, last_alert)
+        return int(inserted), []
+
+    def select_alerts(self, args):
+        rows = [(b, self.alerts[b]) for b in sorted(args) if b in self.alerts]
+        return len(rows), rows
+
+    def update_alerts(self, args):
+        now, budget_ids = args[0], args[1:]
+        for budget_id in budget_ids:
+            self.alerts[budget_id] = now
+        return len(budget_ids), []
+
+    def select_routing(self, args):
+        rows = [(b,) + self._routing(b) for b in args if b in self.budgets]
+        return len(rows), rows
+
+    def insert_ignore_incident(self, args):
+        budget_id, period_start, threshold, triggered = args
+        inserted = budget_id not in self.incidents
+        self.incidents.setdefault(budget_id, (period_start, threshold, triggered))
+        return int(inserted), []
+
+    def select_incidents(self, args):
+        rows = [(b,) + self.incidents[b] for b in sorted(args) if b in self.incidents]
+        return len(rows), rows
+
+    def release_incident(self, args):
+        period_start, threshold, triggered, budget_id, claimed_start, claimed = args
+        if self.incidents.get(budget_id, (None, None))[:2] != (claimed_start, claimed):
+            return 0, []
+        self.incidents[budget_id] = (period_start, threshold, triggered)
+        return 1, []
+
+    def upsert_incident(self, args):
+        budget_id, period_start, threshold, triggered = args
+        self.incidents[budget_id] = (period_start, threshold, triggered)
+        return 2, []
+
+    def select_processed(self, args):
+        rows = [(m,) for m in args if m in self.processed_messages]
+        return len(rows), rows
+
+    def insert_processed(self, args):
+        message_id, processed = args
+        inserted = message_id not in self.processed_messages
+        self.processed_messages.setdefault(message_id, processed)
+        return int(inserted), []
+
+    def delete_processed(self, args):
+        before, limit = args
+        expired = [m for m, t in self.processed_messages.items() if t < before][:limit]
+        for message_id in expired:
+            del self.processed_messages[message_id]
+        return len(expired), []
+
+    def insert_spend_history(self, args):
+        self.spend_history.append(args)
+        return 1, []
+
+    def select_forecasts(self, args):
+        (limit,) = args
+        rows = [
+            (b,) + forecast[:6] + self._routing(b)
+            for b, forecast in sorted(self.spend_forecasts.items())
+            if forecast[6] is None and (forecast[5] or forecast[0] > forecast[1])
+        ][:limit]
+        return len(rows), rows
+
+    def claim_forecast(self, args):
+        alerted, budget_id = args
+        forecast = self.spend_forecasts.get(budget_id)
+        if forecast is None or forecast[6] is not None:
+            return 0, []
+        self.spend_forecasts[budget_id] = forecast[:6] + (alerted,)
+        return 1, []
+
+    def release_forecast(self, args):
+        budget_id, alerted = args
+        forecast = self.spend_forecasts.get(budget_id)
+        if forecast is None or forecast[6] != alerted:
+            return 0, []
+        self.spend_forecasts[budget_id] = forecast[:6] + (None,)
+        return 1, []
+
+
+STATEMENTS = [
+    (kind, re.compile(pattern), handler)
+    for kind, pattern, handler in [
+        ("claim_alert", r"^CALL claim_alert", LocalMySQL.claim_alert),
+        (
+            "insert_alerts",
+            r"^INSERT IGNORE INTO alerts",
+            LocalMySQL.insert_ignore_alert,
+        ),
+        (
+            "select_alerts",
+            r"^SELECT budget_id, last_alert FROM alerts",
+            LocalMySQL.select_alerts,
+        ),
+        ("update_alerts", r"^UPDATE alerts", LocalMySQL.update_alerts),
+        (
+            "select_routing",
+            r"FROM budgets WHERE budget_id IN",
+            LocalMySQL.select_routing,
+        ),
+        (
+            "insert_incidents",
+            r"^INSERT IGNORE INTO incidents",
+            LocalMySQL.insert_ignore_incident,
+        ),
+        ("select_incidents", r"FROM incidents", LocalMySQL.select_incidents),
+        ("upsert_incidents", r"^INSERT INTO incidents", LocalMySQL.upsert_incident),
+        ("release_incidents", r"^UPDATE incidents", LocalMySQL.release_incident),
+        (
+            "select_processed",
+            r"^SELECT message_id FROM processed_messages",
+            LocalMySQL.select_processed,
+        ),
+        (
+            "insert_processed",
+            r"^INSERT IGNORE INTO processed_messages",
+            LocalMySQL.insert_processed,
+        ),
+        (
+            "delete_processed",
+            r"^DELETE FROM processed_messages",
+            LocalMySQL.delete_processed,
+        ),
+        (
+            "insert_spend_history",
+            r"^INSERT INTO spend_history",
+            LocalMySQL.insert_spend_history,
+        ),
+        ("select_forecasts", r"FROM spend_forecasts", LocalMySQL.select_forecasts),
+        (
+            "release_forecasts",
+            r"^UPDATE spend_forecasts SET alerted = NULL",
+            LocalMySQL.release_forecast,
+        ),
+        ("update_forecasts", r"^UPDATE spend_forecasts", LocalMySQL.claim_forecast),
+    ]
+]
+
+
+class LocalCursor:
+    def __init__(self, db, conn):
+        self.db = db
+        self.conn = conn
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def execute(self, sql, args=None):
+        self.conn.check()
+        rowcount, self.rows = self.db.run(sql, args, many=False)
+        return rowcount
+
+    def executemany(self, sql, args):
+        # pymysql sends an INSERT ... VALUES executemany as one multi row statement
+        self.conn.check()
+        rowcount, self.rows = self.db.run(sql, list(args), many=True)
+        return rowcount
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return list(self.rows)
+
+
+class LocalConnection:
+    def __init__(self, db):
+        self.db = db
+        self.open = True
+        self.snapshot = None
+
+    def check(self):
+        if not self.open:
+            raise pymysql.err.InterfaceError(0, "Connection closed")
+
+    def cursor(self):
+        return LocalCursor(self.db, self)
+
+    def ping(self, reconnect=True):
+        started = time.perf_counter()
+        self.open = True
+        self.db._record("ping", started)
+
+    def begin(self):
+        started = time.perf_counter()
+        self.db.lock.acquire()
+        self.snapshot = self.db.snapshot()
+        self.db._record("begin", started)
+
+    def _end(self, kind, rollback):
+        if self.snapshot is None:
+            return
+        started = time.perf_counter()
+        if rollback:
+            self.db.restore(self.snapshot)
+        self.snapshot = None
+        self.db.lock.release()
+        self.db._record(kind, started)
+
+    def commit(self):
+        self._end("commit", rollback=False)
+
+    def rollback(self):
+        self._end("rollback", rollback=True)
+
+    def close(self):
+        # Closing a connection mid transaction rolls it back, like mysql does
+        self._end("rollback", rollback=True)
+        self.open = False
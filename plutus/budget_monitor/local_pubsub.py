@@ -0,0 +1,69 @@
+import collections
+import json
+import threading
+import time
+import uuid
+
+from types import SimpleNamespace
+
+
+class LocalSubscriber:
+    """
+    In memory stand-in for google.cloud.pubsub_v1.SubscriberClient, for local runs and
+    tests. Implements pull and acknowledge. Pulled messages that are never acked are
+    redelivered by redeliver(), like pubsub does once the ack deadline passes.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queue = collections.deque()
+        # ack_id -> message
+        self.unacked = {}
+        self.acked = []
+        self.calls = collections.Counter()
+
+    def publish(self, data, message_id=None, **attributes):
+        """
+        Queues a message. data is a dict (json encoded) or bytes. Publishing a message_id
+        again stands in for pubsub delivering that message twice.
+        """
+        if isinstance(data, dict):
+            data = json.dumps(data).encode("utf-8")
+        message = SimpleNamespace(
+            message_id=message_id or str(uuid.uuid4()), data=data, attributes=attributes
+        )
+        with self.lock:
+            self.queue.append(message)
+        return message.message_id
+
+    def pull(self, request, timeout=None):
+        with self.lock:
+            self.calls["pull"] += 1
+            received = []
+            while self.queue and len(received) < request["max_messages"]:
+                message = self.queue.popleft()
+                ack_id = str(uuid.uuid4())
+                self.unacked[ack_id] = message
+                received.append(SimpleNamespace(ack_id=ack_id, message=message))
+
+        if not received:
+            # Pubsub holds an empty pull open for a while, don't let callers spin
+            time.sleep(min(timeout or 0.1, 0.1))
+        return SimpleNamespace(received_messages=received)
+
+    def acknowledge(self, request):
+        with self.lock:
+            self.calls["acknowledge"] += 1
+            for ack_id in request["ack_ids"]:
+                message = self.unacked.pop(ack_id, None)
+                if message is not None:
+                    self.acked.append(message)
+
+    def redeliver(self):
+        """Requeues every pulled message that wasn't acked."""
+        with self.lock:
+            self.queue.extend(self.unacked.values())
+            self.unacked = {}
+
+    def close(self):
+        pass
@@ -0,0 +1,99 @@
+import json
+import re
+import threading
+import uuid
+
+from botocore.exceptions import ClientError
+
+
+class LocalSES:
+    """
+    Stand-in for the boto3 ses client, for local runs and tests. Implements the calls the
+    budget monitor makes. Sent emails are kept in `sent` and, when outbox is a file path,
+    appended to it as json lines.
+    """
+
+    def __init__(self, outbox=None):
+        self.outbox = outbox
+        self.lock = threading.Lock()
+        self.templates = {}
+        self.sent = []
+        self.calls = []
+
+    def _record(self, to_addresses, subject, body):
+        message_id = str(uuid.uuid4())
+        email = {
+            "message_id": message_id,
+            "to": to_addresses,
+            "subject": subject,
+            "body": body,
+        }
+        with self.lock:
+            self.sent.append(email)
+            if self.outbox is not None:
+                with open(self.outbox, "a") as f:
+                    f.write(json.dumps(email) + "\n")
+        return message_id
+
+    def _call(self, api):
+        with self.lock:
+            self.calls.append(api)
+
+    def get_template(self, TemplateName):
+        self._call("get_template")
+        return {"Template": self._template(TemplateName)}
+
+    def _template(self, TemplateName):
+        if TemplateName not in self.templates:
+            raise ClientError(
+                {
+                    "Error": {
+                        "Code": "TemplateDoesNotExist",
+                        "Message": f"Template {TemplateName} does not exist",
+                    }
+                },
+                "GetTemplate",
+            )
+        return self.templates[TemplateName]
+
+    def create_template(self, Template):
+        self._call("create_template")
+        self.templates[Template["TemplateName"]] = Template
+        return {}
+
+    def send_email(self, Destination, Message, Source):
+        self._call("send_email")
+        message_id = self._record(
+            Destination["ToAddresses"],
+            Message["Subject"]["Data"],
+            Message["Body"]["Text"]["Data"],
+        )
+        return {"MessageId": message_id}
+
+    def send_bulk_templated_email(
+        self, Source, Template, DefaultTemplateData, Destinations
+    ):
+        self._call("send_bulk_templated_email")
+        template = self._template(Template)
+        status = []
+        for destination in Destinations:
+            data = json.loads(DefaultTemplateData)
+            data.update(json.loads(destination.get("ReplacementTemplateData", "{}")))
+            message_id = self._record(
+                destination["Destination"]["ToAddresses"],
+                render(template["SubjectPart"], data),
+                render(template["TextPart"], data),
+            )
+            status.append({"Status": "Success", "MessageId": message_id})
+        return {"Status": status}
+
+
+def render(text, data):
+    """Minimal handlebars: {{#if key}}...{{/if}} blocks and {{key}} substitution."""
+    text = re.sub(
+        r"{{#if (\w+)}}(.*?){{/if}}",
+        lambda m: m.group(2) if data.get(m.group(1)) else "",
+        text,
+        flags=re.S,
+    )
+    return re.sub(r"{{(\w+)}}", lambda m: str(data.get(m.group(1), "")), text)
@@ -1,13 +1,16 @@
+# boto3, pymysql, pypd and slack are imported where they are first needed. Most
+# notifications are routine spend updates that return without an alert, and a cold start
+# shouldn't pay for loading clients those never use.
 import base64
-import boto3
+import concurrent.futures
+import contextlib
 import json
-import pymysql
-import pypd
 import os
 import re
-import slack
+import threading
+import time
 
-from botocore.exceptions import ClientError
+from collections import Counter, namedtuple, OrderedDict
 from datetime import datetime, timedelta
 
 # See https://api.slack.com/docs/token-types#bot for more info
@@ -19,107 +22,931 @@ MYSQL_HOST = os.environ["MYSQL_HOST"]
 MYSQL_USER = os.environ["MYSQL_USER"]
 MYSQL_PASS = os.environ["MYSQL_PASS"]
 MYSQL_DB = os.environ["MYSQL_DB"]
+# Seconds. Bounds how long a notification can hang on an unreachable or stalled db
+MYSQL_CONNECT_TIMEOUT = int(os.environ.get("MYSQL_CONNECT_TIMEOUT", "5"))
+MYSQL_READ_TIMEOUT = int(os.environ.get("MYSQL_READ_TIMEOUT", "10"))
+# Max connections per instance. A cloud function instance handles one message at a time
+MYSQL_POOL_SIZE = int(os.environ.get("MYSQL_POOL_SIZE", "2"))
+# Connections idle for longer than this many seconds are pinged (and reconnected if
+# mysql's wait_timeout closed them) before use
+MYSQL_PING_AFTER = int(os.environ.get("MYSQL_PING_AFTER", "60"))
 
 SMTP_EMAIL = os.environ["SMTP_EMAIL"]
 ACCESS_KEY = os.environ["AWS_ACCESS_KEY_ID"]
 SECRET_KEY = os.environ["AWS_SECRET_ACCESS_KEY"]
+# Point the ses client at a local stand-in, e.g. localstack or moto_server
+SES_ENDPOINT_URL = os.environ.get("SES_ENDPOINT_URL")
+# When set, emails aren't sent but appended to this json lines file (see local_ses.py)
+SES_LOCAL_OUTBOX = os.environ.get("SES_LOCAL_OUTBOX")
+SES_TEMPLATE_NAME = os.environ.get("SES_TEMPLATE_NAME", "plutus-budget-alert")
+# Max destinations per send_bulk_templated_email call, an ses limit
+SES_BULK_MAX = 50
 
 PAGERDUTY_KEY = os.environ["PAGERDUTY_KEY"]
 
+# Only one slack/email alert is sent per budget within this window
+ALERT_WINDOW = timedelta(days=1)
+
+# Max budgets whose last alert time is cached per instance
+ALERT_CACHE_SIZE = int(os.environ.get("ALERT_CACHE_SIZE", "10000"))
+
+# Days pubsub message ids are remembered, longer than pubsub keeps retrying a message
+MESSAGE_ID_TTL = timedelta(days=int(os.environ.get("MESSAGE_ID_TTL_DAYS", "7")))
+# Seconds between each instance's cleanups of expired message ids, and rows per cleanup
+MESSAGE_ID_CLEANUP_INTERVAL = 3600
+MESSAGE_ID_CLEANUP_LIMIT = 1000
+
+# Append every notification to the spend_history table, see SpendHistory
+SPEND_HISTORY = os.environ.get("SPEND_HISTORY", "0") == "1"
+# Buffered notifications that trigger a write before the entrypoint's own flush
+SPEND_HISTORY_MAX_ROWS = int(os.environ.get("SPEND_HISTORY_MAX_ROWS", "500"))
+
+# Seconds between checks of the budget manager's spend_forecasts for budgets projected over
+# budget or burning unusually fast. 0 disables it. Only used by long lived entrypoints
+FORECAST_ALERT_INTERVAL = float(os.environ.get("FORECAST_ALERT_INTERVAL", "0"))
+# Max forecast alerts per check
+FORECAST_ALERT_LIMIT = 100
+
+# Seconds to wait on each alert channel. A slow or failing channel doesn't hold up the others
+PAGERDUTY_TIMEOUT = float(os.environ.get("PAGERDUTY_TIMEOUT", "10"))
+SLACK_TIMEOUT = float(os.environ.get("SLACK_TIMEOUT", "10"))
+EMAIL_TIMEOUT = float(os.environ.get("EMAIL_TIMEOUT", "15"))
+# Threads sending alerts concurrently. One notification sends to at most four channels
+DELIVERY_WORKERS = int(os.environ.get("DELIVERY_WORKERS", "4"))
+
+# Seconds to coalesce slack alerts per channel into one digest message. 0 posts every alert
+# on its own. Only used by long lived entrypoints (subscriber.py), see enable_slack_digest()
+SLACK_DIGEST_WINDOW = float(os.environ.get("SLACK_DIGEST_WINDOW", "0"))
+# Max alerts per digest message, keeping messages well under slack's length limit
+SLACK_DIGEST_MAX = 25
+# Seconds a digest keeps waiting out slack rate limits before it is dropped
+SLACK_DIGEST_GIVE_UP = 300
+
 # for the plutusbot to work with additional slack channels,
 # you first need to invite that bot to the additional slack channel(s)
-slack_client = slack.WebClient(token=BOT_ACCESS_TOKEN)
+slack_client = None
+slack_client_lock = threading.Lock()
 
-mysql_conn = pymysql.connect(
-    host=MYSQL_HOST, user=MYSQL_USER, password=MYSQL_PASS, db=MYSQL_DB, autocommit=True
-)
 
+def get_slack_client():
+    """Returns the instance wide slack client, creating it on first use."""
+    global slack_client
+    if slack_client is None:
+        with slack_client_lock:
+            if slack_client is None:
+                import slack
+
+                slack_client = slack.WebClient(
+                    token=BOT_ACCESS_TOKEN, timeout=int(SLACK_TIMEOUT)
+                )
+    return slack_client
+
+
+class Metrics:
+    """
+    Counters and timings for this instance. flush() writes them as a single structured log
+    line, which cloud logging turns into log based metrics.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = Counter()
+        self.timings = {}
+        # Called with (counters, timings) by flush() instead of logging them, e.g. by
+        # loadtest.py to aggregate every sample of a run
+        self.sink = None
+
+    def incr(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def timing(self, name, ms):
+        with self.lock:
+            self.timings.setdefault(name, []).append(ms)
+
+    def flush(self):
+        with self.lock:
+            counters, self.counters = self.counters, Counter()
+            timings, self.timings = self.timings, {}
+
+        if self.sink is not None:
+            self.sink(counters, timings)
+            return
+        if not counters and not timings:
+            return
+
+        values = dict(counters)
+        for name, samples in timings.items():
+            values[f"{name}_ms_max"] = round(max(samples), 1)
+            values[f"{name}_ms_avg"] = round(sum(samples) / len(samples), 1)
+        print(
+            json.dumps(
+                {
+                    "severity": "INFO",
+                    "message": "plutus_budget_monitor metrics",
+                    "metrics": values,
+                }
+            )
+        )
+
+
+metrics = Metrics()
+
+
+class ConnectionPool:
+    """
+    Small pool of pymysql connections. Connections are only opened when a query needs one,
+    reused across invocations of a warm instance, and pinged with reconnect when they have
+    been idle long enough for mysql's wait_timeout to have dropped them.
+    """
+
+    def __init__(self, size, ping_after, **connect_kwargs):
+        self.ping_after = ping_after
+        self.connect_kwargs = connect_kwargs
+        self.slots = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+        # (connection, last used time) pairs, most recently used last
+        self.idle = []
+
+    def _connect(self):
+        import pymysql
+
+        metrics.incr("mysql_connect_count")
+        started = time.perf_counter()
+        conn = pymysql.connect(**self.connect_kwargs)
+        metrics.timing("mysql_connect", (time.perf_counter() - started) * 1000)
+        return conn
+
+    def _checkout(self):
+        import pymysql
+
+        with self.lock:
+            conn, last_used = self.idle.pop() if self.idle else (None, None)
+
+        if conn is None:
+            return self._connect()
+
+        metrics.incr("mysql_reuse_count")
+        if time.monotonic() - last_used > self.ping_after:
+            try:
+                conn.ping(reconnect=True)
+                metrics.incr("mysql_ping_count")
+            except pymysql.err.Error:
+                metrics.incr("mysql_reconnect_count")
+                conn.close()
+                return self._connect()
+        return conn
+
+    @contextlib.contextmanager
+    def connection(self):
+        import pymysql
+
+        self.slots.acquire()
+        conn = None
+        try:
+            conn = self._checkout()
+            yield conn
+        except (pymysql.err.OperationalError, pymysql.err.InterfaceError):
+            # The connection is likely broken. Don't hand it out again.
+            if conn is not None:
+                with contextlib.suppress(Exception):
+                    conn.close()
+                conn = None
+            raise
+        finally:
+            if conn is not None:
+                with self.lock:
+                    self.idle.append((conn, time.monotonic()))
+            self.slots.release()
+
+
+mysql_pool = None
+mysql_pool_lock = threading.Lock()
+
+
+def get_mysql_pool():
+    """Returns the instance wide connection pool, creating it on first use."""
+    global mysql_pool
+    if mysql_pool is None:
+        with mysql_pool_lock:
+            if mysql_pool is None:
+                mysql_pool = ConnectionPool(
+                    MYSQL_POOL_SIZE,
+                    MYSQL_PING_AFTER,
+                    host=MYSQL_HOST,
+                    user=MYSQL_USER,
+                    password=MYSQL_PASS,
+                    db=MYSQL_DB,
+                    autocommit=True,
+                    connect_timeout=MYSQL_CONNECT_TIMEOUT,
+                    read_timeout=MYSQL_READ_TIMEOUT,
+                    write_timeout=MYSQL_READ_TIMEOUT,
+                )
+    return mysql_pool
+
+
+# Where to send alerts for a budget. Fields are None when unset.
+Routing = namedtuple("Routing", ["emails", "slack_channel", "project_id"])
+
+
+def to_routing(emails, slack_channel, project_id):
+    # see https://github.com/mozilla-services/dataops/pull/80
+    if slack_channel == "None":
+        slack_channel = None
+    return Routing(emails, slack_channel, project_id)
+
+
+class AlertCache:
+    """
+    LRU cache of each budget's last alert time, kept across invocations of a warm instance.
+    Budgets alert repeatedly (every threshold, every few hours), so most notifications are
+    for a budget that already alerted within ALERT_WINDOW and can be dropped without
+    touching mysql. Routing isn't cached, the claim reads it fresh whenever an alert is sent.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # budget_id -> last_alert, least recently used first
+        self.entries = OrderedDict()
+
+    def get(self, budget_id):
+        """Returns last_alert for budget_id, or None if not cached."""
+        with self.lock:
+            last_alert = self.entries.get(budget_id)
+            if last_alert is not None:
+                self.entries.move_to_end(budget_id)
+
+        metrics.incr(
+            "alert_cache_miss_count" if last_alert is None else "alert_cache_hit_count"
+        )
+        return last_alert
+
+    def put(self, budget_id, last_alert):
+        with self.lock:
+            self.entries[budget_id] = last_alert
+            self.entries.move_to_end(budget_id)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                metrics.incr("alert_cache_evict_count")
+
+
+alert_cache = AlertCache(ALERT_CACHE_SIZE)
+
+
+class ProcessedMessages:
+    """
+    Ids of pubsub messages that were fully handled, so a redelivered message is acked
+    without any of its queries or alerts being repeated. Kept in the processed_messages
+    table, shared by all instances, behind an in process LRU.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.ids = OrderedDict()
+        # Ids some thread of this instance is handling right now
+        self.handling = set()
+        self.cleaned_at = None
+
+    def _remember(self, message_ids):
+        with self.lock:
+            for message_id in message_ids:
+                self.ids[message_id] = True
+                self.ids.move_to_end(message_id)
+            while len(self.ids) > self.max_size:
+                self.ids.popitem(last=False)
+
+    @contextlib.contextmanager
+    def in_flight(self, message_ids):
+        """
+        Yields the set of message_ids no other thread of this instance is handling, and
+        holds them until the block exits, so concurrent copies of a message (e.g. redelivered
+        after the ack deadline) are handled once. Skipping a copy is safe: if the handling
+        fails, its own delivery is retried.
+        """
+        with self.lock:
+            mine = set(message_ids) - self.handling
+            self.handling |= mine
+        if len(mine) < len(set(message_ids)):
+            metrics.incr("message_duplicate_count", len(set(message_ids)) - len(mine))
+        try:
+            yield mine
+        finally:
+            with self.lock:
+                self.handling -= mine
+
+    def seen(self, message_ids):
+        """Returns the set of message_ids that were already handled."""
+        with self.lock:
+            known = {message_id for message_id in message_ids if message_id in self.ids}
+        unknown = [message_id for message_id in message_ids if message_id not in known]
+
+        if unknown:
+            placeholders = ", ".join(["%s"] * len(unknown))
+            with get_mysql_pool().connection() as mysql_conn, mysql_conn.cursor() as cursor:
+                cursor.execute(
+                    "SELECT message_id FROM processed_messages "
+                    f"WHERE message_id IN ({placeholders})",
+                    unknown,
+                )
+                found = {row[0] for row in cursor.fetchall()}
+                metrics.incr("mysql_query_count")
+            known |= found
+
+        self._remember(known)
+        if known:
+            metrics.incr("message_duplicate_count", len(known))
+        return known
+
+    def mark(self, message_ids):
+        """Records message_ids as handled. Failing to record them only costs a retry."""
+        import pymysql
+
+        self._remember(message_ids)
+        now = datetime.now().replace(microsecond=0)
+        try:
+            with get_mysql_pool().connection() as mysql_conn, mysql_conn.cursor() as cursor:
+                cursor.executemany(
+                    "INSERT IGNORE INTO processed_messages (message_id, processed) "
+                    "VALUES (%s, %s)",
+                    [(message_id, now) for message_id in message_ids],
+                )
+                metrics.incr("mysql_query_count")
+                self._cleanup(cursor, now)
+        except pymysql.err.Error as err:
+            print(f"Recording processed messages failed: {err}")
+            metrics.incr("message_mark_error_count")
+
+    def claim(self, cursor, message_ids):
+        """
+        Records message_ids as handled on cursor's connection, and returns the ones no
+        instance had recorded before. One insert per message, as only its affected row count
+        tells whether another instance got there first.
+        """
+        if not message_ids:
+            return set()
+
+        now = datetime.now().replace(microsecond=0)
+        with self.lock:
+            unknown = {message_id for message_id in message_ids if message_id not in self.ids}
+        claimed = set()
+        for message_id in sorted(unknown):
+            if cursor.execute(
+                "INSERT IGNORE INTO processed_messages (message_id, processed) "
+                "VALUES (%s, %s)",
+                (message_id, now),
+            ):
+                claimed.add(message_id)
+        metrics.incr("mysql_query_count", len(unknown))
+        if len(claimed) < len(message_ids):
+            metrics.incr("message_duplicate_count", len(message_ids) - len(claimed))
+        self._remember(message_ids)
+        self._cleanup(cursor, now)
+        return claimed
+
+    def _cleanup(self, cursor, now):
+        if (
+            self.cleaned_at is not None
+            and time.monotonic() - self.cleaned_at < MESSAGE_ID_CLEANUP_INTERVAL
+        ):
+            return
+        self.cleaned_at = time.monotonic()
+        deleted = cursor.execute(
+            "DELETE FROM processed_messages WHERE processed < %s LIMIT %s",
+            (now - MESSAGE_ID_TTL, MESSAGE_ID_CLEANUP_LIMIT),
+        )
+        metrics.incr("mysql_query_count")
+        metrics.incr("message_expired_count", deleted)
+
+
+processed_messages = ProcessedMessages(ALERT_CACHE_SIZE)
+
+
+class SpendHistory:
+    """
+    Buffers a row per handled budget notification for the spend_history table. Callers
+    record a notification once its message is handled and not a redelivery of one already
+    handled, or pass its message_id to have the flush check that. Rows are written in one
+    insert when the entrypoint flushes (after the alerts went out) or when max_rows are
+    buffered, so recording history never adds a query in front of alert delivery. A failed
+    write drops the rows, history is best effort.
+    """
+
+    def __init__(self, enabled, max_rows):
+        self.enabled = enabled
+        self.max_rows = max_rows
+        self.lock = threading.Lock()
+        self.rows = []
+
+    def record(self, notification_attrs, notification_data, message_id=None):
+        if not self.enabled:
+            return
+        row = (
+            f"billingAccounts/{notification_attrs['billingAccountId']}"
+            f"/budgets/{notification_attrs['budgetId']}",
+            datetime.utcnow().replace(microsecond=0),
+            budget_period_start(notification_data),
+            notification_data["costAmount"],
+            notification_data["budgetAmount"],
+            notification_data.get("alertThresholdExceeded"),
+        )
+        with self.lock:
+            self.rows.append((message_id, row))
+            full = len(self.rows) >= self.max_rows
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            rows, self.rows = self.rows, []
+        if not rows:
+            return
+
+        import pymysql
+
+        try:
+            with get_mysql_pool().connection() as mysql_conn, mysql_conn.cursor() as cursor:
+                message_ids = [m for m, _ in rows if m is not None]
+                claimed = processed_messages.claim(cursor, message_ids)
+                # Drops the rows of messages already handled, by this or another instance,
+                # and all but the first copy of a message buffered twice
+                kept = []
+                for message_id, row in rows:
+                    if message_id is None or message_id in claimed:
+                        claimed.discard(message_id)
+                        kept.append(row)
+                rows = kept
+                if rows:
+                    cursor.executemany(
+                        "INSERT INTO spend_history (budget_id, received, period_start, "
+                        "cost_amount, budget_amount, threshold) "
+                        "VALUES (%s, %s, %s, %s, %s, %s)",
+                        rows,
+                    )
+                    metrics.incr("mysql_query_count")
+            metrics.incr("spend_history_row_count", len(rows))
+        except pymysql.err.Error as err:
+            print(f"Recording spend history failed: {err}")
+            metrics.incr("spend_history_dropped_count", len(rows))
+
+
+spend_history = SpendHistory(SPEND_HISTORY, SPEND_HISTORY_MAX_ROWS)
+
+
+def recently_alerted(last_alert, now=None):
+    now = now or datetime.now()
+    return last_alert is not None and last_alert >= now - ALERT_WINDOW
+
+
+def claim_alert(budget_id):
+    """
+    Atomically claims the alert slot for budget_id and looks up where to route the alert,
+    in a single round trip via the claim_alert stored procedure (sql/migrations). The
+    last alert time is cached in alert_cache.
+
+    Returns (claimed, routing). claimed is True when no alert was sent for this budget
+    within ALERT_WINDOW. Concurrent duplicate deliveries serialize on the alerts row, so
+    only one of them can claim it. routing fields are None when the budget is not in the db.
+    """
+    now = datetime.now().replace(microsecond=0)
+    with get_mysql_pool().connection() as mysql_conn, mysql_conn.cursor() as cursor:
+        sql = "CALL claim_alert(%s, %s, %s)"
+        cursor.execute(sql, (budget_id, now, now - ALERT_WINDOW))
+        claimed, last_alert, emails, slack_channel, project_id = cursor.fetchone()
+        metrics.incr("mysql_query_count")
+
+    routing = to_routing(emails, slack_channel, project_id)
+    alert_cache.put(budget_id, last_alert)
+    return bool(claimed), routing
+
+
+# last_alert of alerts rows inserted only so they can be locked. Older than any cutoff
+NEVER_ALERTED = datetime(1970, 1, 1)
+
+
+def claim_alerts(budget_ids):
+    """
+    Batch version of claim_alert. Claims the alert slots and looks up routing for many
+    budgets in a single transaction: one insert, one locking select, one update and one
+    routing select, however many budgets there are.
+
+    Returns {budget_id: (claimed, routing)}.
+    """
+    budget_ids = sorted(set(budget_ids))
+    if not budget_ids:
+        return {}
+
+    now = datetime.now().replace(microsecond=0)
+    cutoff = now - ALERT_WINDOW
+    placeholders = ", ".join(["%s"] * len(budget_ids))
+
+    with get_mysql_pool().connection() as mysql_conn:
+        mysql_conn.begin()
+        try:
+            with mysql_conn.cursor() as cursor:
+                # Make sure every row exists, so the select below can lock them all.
+                # Rows are locked in budget_id order to avoid deadlocks between batches
+                cursor.executemany(
+                    "INSERT IGNORE INTO alerts (budget_id, last_alert) VALUES (%s, %s)",
+                    [(budget_id, NEVER_ALERTED) for budget_id in budget_ids],
+                )
+                cursor.execute(
+                    "SELECT budget_id, last_alert FROM alerts "
+                    f"WHERE budget_id IN ({placeholders}) ORDER BY budget_id FOR UPDATE",
+                    budget_ids,
+                )
+                last_alerts = dict(cursor.fetchall())
+
+                claimed = [b for b in budget_ids if last_alerts[b] < cutoff]
+                if claimed:
+                    cursor.execute(
+                        "UPDATE alerts SET last_alert = %s WHERE budget_id IN "
+                        f"({', '.join(['%s'] * len(claimed))})",
+                        [now] + claimed,
+                    )
+
+                cursor.execute(
+                    "SELECT budget_id, owner_emails, alert_slack_channel_id, project_id "
+                    f"FROM budgets WHERE budget_id IN ({placeholders})",
+                    budget_ids,
+                )
+                routings = {row[0]: to_routing(*row[1:]) for row in cursor.fetchall()}
+            mysql_conn.commit()
+        except Exception:
+            with contextlib.suppress(Exception):
+                mysql_conn.rollback()
+            raise
+        metrics.incr("mysql_query_count", 4 if claimed else 3)
+
+    claims = {}
+    for budget_id in budget_ids:
+        routing = routings.get(budget_id, Routing(None, None, None))
+        is_claimed = budget_id in claimed
+        alert_cache.put(budget_id, now if is_claimed else last_alerts[budget_id])
+        claims[budget_id] = (is_claimed, routing)
+    return claims
+
+
+# Last pagerduty trigger per budget, {budget_id: (period_start, threshold)}, mirroring the
+# incidents table for budgets this instance has seen. Least recently used first
+incident_states = OrderedDict()
+incident_states_lock = threading.Lock()
+
+
+def escalates(state, period_start, threshold):
+    """
+    Whether an alert for threshold in the budget period starting period_start should
+    trigger pagerduty, given the budget's last trigger state (None if never triggered).
+    """
+    if state is None:
+        return True
+    last_period_start, last_threshold = state
+    return period_start > last_period_start or (
+        period_start == last_period_start and threshold > last_threshold
+    )
+
+
+def remember_incident(budget_id, period_start, threshold):
+    with incident_states_lock:
+        incident_states[budget_id] = (period_start, threshold)
+        incident_states.move_to_end(budget_id)
+        while len(incident_states) > ALERT_CACHE_SIZE:
+            incident_states.popitem(last=False)
+
+
+def known_incident(alert):
+    """True if this instance knows pagerduty was already triggered at least this high."""
+    with incident_states_lock:
+        state = incident_states.get(alert.full_budget_id)
+    if state is not None and not escalates(state, alert.period_start, alert.threshold):
+        metrics.incr("incident_suppressed_count")
+        return True
+    return False
+
+
+def claim_incidents(alerts):
+    """
+    Records the pagerduty triggers for alerts in the incidents table where they escalate
+    the budget's last trigger, in a single transaction so concurrent deliveries trigger
+    once. If a trigger then fails to send, release_incidents gives the claim back.
+
+    Returns {full_budget_id: (period_start, threshold, triggered)} of the alerts that should
+    trigger pagerduty, with the state each claim replaced.
+    """
+    alerts = [alert for alert in alerts if not known_incident(alert)]
+    budget_ids = sorted({alert.full_budget_id for alert in alerts})
+    if not budget_ids:
+        return {}
+
+    now = datetime.now().replace(microsecond=0)
+    placeholders = ", ".join(["%s"] * len(budget_ids))
+
+    with get_mysql_pool().connection() as mysql_conn:
+        mysql_conn.begin()
+        try:
+            with mysql_conn.cursor() as cursor:
+                # As in claim_alerts, make sure every row exists so all can be locked
+                cursor.executemany(
+                    "INSERT IGNORE INTO incidents "
+                    "(budget_id, period_start, threshold, triggered) "
+                    "VALUES (%s, %s, %s, %s)",
+                    [(b, NEVER_ALERTED, 0, NEVER_ALERTED) for b in budget_ids],
+                )
+                cursor.execute(
+                    "SELECT budget_id, period_start, threshold, triggered FROM incidents "
+                    f"WHERE budget_id IN ({placeholders}) ORDER BY budget_id FOR UPDATE",
+                    budget_ids,
+                )
+                states = {row[0]: tuple(row[1:]) for row in cursor.fetchall()}
+
+                triggered = {}
+                for alert in alerts:
+                    state = (
+                        triggered.get(alert.full_budget_id)
+                        or states[alert.full_budget_id][:2]
+                    )
+                    if escalates(state, alert.period_start, alert.threshold):
+                        triggered[alert.full_budget_id] = (
+                            alert.period_start,
+                            alert.threshold,
+                        )
+
+                if triggered:
+                    cursor.executemany(
+                        "INSERT INTO incidents "
+                        "(budget_id, period_start, threshold, triggered) "
+                        "VALUES (%s, %s, %s, %s) ON DUPLICATE KEY UPDATE "
+                        "period_start = VALUES(period_start), "
+                        "threshold = VALUES(threshold), "
+                        "triggered = VALUES(triggered)",
+                        [(b, p, t, now) for b, (p, t) in triggered.items()],
+                    )
+            mysql_conn.commit()
+        except Exception:
+            with contextlib.suppress(Exception):
+                mysql_conn.rollback()
+            raise
+        metrics.incr("mysql_query_count", 3 if triggered else 2)
+
+    for budget_id in budget_ids:
+        remember_incident(budget_id, *triggered.get(budget_id, states[budget_id][:2]))
+    metrics.incr("incident_suppressed_count", len(alerts) - len(triggered))
+    return {budget_id: states[budget_id] for budget_id in triggered}
+
+
+def release_incidents(alerts, claims):
+    """
+    Gives back the claims of alerts whose pagerduty trigger failed to send, restoring the
+    state claim_incidents replaced, so the next delivery of the alert triggers again.
+    A claim another delivery escalated since is left alone.
+    """
+    if not alerts:
+        return
+
+    with get_mysql_pool().connection() as mysql_conn, mysql_conn.cursor() as cursor:
+        cursor.executemany(
+            "UPDATE incidents SET period_start = %s, threshold = %s, triggered = %s "
+            "WHERE budget_id = %s AND period_start = %s AND threshold = %s",
+            [
+                claims[a.full_budget_id]
+                + (a.full_budget_id, a.period_start, a.threshold)
+                for a in alerts
+            ],
+        )
+        metrics.incr("mysql_query_count")
+
+    # Let the next delivery ask mysql rather than trust the released state
+    with incident_states_lock:
+        for alert in alerts:
+            incident_states.pop(alert.full_budget_id, None)
+    metrics.incr("incident_released_count", len(alerts))
 
-def send_alert(budget_id):
-    """Determine whether to send an alert or not based on last alert time."""
-
-    with mysql_conn.cursor() as cursor:
-        sql = "SELECT `last_alert` FROM `alerts` WHERE `budget_id`=%s"
-        cursor.execute(sql, [budget_id])
-        result = cursor.fetchone()
-        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-        if result is None:
-            # No record found, insert new row into table
-            sql = "INSERT INTO `alerts` (`budget_id`, `last_alert`) VALUES (%s, %s)"
-            cursor.execute(sql, (budget_id, now))
-            return True
-        else:
-            # Record found, check timestamp of last alert time
-            past = datetime.now() - timedelta(days=1)
-
-            # Untuple the sql result. This will return a datetime.datetime object.
-            last_alert_time = result[0]
-
-            if last_alert_time < past:
-                # If last alerted over a day ago, update table and send alert
-                sql = "UPDATE `alerts` set `last_alert`=%s WHERE `budget_id`=%s"
-                cursor.execute(sql, (now, budget_id))
-                return True
-            else:
-                return False
-
-
-def get_emails_for_budget(budget_id):
-    with mysql_conn.cursor() as cursor:
-        sql = "SELECT `owner_emails` FROM `budgets` WHERE `budget_id`=%s"
-        cursor.execute(sql, [budget_id])
-        result = cursor.fetchone()
-        if result is None:
-            emails = None
-        else:
-            # result should be a tuple
-            emails = "".join(result)
-        return emails
+
+class DeliveryError(Exception):
+    """Raised when one or more alert channels failed or timed out."""
+
+
+delivery_pool = None
+delivery_pool_lock = threading.Lock()
+
+
+def get_delivery_pool():
+    """Returns the instance wide thread pool alerts are sent from, creating it on first use."""
+    global delivery_pool
+    if delivery_pool is None:
+        with delivery_pool_lock:
+            if delivery_pool is None:
+                delivery_pool = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=DELIVERY_WORKERS, thread_name_prefix="delivery"
+                )
+    return delivery_pool
+
+
+class Deliveries:
+    """
+    Sends an alert to several channels (pagerduty, slack, email) concurrently. Each channel
+    has its own timeout and fails independently. wait() returns the failures, so the caller
+    decides what to do about them once every channel had its chance.
+    """
+
+    def __init__(self):
+        # (channel, future, deadline)
+        self.pending = []
+
+    def submit(self, channel, timeout, func, *args, **kwargs):
+        """Sends func(*args, **kwargs) on the delivery pool. Returns its future."""
+        future = get_delivery_pool().submit(self._timed, channel, func, *args, **kwargs)
+        self.pending.append((channel, future, time.perf_counter() + timeout))
+        return future
+
+    @staticmethod
+    def delivered(future):
+        """After wait(), whether the delivery behind future was sent within its timeout."""
+        return future.done() and not future.cancelled() and future.exception() is None
+
+    @staticmethod
+    def _timed(channel, func, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            metrics.timing(f"{channel}_send", (time.perf_counter() - started) * 1000)
+
+    def wait(self):
+        """Waits for every channel up to its deadline. Returns a list of failure messages."""
+        failures = []
+        for channel, future, deadline in self.pending:
+            try:
+                future.result(timeout=max(0, deadline - time.perf_counter()))
+                metrics.incr(f"{channel}_sent_count")
+            except concurrent.futures.TimeoutError:
+                # Don't send late if it never got a worker
+                future.cancel()
+                metrics.incr(f"{channel}_timeout_count")
+                failures.append(f"{channel}: timed out")
+            except Exception as err:
+                metrics.incr(f"{channel}_error_count")
+                failures.append(f"{channel}: {err}")
+        self.pending = []
+
+        for failure in failures:
+            print(f"Alert delivery failed. {failure}")
+        return failures
+
+
+EMAIL_CHARSET = "UTF-8"
+EMAIL_TEMPLATE = {
+    "TemplateName": SES_TEMPLATE_NAME,
+    "SubjectPart": "Plutus - GCP Budget alert{{#if project_id}} - {{project_id}}{{/if}}",
+    "TextPart": "{{message}}",
+}
+
+ses_client = None
+ses_client_lock = threading.Lock()
+ses_template_ready = False
+
+
+def get_ses_client():
+    """Returns the instance wide ses client, creating it on first use."""
+    global ses_client
+    if ses_client is None:
+        with ses_client_lock:
+            if ses_client is None:
+                if SES_LOCAL_OUTBOX:
+                    from local_ses import LocalSES
+
+                    ses_client = LocalSES(SES_LOCAL_OUTBOX)
+                else:
+                    import boto3
+                    from botocore.config import Config
+
+                    ses_client = boto3.client(
+                        "ses",
+                        aws_access_key_id=ACCESS_KEY,
+                        aws_secret_access_key=SECRET_KEY,
+                        region_name="us-west-2",
+                        endpoint_url=SES_ENDPOINT_URL,
+                        config=Config(
+                            connect_timeout=EMAIL_TIMEOUT,
+                            read_timeout=EMAIL_TIMEOUT,
+                            retries={"max_attempts": 2},
+                        ),
+                    )
+    return ses_client
+
+
+def ensure_email_template(client):
+    """Creates the ses template used for bulk alert emails, if it doesn't exist yet."""
+    global ses_template_ready
+    from botocore.exceptions import ClientError
+
+    if ses_template_ready:
+        return
+    try:
+        client.get_template(TemplateName=SES_TEMPLATE_NAME)
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "TemplateDoesNotExist":
+            raise
+        client.create_template(Template=EMAIL_TEMPLATE)
+        print(f"Created ses template {SES_TEMPLATE_NAME}")
+    ses_template_ready = True
 
 
 def send_email(emails, message, project_id=None):
+    from botocore.exceptions import ClientError
+
     subject = "Plutus - GCP Budget alert"
     if project_id is not None:
         subject += f" - {project_id}"
-    charset = "UTF-8"
-    client = boto3.client(
-        "ses",
-        aws_access_key_id=ACCESS_KEY,
-        aws_secret_access_key=SECRET_KEY,
-        region_name="us-west-2",
-    )
 
     try:
-        response = client.send_email(
+        response = get_ses_client().send_email(
             Destination={
                 "ToAddresses": emails,
             },
             Message={
                 "Body": {
                     "Text": {
-                        "Charset": charset,
+                        "Charset": EMAIL_CHARSET,
                         "Data": message,
                     },
                 },
                 "Subject": {
-                    "Charset": charset,
+                    "Charset": EMAIL_CHARSET,
                     "Data": subject,
                 },
             },
             Source=SMTP_EMAIL,
         )
+        metrics.incr("ses_call_count")
     except ClientError as e:
         print(e.response["Error"]["Message"])
+        raise
     else:
         print(f"Email sent! Message ID: {response['MessageId']}")
 
 
-def send_pagerduty_alert(message, budget_id):
-    pypd.api_key = PAGERDUTY_KEY
+def send_bulk_email(alerts):
+    """
+    Sends many alert emails through the ses template, SES_BULK_MAX per
+    send_bulk_templated_email call, rather than one send_email call each.
 
+    alerts - list of (emails, message, project_id) tuples
+    Returns a list of (alert, error) for the emails ses rejected.
+    """
+    client = get_ses_client()
+    ensure_email_template(client)
+
+    failures = []
+    for start in range(0, len(alerts), SES_BULK_MAX):
+        end = start + SES_BULK_MAX
+        chunk = alerts[start:end]
+        response = client.send_bulk_templated_email(
+            Source=SMTP_EMAIL,
+            Template=SES_TEMPLATE_NAME,
+            DefaultTemplateData=json.dumps({"message": "", "project_id": ""}),
+            Destinations=[
+                {
+                    "Destination": {"ToAddresses": emails},
+                    "ReplacementTemplateData": json.dumps(
+                        {"message": message, "project_id": project_id or ""}
+                    ),
+                }
+                for emails, message, project_id in chunk
+            ],
+        )
+        metrics.incr("ses_call_count")
+        for alert, status in zip(chunk, response["Status"]):
+            if status["Status"] != "Success":
+                failures.append((alert, status.get("Error", status["Status"])))
+
+    metrics.incr("email_bulk_sent_count", len(alerts) - len(failures))
+    for alert, error in failures:
+        print(f"Bulk email to {alert[0]} failed: {error}")
+    return failures
+
+
+pagerduty_events = None
+pagerduty_events_lock = threading.Lock()
+
+
+def get_pagerduty_events():
+    """Returns the pagerduty events v2 api, importing pypd on first use."""
+    global pagerduty_events
+    if pagerduty_events is None:
+        with pagerduty_events_lock:
+            if pagerduty_events is None:
+                import pypd
+
+                pypd.api_key = PAGERDUTY_KEY
+                pagerduty_events = pypd.EventV2
+    return pagerduty_events
+
+
+def send_pagerduty_alert(message, budget_id):
     # create a version 2 event
-    pypd.EventV2.create(
+    get_pagerduty_events().create(
         data={
             "routing_key": PAGERDUTY_KEY,
             "event_action": "trigger",
@@ -133,24 +960,156 @@ def send_pagerduty_alert(message, budget_id):
     )
 
 
-def get_slack_channel_for_budget(budget_id):
-    with mysql_conn.cursor() as cursor:
-        sql = "SELECT `alert_slack_channel_id` FROM `budgets` WHERE `budget_id`=%s"
-        cursor.execute(sql, [budget_id])
-        result = cursor.fetchone()
-        # see https://github.com/mozilla-services/dataops/pull/80
-        if result[0] is None or result[0] == "None":
-            slack_channel = None
-        else:
-            # result should be a tuple
-            slack_channel = "".join(result)
-        return slack_channel
+def retry_after(err):
+    """Returns the seconds slack asked us to wait for a rate limited call, or None."""
+    response = getattr(err, "response", None)
+    if getattr(response, "status_code", None) != 429:
+        return None
+    return float(response.headers.get("Retry-After", 1))
+
+
+def post_message(channel_id, message, give_up_after=SLACK_TIMEOUT):
+    """Posts to a slack channel, waiting out rate limits for up to give_up_after seconds."""
+    from slack.errors import SlackApiError
+
+    give_up_at = time.monotonic() + give_up_after
+    while True:
+        try:
+            get_slack_client().chat_postMessage(channel=channel_id, text=message)
+            return
+        except SlackApiError as err:
+            wait = retry_after(err)
+            if wait is None or time.monotonic() + wait > give_up_at:
+                raise
+            metrics.incr("slack_rate_limited_count")
+            time.sleep(wait)
+
+
+def format_digest(messages):
+    if len(messages) == 1:
+        return messages[0]
+    return f"{len(messages)} budget alerts:\n\n" + "\n\n".join(messages)
+
+
+class ChannelQueue:
+    """
+    Outbound queue for one slack channel. Messages are buffered for window seconds after
+    the first one arrives and then posted as a single digest, by one sender thread, so a
+    channel never gets concurrent posts and a rate limited channel only holds up itself.
+    """
+
+    def __init__(self, channel_id, window):
+        self.channel_id = channel_id
+        self.window = window
+        self.cond = threading.Condition()
+        self.messages = []
+        self.closed = False
+        self.thread = threading.Thread(
+            target=self._run, name=f"slack-{channel_id}", daemon=True
+        )
+        self.thread.start()
+
+    def put(self, message):
+        with self.cond:
+            self.messages.append(message)
+            self.cond.notify()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.messages and not self.closed:
+                    self.cond.wait()
+                if not self.messages:
+                    return
+
+                # Let more alerts for this channel pile up, unless we're shutting down
+                send_at = time.monotonic() + self.window
+                while not self.closed and time.monotonic() < send_at:
+                    self.cond.wait(send_at - time.monotonic())
+
+                messages, self.messages = self.messages, []
+
+            for start in range(0, len(messages), SLACK_DIGEST_MAX):
+                end = start + SLACK_DIGEST_MAX
+                self._send(messages[start:end])
+
+    def _send(self, messages):
+        started = time.perf_counter()
+        try:
+            post_message(
+                self.channel_id,
+                format_digest(messages),
+                give_up_after=SLACK_DIGEST_GIVE_UP,
+            )
+            metrics.incr("slack_digest_sent_count")
+            metrics.incr("slack_digest_alert_count", len(messages))
+        except Exception as err:
+            metrics.incr("slack_digest_error_count")
+            print(
+                f"Slack digest of {len(messages)} alerts to {self.channel_id} failed: {err}"
+            )
+        finally:
+            metrics.timing("slack_digest_send", (time.perf_counter() - started) * 1000)
+
+    def close(self, timeout=None):
+        """Sends whatever is buffered right away and stops the sender thread."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.thread.join(timeout)
+
+
+class SlackDigest:
+    """Routes slack alerts to a ChannelQueue per destination channel."""
+
+    def __init__(self, window):
+        self.window = window
+        self.lock = threading.Lock()
+        self.channels = {}
+
+    def post(self, channel_id, message):
+        with self.lock:
+            channel = self.channels.get(channel_id)
+            if channel is None:
+                channel = self.channels[channel_id] = ChannelQueue(
+                    channel_id, self.window
+                )
+        channel.put(message)
+        metrics.incr("slack_digest_queued_count")
+
+    def close(self, timeout=None):
+        with self.lock:
+            channels = list(self.channels.values())
+        for channel in channels:
+            channel.close(timeout)
+
+
+# Off unless a long lived entrypoint enables it. A cloud function instance may be frozen
+# as soon as the invocation returns, before a digest is sent.
+slack_digest = None
+
+
+def enable_slack_digest(window=SLACK_DIGEST_WINDOW):
+    """Switches slack alerts to digest mode when window > 0. Returns the SlackDigest."""
+    global slack_digest
+    if window > 0 and slack_digest is None:
+        slack_digest = SlackDigest(window)
+        print(f"Slack alerts are sent as digests every {window} seconds per channel")
+    return slack_digest
+
+
+def send_slack_alert(deliveries, channel_id, message):
+    """Queues a slack alert, on the channel's digest when digest mode is on."""
+    if slack_digest is not None:
+        slack_digest.post(channel_id, message)
+    else:
+        deliveries.submit("slack", SLACK_TIMEOUT, post_message, channel_id, message)
 
 
 def post_to_channel(message, additional_channel_id=None):
     if additional_channel_id is not None:
-        slack_client.chat_postMessage(channel=additional_channel_id, text=message)
-    slack_client.chat_postMessage(channel=DEFAULT_CHANNEL_ID, text=message)
+        post_message(additional_channel_id, message)
+    post_message(DEFAULT_CHANNEL_ID, message)
 
 
 def decode_budget_data(data):
@@ -158,7 +1117,23 @@ def decode_budget_data(data):
     return json.loads(data)
 
 
-def budget_notify(notification_attrs, notification_data):
+# A notification that exceeded an alert threshold
+Alert = namedtuple(
+    "Alert",
+    [
+        "budget_id",
+        "full_budget_id",
+        "project_id",
+        "message",
+        "threshold",
+        "cost_amount",
+        "period_start",
+    ],
+)
+
+
+def build_alert(notification_attrs, notification_data):
+    """Returns the Alert for a budget notification, or None if no threshold was exceeded."""
 
     billing_account_id = notification_attrs["billingAccountId"]
     budget_id = notification_attrs["budgetId"]
@@ -166,53 +1141,279 @@ def budget_notify(notification_attrs, notification_data):
     cost_amount = notification_data["costAmount"]
     budget_amount = notification_data["budgetAmount"]
 
-    if notification_data.get("alertThresholdExceeded"):
-        # From google documentation, key exists only if a threshold was exceeded
-        alert_threshold_exceeded = notification_data.get("alertThresholdExceeded")
+    if not notification_data.get("alertThresholdExceeded"):
+        return None
+
+    # From google documentation, key exists only if a threshold was exceeded
+    alert_threshold_exceeded = notification_data.get("alertThresholdExceeded")
 
-        pattern = re.compile("^plutus-(labels|\d*-)*(.*)$")  # noqa: W605
-        match = pattern.match(budget_name)
+    pattern = re.compile("^plutus-(labels|\d*-)*(.*)$")  # noqa: W605
+    match = pattern.match(budget_name)
 
-        message = ""
-        project_id = None
-        if match:
-            project_id = match.group(2)
-            message += f"Budget exceeded for project: {project_id}. "
+    message = ""
+    project_id = None
+    if match:
+        project_id = match.group(2)
+        message += f"Budget exceeded for project: {project_id}. "
 
-        message += f"budget_name: {budget_name}\
+    message += f"budget_name: {budget_name}\
         budget_id: {budget_id},\
         budget_amount: {budget_amount},\
         cost_amount: {cost_amount},\
         alert_threshold_exceeded: {alert_threshold_exceeded},\
         budget_url: https://console.cloud.google.com/billing?project={project_id}"
 
-        send_pagerduty_alert(message, budget_id)
+    full_budget_id = f"billingAccounts/{billing_account_id}/budgets/{budget_id}"
+    return Alert(
+        budget_id,
+        full_budget_id,
+        project_id,
+        message,
+        alert_threshold_exceeded,
+        cost_amount,
+        budget_period_start(notification_data),
+    )
+
+
+def budget_period_start(notification_data):
+    """Start of the budget period (e.g. the month) a notification is for."""
+    interval_start = notification_data.get("costIntervalStart")
+    if interval_start:
+        # e.g. 2020-06-01T07:00:00Z
+        return datetime.strptime(interval_start[:19], "%Y-%m-%dT%H:%M:%S")
+    now = datetime.utcnow()
+    return datetime(now.year, now.month, 1)
+
+
+def budget_notify(notification_attrs, notification_data, message_id=None):
+    alert = build_alert(notification_attrs, notification_data)
+    if alert is None:
+        metrics.incr("notification_routine_count")
+        # Spend history is a routine notification's only side effect. The history flush
+        # records its message id and drops a redelivery, so no query is made here
+        spend_history.record(notification_attrs, notification_data, message_id)
+        return
+
+    message_ids = [] if message_id is None else [message_id]
+    with processed_messages.in_flight(message_ids) as mine:
+        if len(mine) < len(message_ids) or mine and processed_messages.seen(mine):
+            return
+
+        send_alert(alert)
+        # Only once the message is handled, so a redelivery doesn't record it twice
+        spend_history.record(notification_attrs, notification_data)
+        if mine:
+            processed_messages.mark(mine)
+
+
+def send_alert(alert):
+    """Sends alert on every channel it is due on. Raises DeliveryError if any failed."""
+    deliveries = Deliveries()
+    incident = None
+    try:
+        # Only trigger pagerduty when a higher threshold is exceeded
+        claims = claim_incidents([alert])
+        if claims:
+            incident = deliveries.submit(
+                "pagerduty",
+                PAGERDUTY_TIMEOUT,
+                send_pagerduty_alert,
+                alert.message,
+                alert.budget_id,
+            )
+        alert_once(deliveries, alert)
+    finally:
+        failures = deliveries.wait()
+        # So the redelivery triggers again, the budget_id dedup_key makes a late send harmless
+        if incident is not None and not Deliveries.delivered(incident):
+            release_incidents([alert], claims)
+
+    if failures:
+        raise DeliveryError("; ".join(failures))
+
+
+def alert_once(deliveries, alert):
+    """Queues the slack and email alerts, unless one was already sent within ALERT_WINDOW."""
+    if recently_alerted(alert_cache.get(alert.full_budget_id)):
+        # Already alerted within the window, no need to ask mysql
+        metrics.incr("alert_suppressed_count")
+        return
+
+    claimed, routing = claim_alert(alert.full_budget_id)
+    if not claimed:
+        return
+
+    queue_slack_alert(deliveries, alert, routing)
 
-        full_budget_id = f"billingAccounts/{billing_account_id}/budgets/{budget_id}"
+    # Send email alert
+    if routing.emails is not None:
+        deliveries.submit(
+            "email",
+            EMAIL_TIMEOUT,
+            send_email,
+            routing.emails.split(","),
+            alert.message,
+            alert.project_id,
+        )
+
+
+def queue_slack_alert(deliveries, alert, routing):
+    """Queues the slack alert(s) for a claimed alert, and flags budgets missing from the db."""
+    if routing.slack_channel is not None:
+        send_slack_alert(deliveries, routing.slack_channel, alert.message)
+    send_slack_alert(deliveries, DEFAULT_CHANNEL_ID, alert.message)
+
+    if routing.emails is None:
+        send_slack_alert(
+            deliveries,
+            DEFAULT_CHANNEL_ID,
+            f"Send email failed. Budget id {alert.full_budget_id} not found in db.",
+        )
+
+
+def format_forecast(
+    projected_cost, budget_amount, cost_amount, burn_rate, baseline_rate
+):
+    return (
+        f"projected_cost: {projected_cost:.2f}, budget_amount: {budget_amount:.2f}, "
+        f"cost_amount: {cost_amount:.2f}, burn_rate: {burn_rate:.2f}/hour, "
+        f"period_burn_rate: {baseline_rate:.2f}/hour"
+    )
+
+
+def alert_forecasts(limit=FORECAST_ALERT_LIMIT):
+    """
+    Alerts on budgets that spend_forecasts projects over budget or flags as burning
+    anomalously fast, once per budget period. A budget whose alert fails to deliver is
+    alerted again by the next check. Returns the number of budgets alerted.
+
+    Never raises, so the long lived entrypoints' loops that call it survive e.g. slack
+    being down.
+    """
+    try:
+        return send_forecast_alerts(limit)
+    except Exception as err:
+        print(f"Forecast alerts failed: {err}")
+        metrics.incr("forecast_alert_error_count")
+        return 0
+
+
+def send_forecast_alerts(limit):
+    """alert_forecasts, raising what it doesn't handle itself."""
+    import pymysql
 
-        if send_alert(full_budget_id):
-            # Send slack alert(s)
-            additional_channel_id = get_slack_channel_for_budget(full_budget_id)
-            post_to_channel(message, additional_channel_id=additional_channel_id)
+    now = datetime.utcnow().replace(microsecond=0)
+    claimed = []
+    try:
+        with get_mysql_pool().connection() as mysql_conn, mysql_conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT f.budget_id, f.projected_cost, f.budget_amount, f.cost_amount, "
+                "f.burn_rate, f.baseline_rate, f.anomaly, "
+                "b.owner_emails, b.alert_slack_channel_id, b.project_id "
+                "FROM spend_forecasts f LEFT JOIN budgets b ON b.budget_id = f.budget_id "
+                "WHERE f.alerted IS NULL AND (f.anomaly OR f.projected_cost > f.budget_amount) "
+                "LIMIT %s",
+                (limit,),
+            )
+            rows = cursor.fetchall()
+            metrics.incr("mysql_query_count")
+            for row in rows:
+                # Another instance may have alerted since the select
+                if cursor.execute(
+                    "UPDATE spend_forecasts SET alerted = %s "
+                    "WHERE budget_id = %s AND alerted IS NULL",
+                    (now, row[0]),
+                ):
+                    claimed.append(row)
+                metrics.incr("mysql_query_count")
+    except pymysql.err.Error as err:
+        print(f"Checking spend forecasts failed: {err}")
+        metrics.incr("forecast_alert_error_count")
+        return 0
+
+    # Per budget, so a failure only gives back the claim of the budget it belongs to
+    pending = []
+    for row in claimed:
+        deliveries = Deliveries()
+        try:
+            queue_forecast_alert(deliveries, *row)
+            error = None
+        except Exception as err:
+            error = f"{row[0]}: {err}"
+        pending.append((row[0], deliveries, error))
 
-            # Send email alert
-            emails = get_emails_for_budget(full_budget_id)
-            if emails is not None:
-                send_email(emails.split(","), message, project_id)
-            else:
-                post_to_channel(
-                    f"Send email failed. Budget id {full_budget_id} not found in db."
+    failures, failed = [], []
+    for budget_id, deliveries, error in pending:
+        budget_failures = deliveries.wait() + ([error] if error else [])
+        if budget_failures:
+            failures.extend(budget_failures)
+            failed.append(budget_id)
+
+    if failed:
+        try:
+            with get_mysql_pool().connection() as mysql_conn, mysql_conn.cursor() as cursor:
+                cursor.executemany(
+                    "UPDATE spend_forecasts SET alerted = NULL "
+                    "WHERE budget_id = %s AND alerted = %s",
+                    [(budget_id, now) for budget_id in failed],
                 )
+                metrics.incr("mysql_query_count")
+        except pymysql.err.Error as err:
+            print(f"Releasing failed forecast alerts failed: {err}")
+            metrics.incr("forecast_alert_error_count")
 
+    metrics.incr("forecast_alert_count", len(claimed) - len(failed))
+    if failures:
+        try:
+            post_to_channel(f"Plutus forecast alert failed: {'; '.join(failures)}")
+        except Exception as err:
+            # Likely the same outage the report is about. The next check retries anyway
+            print(f"Reporting failed forecast alerts failed: {err}")
+            metrics.incr("forecast_alert_error_count")
+    return len(claimed) - len(failed)
 
-# Entrypoint of GCP Cloud Function
-def process_pubsub(data, context):
+
+def queue_forecast_alert(deliveries, budget_id, *forecast_and_routing):
+    *forecast, anomaly, emails, slack_channel, project_id = forecast_and_routing
+    routing = to_routing(emails, slack_channel, project_id)
+    reason = "Burn rate anomaly" if anomaly else "Projected to exceed budget"
+    message = (
+        f"{reason} for project: {project_id}. budget_id: {budget_id}, "
+        f"{format_forecast(*forecast)}, "
+        f"budget_url: https://console.cloud.google.com/billing?project={project_id}"
+    )
+    if routing.slack_channel is not None:
+        send_slack_alert(deliveries, routing.slack_channel, message)
+    send_slack_alert(deliveries, DEFAULT_CHANNEL_ID, message)
+    if routing.emails is not None:
+        deliveries.submit(
+            "email",
+            EMAIL_TIMEOUT,
+            send_email,
+            routing.emails.split(","),
+            message,
+            project_id,
+        )
+
+
+def handle_notification(data, message_id=None):
+    """Handles one pubsub message. Failures are reported to slack and re-raised."""
     notification_attrs = data["attributes"]
     notification_data = decode_budget_data(data["data"])
 
     try:
-        budget_notify(notification_attrs, notification_data)
+        budget_notify(notification_attrs, notification_data, message_id)
     except Exception as err:
         post_to_channel(f"Plutus budget notify failed: {err}")
         post_to_channel(f"{notification_attrs} - {notification_data}")
         raise
+
+
+# Entrypoint of GCP Cloud Function
+def process_pubsub(data, context):
+    try:
+        # The event id of a pubsub triggered function is the pubsub message id
+        handle_notification(data, getattr(context, "event_id", None))
+    finally:
+        spend_history.flush()
+        metrics.flush()
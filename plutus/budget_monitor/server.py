@@ -0,0 +1,259 @@
+"""
+HTTP server entrypoint for pubsub push subscriptions, e.g. to run the budget monitor in GKE
+next to the budget manager instead of as a cloud function.
+
+Push requests are queued to a fixed pool of worker threads, which share the pooled mysql
+connections and the slack and ses clients. A request is answered once its message was
+handled: 204 acks it, 500 has pubsub redeliver it. When the queue is full the request is
+refused with 429, so pubsub backs off instead of piling up work.
+
+* POST /          pubsub push endpoint
+* GET  /healthz   liveness, 200 while the server is up
+* GET  /readyz    readiness, 200 while workers are running, the queue has room and mysql
+                  is reachable
+
+Run with e.g. PORT=8080 python server.py
+"""
+
+import json
+import os
+import queue
+import signal
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from main import (
+    alert_forecasts,
+    enable_slack_digest,
+    FORECAST_ALERT_INTERVAL,
+    get_mysql_pool,
+    handle_notification,
+    metrics,
+    spend_history,
+)
+
+PORT = int(os.environ.get("PORT", "8080"))
+# Messages handled concurrently
+SERVER_WORKERS = int(os.environ.get("SERVER_WORKERS", "8"))
+# Messages waiting for a worker before new pushes are refused with 429
+SERVER_QUEUE_SIZE = int(os.environ.get("SERVER_QUEUE_SIZE", "32"))
+# Seconds a push request waits for its message to be handled. Keep it below the
+# subscription's ack deadline
+SERVER_REQUEST_TIMEOUT = float(os.environ.get("SERVER_REQUEST_TIMEOUT", "30"))
+# Seconds between metrics log lines and spend history writes
+METRICS_FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", "60"))
+# Seconds a successful mysql readiness check is trusted for
+READY_CHECK_INTERVAL = 10
+
+
+class Job:
+    def __init__(self, data, message_id):
+        self.data = data
+        self.message_id = message_id
+        self.done = threading.Event()
+        self.error = None
+        self.queued = time.perf_counter()
+
+
+class WorkerPool:
+    """Fixed number of threads handling pubsub messages from a bounded queue."""
+
+    def __init__(self, workers, queue_size):
+        self.jobs = queue.Queue(maxsize=queue_size)
+        self.threads = [
+            threading.Thread(target=self._work, name=f"worker-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, data, message_id=None):
+        """Queues a message. Returns the Job, or None when the queue is full."""
+        job = Job(data, message_id)
+        try:
+            self.jobs.put_nowait(job)
+        except queue.Full:
+            return None
+        return job
+
+    def _work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            metrics.timing(
+                "server_queue_wait", (time.perf_counter() - job.queued) * 1000
+            )
+            try:
+                handle_notification(job.data, job.message_id)
+            except Exception as err:
+                job.error = err
+            finally:
+                metrics.timing(
+                    "server_handle", (time.perf_counter() - job.queued) * 1000
+                )
+                job.done.set()
+
+    def alive(self):
+        return all(thread.is_alive() for thread in self.threads)
+
+    def has_room(self):
+        return not self.jobs.full()
+
+    def stop(self, timeout=None):
+        """Lets queued jobs finish, then stops the workers."""
+        for _ in self.threads:
+            self.jobs.put(None)
+        for thread in self.threads:
+            thread.join(timeout)
+
+
+class ReadinessCheck:
+    def __init__(self, pool):
+        self.pool = pool
+        self.lock = threading.Lock()
+        self.checked_at = None
+
+    def mysql_ok(self):
+        with self.lock:
+            if (
+                self.checked_at is not None
+                and time.monotonic() - self.checked_at < READY_CHECK_INTERVAL
+            ):
+                return True
+            try:
+                with get_mysql_pool().connection() as mysql_conn:
+                    mysql_conn.ping(reconnect=True)
+            except Exception as err:
+                print(f"Readiness check failed: {err}")
+                self.checked_at = None
+                return False
+            self.checked_at = time.monotonic()
+            return True
+
+    def ready(self):
+        return self.pool.alive() and self.pool.has_room() and self.mysql_ok()
+
+
+class PushHandler(BaseHTTPRequestHandler):
+    # Set by make_server
+    pool = None
+    readiness = None
+
+    def _respond(self, status, body=b""):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/healthz":
+            self._respond(200, b"ok")
+        elif self.path == "/readyz":
+            if self.readiness.ready():
+                self._respond(200, b"ready")
+            else:
+                self._respond(503, b"not ready")
+        else:
+            self._respond(404)
+
+    def do_POST(self):
+        if self.path != "/":
+            self._respond(404)
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            envelope = json.loads(self.rfile.read(length))
+            message = envelope["message"]
+            data = {"attributes": message["attributes"], "data": message["data"]}
+            message_id = message.get("messageId") or message.get("message_id")
+        except (KeyError, TypeError, ValueError) as err:
+            # Redelivering won't fix a malformed push, ack it
+            metrics.incr("server_malformed_count")
+            print(f"Dropped malformed push: {err}")
+            self._respond(204)
+            return
+
+        job = self.pool.submit(data, message_id)
+        if job is None:
+            metrics.incr("server_rejected_count")
+            self._respond(429, b"queue full")
+            return
+
+        if not job.done.wait(SERVER_REQUEST_TIMEOUT):
+            metrics.incr("server_timeout_count")
+            self._respond(503, b"timed out")
+        elif job.error is not None:
+            metrics.incr("server_error_count")
+            self._respond(500, str(job.error).encode("utf-8"))
+        else:
+            metrics.incr("server_handled_count")
+            self._respond(204)
+
+    def log_message(self, format, *args):
+        # Successful requests are counted in metrics rather than logged one by one
+        pass
+
+
+def make_server(port, pool):
+    handler = type(
+        "Handler",
+        (PushHandler,),
+        {"pool": pool, "readiness": ReadinessCheck(pool)},
+    )
+    server = ThreadingHTTPServer(("", port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def alert_forecasts_periodically(stop):
+    while not stop.wait(FORECAST_ALERT_INTERVAL):
+        alert_forecasts()
+
+
+def flush_metrics_periodically(stop):
+    while not stop.wait(METRICS_FLUSH_INTERVAL):
+        spend_history.flush()
+        metrics.flush()
+
+
+if __name__ == "__main__":
+    stop = threading.Event()
+    digest = enable_slack_digest()
+    pool = WorkerPool(SERVER_WORKERS, SERVER_QUEUE_SIZE)
+    server = make_server(PORT, pool)
+
+    def shutdown(signum, frame):
+        # serve_forever() must be stopped from another thread
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    threading.Thread(
+        target=flush_metrics_periodically, args=(stop,), name="metrics", daemon=True
+    ).start()
+    if FORECAST_ALERT_INTERVAL:
+        threading.Thread(
+            target=alert_forecasts_periodically,
+            args=(stop,),
+            name="forecasts",
+            daemon=True,
+        ).start()
+
+    print(
+        f"Listening on port {PORT} with {SERVER_WORKERS} workers, "
+        f"queue size {SERVER_QUEUE_SIZE}"
+    )
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        pool.stop(timeout=SERVER_REQUEST_TIMEOUT)
+        if digest is not None:
+            digest.close(timeout=30)
+        stop.set()
+        spend_history.flush()
+        metrics.flush()
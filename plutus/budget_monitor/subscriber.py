@@ -0,0 +1,249 @@
+"""
+Long lived pubsub pull subscriber, an alternative entrypoint to the process_pubsub cloud
+function. Messages are pulled in batches, and each batch is handled together:
+
+* notifications for the same budget are coalesced, keeping the highest threshold
+* alert slots are claimed and routing looked up for the whole batch in one transaction
+* emails go out through ses bulk sending
+* the batch is acked in a single call
+
+Run with e.g. PUBSUB_SUBSCRIPTION=projects/p/subscriptions/s python subscriber.py
+Set PUBSUB_EMULATOR_HOST to use the pubsub emulator, or PUBSUB_LOCAL=1 for the in memory
+stand-in in local_pubsub.py.
+"""
+
+import json
+import os
+import signal
+import threading
+import time
+
+from main import (
+    alert_cache,
+    alert_forecasts,
+    build_alert,
+    claim_alerts,
+    claim_incidents,
+    Deliveries,
+    DeliveryError,
+    EMAIL_TIMEOUT,
+    enable_slack_digest,
+    FORECAST_ALERT_INTERVAL,
+    metrics,
+    PAGERDUTY_TIMEOUT,
+    post_to_channel,
+    processed_messages,
+    queue_slack_alert,
+    recently_alerted,
+    release_incidents,
+    send_bulk_email,
+    send_pagerduty_alert,
+    spend_history,
+)
+
+PUBSUB_SUBSCRIPTION = os.environ.get("PUBSUB_SUBSCRIPTION")
+PUBSUB_LOCAL = os.environ.get("PUBSUB_LOCAL") == "1"
+# Max messages per pull, i.e. per batch
+PULL_MAX_MESSAGES = int(os.environ.get("PULL_MAX_MESSAGES", "100"))
+# Seconds a pull waits for messages
+PULL_TIMEOUT = float(os.environ.get("PULL_TIMEOUT", "30"))
+
+
+def coalesce(alerts):
+    """Keeps one alert per budget, the one with the highest threshold (then cost)."""
+    latest = {}
+    for alert in alerts:
+        current = latest.get(alert.full_budget_id)
+        if current is None or (alert.threshold, alert.cost_amount) > (
+            current.threshold,
+            current.cost_amount,
+        ):
+            latest[alert.full_budget_id] = alert
+    return list(latest.values())
+
+
+def send_emails(emails):
+    failures = send_bulk_email(emails)
+    if failures:
+        raise DeliveryError(f"{len(failures)} of {len(emails)} emails rejected")
+
+
+def process_batch(alerts):
+    """
+    Sends a batch of alerts.
+
+    Returns a list of delivery failure messages. Raises if the alerts couldn't be claimed,
+    in which case the batch should be redelivered.
+    """
+    unique = coalesce(alerts)
+    metrics.incr("batch_coalesced_count", len(alerts) - len(unique))
+
+    deliveries = Deliveries()
+    incident_claims, incidents = {}, []
+    try:
+        # Only trigger pagerduty when a higher threshold is exceeded
+        incident_claims = claim_incidents(unique)
+        for alert in unique:
+            if alert.full_budget_id in incident_claims:
+                future = deliveries.submit(
+                    "pagerduty",
+                    PAGERDUTY_TIMEOUT,
+                    send_pagerduty_alert,
+                    alert.message,
+                    alert.budget_id,
+                )
+                incidents.append((alert, future))
+
+        pending = []
+        for alert in unique:
+            if recently_alerted(alert_cache.get(alert.full_budget_id)):
+                metrics.incr("alert_suppressed_count")
+            else:
+                pending.append(alert)
+
+        claims = claim_alerts([alert.full_budget_id for alert in pending])
+
+        emails = []
+        for alert in pending:
+            claimed, routing = claims[alert.full_budget_id]
+            if not claimed:
+                continue
+            queue_slack_alert(deliveries, alert, routing)
+            if routing.emails is not None:
+                emails.append(
+                    (routing.emails.split(","), alert.message, alert.project_id)
+                )
+
+        if emails:
+            deliveries.submit("email", EMAIL_TIMEOUT, send_emails, emails)
+    finally:
+        failures = deliveries.wait()
+        # So the next notification of the budget triggers again
+        release_incidents(
+            [alert for alert, future in incidents if not Deliveries.delivered(future)],
+            incident_claims,
+        )
+
+    return failures
+
+
+def handle_batch(client, subscription, received):
+    """Processes pulled messages and acks them. Returns True if the batch was acked."""
+    metrics.incr("batch_message_count", len(received))
+    # (message_id, attrs, data, alert), alert is None for routine notifications
+    notifications = []
+    for received_message in received:
+        message = received_message.message
+        try:
+            attrs = dict(message.attributes)
+            data = json.loads(message.data)
+            alert = build_alert(attrs, data)
+        except (KeyError, ValueError) as err:
+            # Redelivering won't fix it. Report it and ack it with the rest of the batch
+            metrics.incr("batch_malformed_count")
+            post_to_channel(
+                f"Plutus dropped malformed message {message.message_id}: {err}"
+            )
+            continue
+        # Without spend history routine notifications have no side effects to repeat
+        if alert is not None or spend_history.enabled:
+            notifications.append((message.message_id, attrs, data, alert))
+
+    message_ids = [notification[0] for notification in notifications]
+    with processed_messages.in_flight(message_ids) as mine:
+        try:
+            # Skip messages that were already handled, e.g. redelivered after an ack
+            seen = processed_messages.seen(mine) if mine else set()
+            # Keyed by message id, so a message pulled twice in one batch counts once
+            notifications = list(
+                {
+                    n[0]: n for n in notifications if n[0] in mine and n[0] not in seen
+                }.values()
+            )
+            failures = process_batch([n[3] for n in notifications if n[3] is not None])
+            for _, attrs, data, _ in notifications:
+                spend_history.record(attrs, data)
+        except Exception as err:
+            # Not acked, so pubsub redelivers the batch after the ack deadline
+            metrics.incr("batch_error_count")
+            post_to_channel(f"Plutus batch notify failed: {err}")
+            return False
+        finally:
+            # One history insert per batch, after its alerts went out
+            spend_history.flush()
+            metrics.flush()
+
+        # The batch is acked either way, so its messages count as handled. A failed
+        # pagerduty trigger was given back, for the budget's next notification to retry
+        if notifications:
+            processed_messages.mark([n[0] for n in notifications])
+        if failures:
+            post_to_channel(f"Plutus budget notify failed: {'; '.join(failures)}")
+
+    client.acknowledge(
+        request={
+            "subscription": subscription,
+            "ack_ids": [received_message.ack_id for received_message in received],
+        }
+    )
+    return True
+
+
+def run(client, subscription, max_messages=PULL_MAX_MESSAGES, stop=None):
+    """Pulls and handles batches until stop is set."""
+    stop = stop or threading.Event()
+    print(f"Pulling up to {max_messages} messages at a time from {subscription}")
+    forecasts_checked = time.monotonic()
+    while not stop.is_set():
+        if (
+            FORECAST_ALERT_INTERVAL
+            and time.monotonic() - forecasts_checked >= FORECAST_ALERT_INTERVAL
+        ):
+            forecasts_checked = time.monotonic()
+            alert_forecasts()
+
+        try:
+            response = client.pull(
+                request={"subscription": subscription, "max_messages": max_messages},
+                timeout=PULL_TIMEOUT,
+            )
+        except Exception as err:
+            # Includes deadline exceeded on an idle subscription
+            print(f"Pull failed: {err}")
+            stop.wait(1)
+            continue
+
+        if response.received_messages:
+            try:
+                handle_batch(client, subscription, response.received_messages)
+            except Exception as err:
+                # e.g. slack failing while a failure is reported. The batch wasn't acked,
+                # so it is redelivered, and this thread keeps pulling
+                metrics.incr("batch_error_count")
+                print(f"Handling batch failed: {err}")
+
+
+def get_subscriber_client():
+    if PUBSUB_LOCAL:
+        from local_pubsub import LocalSubscriber
+
+        return LocalSubscriber()
+
+    from google.cloud import pubsub_v1
+
+    return pubsub_v1.SubscriberClient()
+
+
+if __name__ == "__main__":
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+
+    digest = enable_slack_digest()
+    client = get_subscriber_client()
+    try:
+        run(client, PUBSUB_SUBSCRIPTION, stop=stop)
+    finally:
+        client.close()
+        if digest is not None:
+            digest.close(timeout=30)
@@ -0,0 +1,77 @@
+"""
+Circuit breakers for the GCP APIs plutus calls. When an API degrades, every project's call
+would otherwise wait out its full retry policy, so a run takes an hour and achieves nothing.
+After threshold consecutive failures a breaker opens, and calls through it fail fast with
+CircuitOpenError: for the rest of the run, or for cooldown seconds in long running
+processes, after which one call is let through to probe the API.
+
+Only failures that say the API itself is struggling count: server errors, deadlines,
+throttling and exhausted retries. A 404 or a bad request is the caller's problem.
+"""
+
+from google.api_core.exceptions import RetryError, ServerError, TooManyRequests
+from plutus.lib.constants import APP
+from plutus.lib.exceptions import CircuitOpenError
+import logging
+import markus
+import threading
+import time
+
+log = logging.getLogger(f"{APP}.circuit_breaker")
+metrics = markus.get_metrics(f"{APP}.circuit_breaker")
+
+BREAKER_ERRORS = (RetryError, ServerError, TooManyRequests)
+
+
+class CircuitBreaker:
+    def __init__(self, name, threshold=5, cooldown=None):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def open(self):
+        with self._lock:
+            return self._is_open()
+
+    def _is_open(self):
+        if self.opened_at is None:
+            return False
+        if self.cooldown is None:
+            return True
+        return time.monotonic() - self.opened_at < self.cooldown
+
+    def call(self, func, *args, **kwargs):
+        """Calls func through the breaker. Raises CircuitOpenError if it is open."""
+        with self._lock:
+            if self._is_open():
+                metrics.incr("rejected_count", tags=[f"api:{self.name}"])
+                raise CircuitOpenError(
+                    f"{self.name} API circuit breaker open after {self.failures} failures"
+                )
+
+        try:
+            result = func(*args, **kwargs)
+        except BREAKER_ERRORS:
+            self._record_failure()
+            raise
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+        return result
+
+    def _record_failure(self):
+        with self._lock:
+            self.failures += 1
+            # A failed probe after the cooldown opens it again right away
+            if self.failures >= self.threshold:
+                if self.opened_at is None:
+                    log.error(
+                        f"Opening {self.name} API circuit breaker after "
+                        f"{self.failures} consecutive failures"
+                    )
+                    metrics.incr("opened_count", tags=[f"api:{self.name}"])
+                self.opened_at = time.monotonic()
@@ -0,0 +1,293 @@
+"""
+Google API clients, created once per process and shared. All clients use the same
+application default credentials, and each gRPC API gets a pool of tuned channels instead of
+every client negotiating its own credentials, TLS and connection.
+
+A gRPC channel is one HTTP/2 connection, which multiplexes calls up to the server's limit
+on concurrent streams (usually 100). With pool_size > 1, unary calls are spread round robin
+over pool_size channels, each its own connection, for more concurrent calls than that.
+Keepalive pings keep idle connections from being dropped between runs of calls.
+
+Every channel is intercepted to report per API call counts, errors, latency and calls in
+flight, and connectivity state changes, as metrics.
+"""
+
+from plutus.lib.constants import APP
+import google.auth
+import grpc
+import itertools
+import logging
+import markus
+import threading
+import time
+
+log = logging.getLogger(f"{APP}.clients")
+metrics = markus.get_metrics(f"{APP}.clients")
+
+SCOPES = ["https://www.googleapis.com/auth/cloud-platform"]
+
+# Defaults, see configure()
+POOL_SIZE = 1
+KEEPALIVE_TIME_MS = 30000
+KEEPALIVE_TIMEOUT_MS = 10000
+
+_lock = threading.Lock()
+_settings = {
+    "pool_size": POOL_SIZE,
+    "keepalive_time_ms": KEEPALIVE_TIME_MS,
+    "keepalive_timeout_ms": KEEPALIVE_TIMEOUT_MS,
+}
+_credentials = None
+_clients = {}
+_pools = {}
+
+
+def configure(pool_size=None, keepalive_time_ms=None, keepalive_timeout_ms=None):
+    """Sets channel options for clients created afterwards."""
+    for key, value in (
+        ("pool_size", pool_size),
+        ("keepalive_time_ms", keepalive_time_ms),
+        ("keepalive_timeout_ms", keepalive_timeout_ms),
+    ):
+        if value is not None:
+            _settings[key] = int(value)
+
+
+def channel_options():
+    return [
+        ("grpc.keepalive_time_ms", _settings["keepalive_time_ms"]),
+        ("grpc.keepalive_timeout_ms", _settings["keepalive_timeout_ms"]),
+        ("grpc.keepalive_permit_without_calls", 1),
+        ("grpc.http2.max_pings_without_data", 0),
+        # Otherwise channels with the same target share subchannels, i.e. one connection
+        ("grpc.use_local_subchannel_pool", 1),
+        # Unlimited, list responses of thousands of budgets or projects can be large
+        ("grpc.max_receive_message_length", -1),
+    ]
+
+
+def credentials():
+    """Returns (credentials, project) of the application default credentials."""
+    global _credentials
+    if _credentials is None:
+        with _lock:
+            if _credentials is None:
+                _credentials = google.auth.default(scopes=SCOPES)
+    return _credentials
+
+
+class ChannelStats(grpc.UnaryUnaryClientInterceptor):
+    """Reports metrics for the unary calls on a channel, tagged with its API."""
+
+    def __init__(self, api):
+        self.api = api
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def intercept_unary_unary(self, continuation, client_call_details, request):
+        with self._lock:
+            self.calls += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        started = time.perf_counter()
+        try:
+            outcome = continuation(client_call_details, request)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+        metrics.timing(
+            "rpc_time",
+            (time.perf_counter() - started) * 1000,
+            tags=[f"type:{self.api}"],
+        )
+        metrics.incr("rpc_count", tags=[f"type:{self.api}"])
+        if outcome.exception() is not None:
+            metrics.incr("rpc_error_count", tags=[f"type:{self.api}"])
+        return outcome
+
+
+class _PooledMultiCallable:
+    def __init__(self, callables, counter):
+        self.callables = callables
+        self.counter = counter
+
+    def _next(self):
+        return self.callables[next(self.counter) % len(self.callables)]
+
+    def __call__(self, *args, **kwargs):
+        return self._next()(*args, **kwargs)
+
+    def with_call(self, *args, **kwargs):
+        return self._next().with_call(*args, **kwargs)
+
+    def future(self, *args, **kwargs):
+        return self._next().future(*args, **kwargs)
+
+
+class ChannelPool(grpc.Channel):
+    """
+    grpc.Channel spreading unary calls round robin over channels. Streaming calls, which
+    plutus doesn't make, all go to the first channel.
+    """
+
+    def __init__(self, api, channels, stats):
+        self.api = api
+        self.channels = channels
+        self.stats = stats
+        self.states = {}
+        self._counter = itertools.count()
+        for index, channel in enumerate(channels):
+            channel.subscribe(self._state_callback(index))
+
+    def _state_callback(self, index):
+        def callback(state):
+            self.states[index] = state
+            metrics.incr(
+                f"channel_{state.name.lower()}_count", tags=[f"type:{self.api}"]
+            )
+
+        return callback
+
+    def unary_unary(self, method, *args, **kwargs):
+        return _PooledMultiCallable(
+            [c.unary_unary(method, *args, **kwargs) for c in self.channels],
+            self._counter,
+        )
+
+    def unary_stream(self, method, *args, **kwargs):
+        return self.channels[0].unary_stream(method, *args, **kwargs)
+
+    def stream_unary(self, method, *args, **kwargs):
+        return self.channels[0].stream_unary(method, *args, **kwargs)
+
+    def stream_stream(self, method, *args, **kwargs):
+        return self.channels[0].stream_stream(method, *args, **kwargs)
+
+    def subscribe(self, callback, try_to_connect=False):
+        self.channels[0].subscribe(callback, try_to_connect)
+
+    def unsubscribe(self, callback):
+        self.channels[0].unsubscribe(callback)
+
+    def close(self):
+        for channel in self.channels:
+            channel.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+
+def channel_pool(api, transport_cls):
+    """Returns api's ChannelPool, creating it with transport_cls.create_channel()."""
+    with _lock:
+        pool = _pools.get(api)
+        if pool is None:
+            creds, _ = credentials()
+            stats = ChannelStats(api)
+            channels = [
+                grpc.intercept_channel(
+                    transport_cls.create_channel(
+                        credentials=creds, options=channel_options()
+                    ),
+                    stats,
+                )
+                for _ in range(_settings["pool_size"])
+            ]
+            pool = _pools[api] = ChannelPool(api, channels, stats)
+        return pool
+
+
+def _client(api, create):
+    client = _clients.get(api)
+    if client is None:
+        client = create()
+        with _lock:
+            client = _clients.setdefault(api, client)
+    return client
+
+
+def billing_client():
+    from google.cloud.billing.budgets_v1.services.budget_service import (
+        BudgetServiceClient,
+    )
+    from google.cloud.billing.budgets_v1.services.budget_service.transports import (
+        BudgetServiceGrpcTransport,
+    )
+
+    return _client(
+        "billing",
+        lambda: BudgetServiceClient(
+            transport=BudgetServiceGrpcTransport(
+                channel=channel_pool("billing", BudgetServiceGrpcTransport)
+            )
+        ),
+    )
+
+
+def projects_client():
+    from google.cloud.resourcemanager_v3 import ProjectsClient
+    from google.cloud.resourcemanager_v3.services.projects.transports import (
+        ProjectsGrpcTransport,
+    )
+
+    return _client(
+        "resourcemanager",
+        lambda: ProjectsClient(
+            transport=ProjectsGrpcTransport(
+                channel=channel_pool("resourcemanager", ProjectsGrpcTransport)
+            )
+        ),
+    )
+
+
+def asset_client():
+    from google.cloud.asset_v1 import AssetServiceClient
+    from google.cloud.asset_v1.services.asset_service.transports import (
+        AssetServiceGrpcTransport,
+    )
+
+    return _client(
+        "asset",
+        lambda: AssetServiceClient(
+            transport=AssetServiceGrpcTransport(
+                channel=channel_pool("asset", AssetServiceGrpcTransport)
+            )
+        ),
+    )
+
+
+def storage_client():
+    from google.cloud import storage
+
+    def create():
+        creds, project = credentials()
+        return storage.Client(project=project, credentials=creds)
+
+    return _client("storage", create)
+
+
+def report_channel_stats():
+    """Gauges each API's channel count, calls and peak calls in flight since the last report."""
+    with _lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        tags = [f"type:{pool.api}"]
+        with pool.stats._lock:
+            calls, max_in_flight = pool.stats.calls, pool.stats.max_in_flight
+            pool.stats.calls = 0
+            pool.stats.max_in_flight = pool.stats.in_flight
+        ready = sum(
+            1
+            for state in pool.states.values()
+            if state == grpc.ChannelConnectivity.READY
+        )
+        metrics.gauge("channel_count", len(pool.channels), tags=tags)
+        metrics.gauge("channel_ready_count", ready, tags=tags)
+        metrics.gauge("channel_call_count", calls, tags=tags)
+        metrics.gauge("channel_max_in_flight", max_in_flight, tags=tags)
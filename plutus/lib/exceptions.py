@@ -0,0 +1,24 @@
+class PlutusError(Exception):
+    """Base class for plutus errors."""
+
+
+class ProjectError(PlutusError):
+    """
+    Raised when a single project's budget cannot be reconciled, e.g. the project is missing,
+    its budgets cannot be listed or its config is invalid. The budget manager records it in
+    the run report and moves on to the next project.
+    """
+
+
+class MigrationError(PlutusError):
+    """
+    Raised when a schema migration fails. The budget manager doesn't run against a schema
+    it couldn't migrate.
+    """
+
+
+class CircuitOpenError(ProjectError):
+    """
+    Raised instead of calling a GCP API whose circuit breaker is open. The project is
+    skipped rather than failed, and retried on the next run.
+    """
@@ -0,0 +1,234 @@
+"""
+Month end spend projections and burn rate anomalies for every budget, from the spend_hourly
+rollup of the budget monitor's spend history.
+
+All budgets' recent hourly series are loaded into flat numpy arrays, sorted by budget, and
+every statistic is computed per budget with bincount/reduceat over the whole array, so the
+cost of a run grows with the number of rows rather than with a python loop per budget.
+
+For each budget, within its latest budget period:
+
+* burn_rate      cost per hour over the window, a least squares fit of the hourly costs
+* baseline_rate  cost per hour since the period started
+* projected_cost latest cost plus burn_rate until the period ends
+* anomaly        burn_rate is over anomaly_ratio times baseline_rate
+"""
+
+from collections import namedtuple
+from plutus.lib.constants import APP
+from pymysql.err import Error
+import datetime
+import logging
+import markus
+import numpy as np
+import time
+
+log = logging.getLogger(f"{APP}.forecast")
+metrics = markus.get_metrics(f"{APP}.forecast")
+
+# Hours of spend_hourly used to fit the burn rate
+WINDOW_HOURS = 24
+# A burn rate this many times the period's average is flagged as an anomaly
+ANOMALY_RATIO = 3.0
+# Hourly points needed before a budget can be flagged as an anomaly
+MIN_POINTS = 3
+
+SECONDS_PER_HOUR = 3600.0
+
+
+class Series:
+    """
+    Hourly spend of many budgets as flat arrays. Rows are (budget_id, bucket, period_start,
+    cost, budget_amount), times in seconds since the epoch, each budget's rows together and
+    ordered by bucket.
+    """
+
+    def __init__(self, rows):
+        budget_ids, buckets, periods, costs, amounts = zip(*rows) if rows else ([],) * 5
+        budget_ids = np.array(budget_ids, dtype=str)
+        # Rows are grouped by budget, so a budget starts wherever the id changes
+        changed = budget_ids[1:] != budget_ids[:-1]
+        self.index = (
+            np.r_[0, np.cumsum(changed)] if len(budget_ids) else np.zeros(0, int)
+        )
+        self.budget_ids = (
+            budget_ids[np.r_[True, changed]] if len(budget_ids) else budget_ids
+        )
+        self.buckets = np.array(buckets, dtype=np.int64)
+        self.periods = np.array(periods, dtype=np.int64)
+        self.costs = np.array(costs, dtype=np.float64)
+        self.amounts = np.array(amounts, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.budget_ids)
+
+
+# Per budget results, arrays aligned with budget_ids
+Forecasts = namedtuple(
+    "Forecasts",
+    [
+        "budget_ids",
+        "period_start",
+        "cost_amount",
+        "budget_amount",
+        "burn_rate",
+        "baseline_rate",
+        "projected_cost",
+        "anomaly",
+        "points",
+    ],
+)
+
+
+def forecast_rows(forecasts, computed):
+    """Returns forecasts as spend_forecasts rows of plain python values."""
+    period_starts = forecasts.period_start.astype(object).tolist()
+    return list(
+        zip(
+            forecasts.budget_ids.tolist(),
+            period_starts,
+            [computed] * len(period_starts),
+            forecasts.cost_amount.tolist(),
+            forecasts.budget_amount.tolist(),
+            forecasts.burn_rate.tolist(),
+            forecasts.baseline_rate.tolist(),
+            forecasts.projected_cost.tolist(),
+            forecasts.anomaly.tolist(),
+            forecasts.points.tolist(),
+        )
+    )
+
+
+def load_series(mysql_cursor, since):
+    """Loads every budget's hourly spend from since onwards."""
+    # Epoch seconds straight from mysql, independent of the session time zone, are much
+    # cheaper to load into numpy than datetimes
+    sql = """SELECT budget_id,
+TIMESTAMPDIFF(SECOND, '1970-01-01', bucket),
+TIMESTAMPDIFF(SECOND, '1970-01-01', period_start),
+max_cost, budget_amount
+FROM spend_hourly
+WHERE bucket >= %s
+ORDER BY budget_id, bucket
+"""
+    mysql_cursor.execute(sql, (since,))
+    return Series(mysql_cursor.fetchall())
+
+
+def forecast(series, now, anomaly_ratio=ANOMALY_RATIO):
+    """Projects every budget in series to the end of its latest budget period."""
+    budgets = len(series)
+    if not budgets:
+        return None
+
+    index = series.index
+    first = np.flatnonzero(np.r_[True, index[1:] != index[:-1]])
+
+    # Costs restart with each budget period, only fit the budget's latest one
+    latest_period = np.maximum.reduceat(series.periods, first)
+    keep = series.periods == latest_period[index]
+    index = index[keep]
+    costs = series.costs[keep]
+    amounts = series.amounts[keep]
+    last = np.flatnonzero(np.r_[index[1:] != index[:-1], True])
+
+    # Least squares slope of cost over hours, from per budget sums
+    hours = (series.buckets[keep] - series.buckets.min()) / SECONDS_PER_HOUR
+    n = np.bincount(index, minlength=budgets).astype(np.float64)
+    sx = np.bincount(index, weights=hours, minlength=budgets)
+    sy = np.bincount(index, weights=costs, minlength=budgets)
+    sxx = np.bincount(index, weights=hours * hours, minlength=budgets)
+    sxy = np.bincount(index, weights=hours * costs, minlength=budgets)
+    denominator = n * sxx - sx * sx
+    with np.errstate(divide="ignore", invalid="ignore"):
+        slope = np.where(denominator > 0, (n * sxy - sx * sy) / denominator, 0.0)
+    # Credits can lower the cost, but a negative burn rate isn't a useful projection
+    burn_rate = np.maximum(slope, 0.0)
+
+    now_s = np.datetime64(now, "s").astype(np.int64)
+    period_start = latest_period.astype("datetime64[s]")
+    period_end = (
+        (period_start.astype("datetime64[M]") + 1)
+        .astype("datetime64[s]")
+        .astype(np.int64)
+    )
+    elapsed = np.maximum(now_s - latest_period, SECONDS_PER_HOUR) / SECONDS_PER_HOUR
+    remaining = np.maximum(period_end - now_s, 0) / SECONDS_PER_HOUR
+
+    cost_amount = costs[last]
+    baseline_rate = cost_amount / elapsed
+    return Forecasts(
+        budget_ids=series.budget_ids,
+        period_start=period_start,
+        cost_amount=cost_amount,
+        budget_amount=amounts[last],
+        burn_rate=burn_rate,
+        baseline_rate=baseline_rate,
+        projected_cost=cost_amount + burn_rate * remaining,
+        anomaly=(n >= MIN_POINTS) & (burn_rate > anomaly_ratio * baseline_rate),
+        points=n.astype(np.int64),
+    )
+
+
+def write_forecasts(mysql_cursor, forecasts, computed):
+    """
+    Upserts forecasts into spend_forecasts in one multi row statement. A budget's alerted
+    time is cleared when a new budget period starts, so the monitor alerts once per period.
+    """
+    # Assignments are evaluated left to right, so period_start has to come last
+    sql = """INSERT INTO spend_forecasts (
+budget_id, period_start, computed, cost_amount, budget_amount, burn_rate, baseline_rate,
+projected_cost, anomaly, points
+)
+VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+ON DUPLICATE KEY UPDATE
+alerted = IF(VALUES(period_start) > period_start, NULL, alerted),
+computed = VALUES(computed),
+cost_amount = VALUES(cost_amount),
+budget_amount = VALUES(budget_amount),
+burn_rate = VALUES(burn_rate),
+baseline_rate = VALUES(baseline_rate),
+projected_cost = VALUES(projected_cost),
+anomaly = VALUES(anomaly),
+points = VALUES(points),
+period_start = GREATEST(period_start, VALUES(period_start))"""
+    mysql_cursor.executemany(sql, forecast_rows(forecasts, computed))
+
+
+def run_forecast(
+    mysql_conn, now=None, window_hours=WINDOW_HOURS, anomaly_ratio=ANOMALY_RATIO
+):
+    """Forecasts every budget with spend history in the window. Returns the Forecasts."""
+    now = (now or datetime.datetime.utcnow()).replace(microsecond=0)
+    since = (now - datetime.timedelta(hours=window_hours)).replace(minute=0, second=0)
+    try:
+        with mysql_conn.cursor() as mysql_cursor:
+            started = time.perf_counter()
+            series = load_series(mysql_cursor, since)
+            loaded = time.perf_counter()
+            forecasts = forecast(series, now, anomaly_ratio)
+            computed = time.perf_counter()
+            if forecasts is not None:
+                write_forecasts(mysql_cursor, forecasts, now)
+            written = time.perf_counter()
+    except Error as err:
+        log.error(f"Error while forecasting spend: {err}")
+        metrics.incr("error_count", tags=["type:sql_forecast_err"])
+        return None
+
+    metrics.timing("load_time", (loaded - started) * 1000)
+    metrics.timing("compute_time", (computed - loaded) * 1000)
+    metrics.timing("write_time", (written - computed) * 1000)
+    if forecasts is None:
+        return None
+
+    metrics.gauge("budget_count", len(forecasts.budget_ids))
+    metrics.gauge("anomaly_count", int(forecasts.anomaly.sum()))
+    over = forecasts.projected_cost > forecasts.budget_amount
+    metrics.gauge("projected_over_count", int(over.sum()))
+    log.info(
+        f"Forecast {len(forecasts.budget_ids)} budgets from {len(series.costs)} hourly points: "
+        f"{int(over.sum())} projected over budget, {int(forecasts.anomaly.sum())} anomalies, "
+        f"computed in {(computed - loaded) * 1000:.1f} ms"
+    )
+    return forecasts
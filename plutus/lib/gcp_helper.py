@@ -1,33 +1,101 @@
+from plutus.lib.circuit_breaker import CircuitBreaker
 from plutus.lib.constants import APP
+from plutus.lib.exceptions import CircuitOpenError, ProjectError
+from plutus.lib.tracing import traced
 import copy
 import logging
 import markus
 
 import json
 import re
-import sys
+from google.api_core import retry as retries
 from google.api_core.exceptions import GoogleAPICallError, RetryError
 from google.protobuf.json_format import MessageToDict
 
 metrics = markus.get_metrics(APP + ".gcphelper")
 
+API_BILLING = "billing"
+API_RESOURCE_MANAGER = "resourcemanager"
+API_ASSET = "asset"
+
+# Seconds a call may take, retries included, per method
+DEFAULT_DEADLINES = {
+    "search_projects": 60,
+    "get_project": 30,
+    "get_iam_policy": 30,
+    "list_projects": 60,
+    "search_all_resources": 60,
+    "list_budgets": 60,
+    "create_budget": 30,
+    "update_budget": 30,
+    "delete_budget": 30,
+}
+
+
+def parse_deadlines(overrides):
+    """Returns DEFAULT_DEADLINES updated with "method=seconds,..." overrides."""
+    deadlines = dict(DEFAULT_DEADLINES)
+    for override in filter(None, (o.strip() for o in overrides.split(","))):
+        method, seconds = override.split("=")
+        if method not in deadlines:
+            raise ValueError(f"Unknown GCP method {method}")
+        deadlines[method] = float(seconds)
+    return deadlines
+
 
 class GcpHelper:
     """
     Uses GCP billing budget and resource manager clients to get, update, and create budgets
     """
 
-    def __init__(self, billing_client, resource_manager_client):
+    def __init__(
+        self,
+        billing_client,
+        resource_manager_client,
+        deadlines=None,
+        breaker_threshold=5,
+        breaker_cooldown=None,
+    ):
         self.billing_client = billing_client
         self.resource_manager_client = resource_manager_client
         self.logger = logging.getLogger(APP + ".gcphelper")
+        self.deadlines = deadlines or DEFAULT_DEADLINES
+        self.breakers = {
+            api: CircuitBreaker(api, breaker_threshold, breaker_cooldown)
+            for api in (API_BILLING, API_RESOURCE_MANAGER, API_ASSET)
+        }
+
+    def call(self, api, method, func, paged=False, **kwargs):
+        """
+        Calls func(**kwargs), a GCP client method, through api's circuit breaker and within
+        the method's deadline. Pass paged=True for list methods, to fetch every page
+        through the breaker; their results are returned as a list.
+        """
+        deadline = self.deadlines[method]
+
+        def request():
+            result = func(
+                retry=retries.Retry(
+                    predicate=retries.if_transient_error, deadline=deadline
+                ),
+                timeout=deadline,
+                **kwargs,
+            )
+            return list(result) if paged else result
 
+        return self.breakers[api].call(request)
+
+    @traced("gcp.get_project_number")
     def get_project_number(self, project_id):
         """Given a GCP project id, return the associated GCP project number."""
         # Ensure that the configured project_id actually exists in GCP
         try:
-            page_result = self.resource_manager_client.search_projects(
-                query=f"projectId:{project_id}"
+            page_result = self.call(
+                API_RESOURCE_MANAGER,
+                "search_projects",
+                self.resource_manager_client.search_projects,
+                paged=True,
+                query=f"projectId:{project_id}",
             )
             metrics.incr(
                 "gcp_api_request_count",
@@ -53,15 +121,19 @@ class GcpHelper:
                     self.logger.error(
                         f"Error matching regex while comparing {name} to regex:{regex}"
                     )
-                    sys.exit(1)
+                    raise ProjectError(f"Unexpected project name {name} for {project_id}")
             else:
                 self.logger.error(
                     f"search_projects() yielded a count of {response_count}, expected 1 only."
                 )
                 self.logger.error(f"page result was {page_result}")
-                sys.exit(1)
+                raise ProjectError(
+                    f"Found {response_count} projects matching {project_id}, expected 1"
+                )
 
             return project_number
+        except ProjectError:
+            raise
         except Exception as err:
             self.logger.error(
                 f"Error fetching project {project_id}: {err}. Double check config."
@@ -73,10 +145,9 @@ class GcpHelper:
                     f"project_id:{project_id}",
                 ],
             )
-            sys.exit(1)
-
-        return None
+            raise ProjectError(f"Error fetching project {project_id}: {err}") from err
 
+    @traced("gcp.list_budgets")
     def get_budgets_by_project(self, project, project_number):
         """
         Retreives all budgets by project id & number. The Budgets API currently doesnt support this.
@@ -88,7 +159,13 @@ class GcpHelper:
             parent = self.billing_client.common_billing_account_path(
                 project.billing_account_id
             )
-            for budget in self.billing_client.list_budgets(parent=parent):
+            for budget in self.call(
+                API_BILLING,
+                "list_budgets",
+                self.billing_client.list_budgets,
+                paged=True,
+                parent=parent,
+            ):
                 if (
                     f"projects/{project.project_id}" in budget.budget_filter.projects
                     or f"projects/{project_number}" in budget.budget_filter.projects
@@ -99,6 +176,8 @@ class GcpHelper:
                 "gcp_api_request_count",
                 tags=["type:billing.list", f"project_id:{project.project_id}"],
             )
+        except CircuitOpenError:
+            raise
         except Exception as err:
             self.logger.error(
                 f"Error listing budgets for {project.billing_account_id}: {err}."
@@ -107,7 +186,9 @@ class GcpHelper:
                 "error_count",
                 tags=["type:billing.list_budgets", f"project_id:{project.project_id}"],
             )
-            sys.exit(1)
+            raise ProjectError(
+                f"Error listing budgets for {project.project_id}: {err}"
+            ) from err
 
         return budgets
 
@@ -160,6 +241,7 @@ class GcpHelper:
 
         return None
 
+    @traced("gcp.diff_budget")
     def sync_config_with_gcp_budget(self, project, budget_dict, project_number):
         """
         Takes as a parameter a budget_dict which is a dict representation of a gcp proto budget
@@ -339,8 +421,9 @@ class GcpHelper:
 
         return ret_val, changed_budget
 
+    @traced("gcp.create_budget")
     def create_budget(self, project):
-        """Creates a GCP budget."""
+        """Creates a GCP budget. Raises ProjectError if it fails."""
 
         self.logger.info(f"Creating new budget {project.display_name}...")
 
@@ -368,7 +451,7 @@ class GcpHelper:
                 "error_count",
                 tags=["type:misconfig", f"project_id:{project.project_id}"],
             )
-            return None
+            raise ProjectError(f"Unknown budget_type {project.budget_type}")
 
         threshold_rules = []
         for rule in project.threshold_rules:
@@ -404,7 +487,13 @@ class GcpHelper:
             self.logger.info(
                 f"Creating budget for parent: {parent},\n and budget: {budget}"
             )
-            response = self.billing_client.create_budget(parent=parent, budget=budget)
+            response = self.call(
+                API_BILLING,
+                "create_budget",
+                self.billing_client.create_budget,
+                parent=parent,
+                budget=budget,
+            )
             metrics.incr(
                 "gcp_api_request_count",
                 tags=["type:billing.create", f"project_id:{project.project_id}"],
@@ -422,6 +511,7 @@ class GcpHelper:
                     f"project_id:{project.project_id}",
                 ],
             )
+            raise ProjectError(f"Error creating budget: {err}") from err
         except RetryError as err:
             self.logger.error(
                 f"Request failed due to retryable error \
@@ -431,6 +521,7 @@ class GcpHelper:
                 "gcp_api_error_count",
                 tags=["type:billing.create.retry", f"project_id:{project.project_id}"],
             )
+            raise ProjectError(f"Error creating budget: {err}") from err
         except ValueError as err:
             self.logger.error(
                 f"Requst failed likely due to invalid parameters. ValueError: {err}"
@@ -439,9 +530,11 @@ class GcpHelper:
                 "gcp_api_error_count",
                 tags=["type:billing.create.value", f"project_id:{project.project_id}"],
             )
+            raise ProjectError(f"Error creating budget: {err}") from err
 
+    @traced("gcp.update_budget")
     def update_budget(self, changed_budget):
-        """Updates an existing GCP budget."""
+        """Updates an existing GCP budget. Raises ProjectError if it fails."""
 
         self.logger.info(f"Updating budget for {changed_budget['display_name']}...")
 
@@ -452,7 +545,12 @@ class GcpHelper:
             changed_budget["amount"]["specified_amount"]["units"] = int(
                 changed_budget["amount"]["specified_amount"]["units"]
             )
-            response = self.billing_client.update_budget(changed_budget_dict)
+            response = self.call(
+                API_BILLING,
+                "update_budget",
+                self.billing_client.update_budget,
+                request=changed_budget_dict,
+            )
             metrics.incr(
                 "gcp_api_request_count",
                 tags=[
@@ -473,6 +571,7 @@ class GcpHelper:
                     f"display_name:{changed_budget['display_name']}",
                 ],
             )
+            raise ProjectError(f"Error updating budget: {err}") from err
         except RetryError as err:
             self.logger.error(
                 f"Request failed due to retryable error \
@@ -485,6 +584,7 @@ class GcpHelper:
                     f"display_name:{changed_budget['display_name']}",
                 ],
             )
+            raise ProjectError(f"Error updating budget: {err}") from err
         except ValueError as err:
             self.logger.error(
                 f"Requst failed likely due to invalid parameters. ValueError: {err}"
@@ -496,12 +596,19 @@ class GcpHelper:
                     f"display_name:{changed_budget['display_name']}",
                 ],
             )
+            raise ProjectError(f"Error updating budget: {err}") from err
 
+    @traced("gcp.delete_budget")
     def delete_budget(self, budget_id):
         """Deletes an existing GCP budget."""
 
         self.logger.info(f"Deleting budget for {budget_id}...")
-        self.billing_client.delete_budget(name=budget_id)
+        self.call(
+            API_BILLING,
+            "delete_budget",
+            self.billing_client.delete_budget,
+            name=budget_id,
+        )
 
     def get_and_update_or_create_budget(self, project):
         """
@@ -543,9 +650,11 @@ class GcpHelper:
                         return new_budget
                     elif changed_budget is None:
                         self.logger.error(
-                            "Error while comparing config and gcp budget. Exiting..."
+                            "Error while comparing config and gcp budget. Skipping project..."
+                        )
+                        raise ProjectError(
+                            f"Error while comparing config and gcp budget {project.display_name}"
                         )
-                        sys.exit(1)
                     else:
                         self.logger.debug(
                             f"No changes with budget {budget_dict['display_name']}"
@@ -0,0 +1,169 @@
+"""
+Buffered, aggregating markus backend.
+
+Rather than sending one statsd packet per metrics.incr() call, BufferedMetrics aggregates
+records in process and emits them to a wrapped markus backend on flush():
+
+* incr - summed per (key, tags)
+* gauge - last value per (key, tags)
+* timing/histogram - emitted as {key}.count (incr), {key}.avg, {key}.max, {key}.p95 (gauges)
+
+Tags are run through a cardinality filter first. Tag keys on the allowlist pass through
+untouched. Other tags are dropped, or when tag_buckets > 0, their value is replaced by a
+stable hash bucket so per project tags collapse to a bounded number of series.
+"""
+
+from plutus.lib.constants import APP
+from markus.backends import BackendBase
+from markus.main import MetricsRecord
+from markus.utils import generate_tag
+import atexit
+import logging
+import math
+import threading
+import zlib
+
+log = logging.getLogger(f"{APP}.metrics")
+
+DEFAULT_TAG_ALLOWLIST = ["type", "config_type"]
+
+# All BufferedMetrics backends configured in this process, so flush_metrics() can find them
+_buffers = []
+
+
+def _load_class(clspath):
+    if not isinstance(clspath, str):
+        return clspath
+    modpath, clsname = clspath.rsplit(".", 1)
+    module = __import__(modpath, fromlist=[clsname])
+    return getattr(module, clsname)
+
+
+class TagCardinalityFilter:
+    """Drops or hash buckets the value of any tag whose key is not in allowlist."""
+
+    def __init__(self, allowlist=None, buckets=0):
+        self.allowlist = set(DEFAULT_TAG_ALLOWLIST if allowlist is None else allowlist)
+        self.buckets = buckets
+
+    def filter_tags(self, tags):
+        filtered = []
+        for tag in tags:
+            key, sep, value = tag.partition(":")
+            if key in self.allowlist:
+                filtered.append(tag)
+            elif self.buckets > 0 and sep:
+                bucket = zlib.crc32(value.encode("utf-8")) % self.buckets
+                filtered.append(generate_tag(key, f"bucket-{bucket}"))
+        return sorted(filtered)
+
+
+class BufferedMetrics(BackendBase):
+    """
+    Markus backend that aggregates metrics and emits them to an inner backend on flush.
+
+    Options:
+
+    * backend: markus backend config dict (class/options) for the backend to flush to
+    * tag_allowlist: tag keys to keep as is. Defaults to DEFAULT_TAG_ALLOWLIST
+    * tag_buckets: hash bucket count for non allowlisted tags. 0 drops them. Defaults to 0
+    * flush_interval: seconds between background flushes. 0 only flushes on flush_metrics()
+    """
+
+    def __init__(self, options=None, filters=None):
+        options = options or {}
+        self.filters = filters or []
+
+        inner = options["backend"]
+        self.backend = _load_class(inner["class"])(
+            options=inner.get("options", {}), filters=inner.get("filters", [])
+        )
+        self.tag_filter = TagCardinalityFilter(
+            allowlist=options.get("tag_allowlist"),
+            buckets=int(options.get("tag_buckets", 0)),
+        )
+        self.flush_interval = float(options.get("flush_interval", 0))
+
+        self._lock = threading.Lock()
+        self._reset()
+
+        self._stop = threading.Event()
+        if self.flush_interval > 0:
+            thread = threading.Thread(
+                target=self._flush_periodically, name="metrics-flush", daemon=True
+            )
+            thread.start()
+
+        _buffers.append(self)
+
+    def _reset(self):
+        self.counters = {}
+        self.gauges = {}
+        self.timings = {}
+
+    def emit(self, record):
+        key = (record.key, tuple(self.tag_filter.filter_tags(record.tags)))
+        with self._lock:
+            if record.stat_type == "incr":
+                self.counters[key] = self.counters.get(key, 0) + record.value
+            elif record.stat_type == "gauge":
+                self.gauges[key] = record.value
+            else:
+                self.timings.setdefault(key, []).append(record.value)
+
+    def _records(self, counters, gauges, timings):
+        for (stat, tags), value in counters.items():
+            yield MetricsRecord("incr", stat, value, list(tags))
+        for (stat, tags), value in gauges.items():
+            yield MetricsRecord("gauge", stat, value, list(tags))
+        for (stat, tags), values in timings.items():
+            values.sort()
+            # Nearest rank, the smallest value >= 95% of values
+            p95 = values[max(0, math.ceil(0.95 * len(values)) - 1)]
+            yield MetricsRecord("incr", f"{stat}.count", len(values), list(tags))
+            yield MetricsRecord(
+                "gauge", f"{stat}.avg", sum(values) / len(values), list(tags)
+            )
+            yield MetricsRecord("gauge", f"{stat}.max", values[-1], list(tags))
+            yield MetricsRecord("gauge", f"{stat}.p95", p95, list(tags))
+
+    def flush(self):
+        with self._lock:
+            counters, gauges, timings = self.counters, self.gauges, self.timings
+            self._reset()
+
+        # DogStatsd can pack several metrics per udp packet while its buffer is open
+        client = getattr(self.backend, "client", None)
+        buffered = client is not None and hasattr(client, "open_buffer")
+        if buffered:
+            client.open_buffer()
+        try:
+            count = 0
+            for record in self._records(counters, gauges, timings):
+                self.backend.emit_to_backend(record)
+                count = count + 1
+        finally:
+            if buffered:
+                client.close_buffer()
+
+        log.debug(f"Flushed {count} aggregated metrics")
+
+    def _flush_periodically(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as err:
+                log.warning(f"Periodic metrics flush failed: {err}")
+
+    def close(self):
+        self._stop.set()
+        self.flush()
+
+
+def flush_metrics():
+    """Flushes every BufferedMetrics backend. Call at the end of a run."""
+    for buffer in _buffers:
+        buffer.flush()
+
+
+atexit.register(flush_metrics)
@@ -0,0 +1,180 @@
+"""
+Versioned schema migrations. sql/tables.sql is the baseline schema, and every later change
+is a file in sql/migrations named <version>_<name>.sql, applied in version order by the
+budget manager at startup. Applied versions are recorded in the schema_version table.
+
+mysql can't roll back DDL, so a migration that failed halfway is applied again from its
+first statement. Errors meaning a statement was already applied (duplicate index or
+column, missing index to drop) are skipped, so migrations only need to be safe to rerun
+in that sense.
+"""
+
+from plutus.lib.constants import APP
+from plutus.lib.exceptions import MigrationError
+from plutus.lib.tracing import traced
+from pymysql.err import Error
+import datetime
+import hashlib
+import logging
+import markus
+import os
+import re
+
+log = logging.getLogger(f"{APP}.migrations")
+metrics = markus.get_metrics(f"{APP}.migrations")
+
+MIGRATIONS_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+    "sql",
+    "migrations",
+)
+MIGRATION_FILE = re.compile(r"^(\d+)_(\w+)\.sql$")
+
+# Duplicate column name, duplicate key name, can't drop a missing column or key
+ALREADY_APPLIED_ERRORS = {1060, 1061, 1091}
+NO_SUCH_TABLE_ERROR = 1146
+
+# Held while migrating, so managers starting together don't apply migrations twice
+LOCK_NAME = "plutus.migrations"
+LOCK_TIMEOUT = 300
+
+
+class Migration:
+    def __init__(self, version, name, sql):
+        self.version = version
+        self.name = name
+        self.sql = sql
+        self.checksum = hashlib.sha256(sql.encode("utf-8")).hexdigest()
+
+    def statements(self):
+        """
+        The migration's statements, without comments. Statements end with ';', or with
+        what a DELIMITER line sets, as in the mysql client, so that a stored procedure's
+        body can hold several statements.
+        """
+        statements = []
+        buffer = ""
+        delimiter = ";"
+        for line in self.sql.splitlines():
+            stripped = line.strip()
+            if not stripped or stripped.startswith("--"):
+                continue
+            if stripped.upper().startswith("DELIMITER "):
+                delimiter = stripped.split()[1]
+                continue
+            buffer += line + "\n"
+            while delimiter in buffer:
+                statement, buffer = buffer.split(delimiter, 1)
+                statements.append(statement.strip())
+        statements.append(buffer.strip())
+        return [statement for statement in statements if statement]
+
+
+def load_migrations(directory=MIGRATIONS_DIR):
+    """Returns the migrations in directory, in version order."""
+    migrations = {}
+    for filename in sorted(os.listdir(directory)):
+        match = MIGRATION_FILE.match(filename)
+        if match is None:
+            continue
+        version = int(match.group(1))
+        if version in migrations:
+            raise MigrationError(f"Duplicate migration version {version}: {filename}")
+        with open(os.path.join(directory, filename)) as f:
+            migrations[version] = Migration(version, match.group(2), f.read())
+    return [migrations[version] for version in sorted(migrations)]
+
+
+def create_version_table(mysql_cursor):
+    mysql_cursor.execute("""CREATE TABLE IF NOT EXISTS schema_version (
+version INT PRIMARY KEY NOT NULL,
+name VARCHAR(255) NOT NULL,
+checksum VARCHAR(64) NOT NULL,
+applied DATETIME NOT NULL
+)""")
+
+
+def applied_versions(mysql_cursor):
+    """Returns {version: checksum} of the applied migrations."""
+    try:
+        mysql_cursor.execute("SELECT version, checksum FROM schema_version")
+    except Error as err:
+        # Table doesn't exist, only on dry runs against a database never migrated
+        if err.args and err.args[0] == NO_SUCH_TABLE_ERROR:
+            return {}
+        raise
+    return dict(mysql_cursor.fetchall())
+
+
+def pending_migrations(migrations, applied):
+    pending = []
+    for migration in migrations:
+        checksum = applied.get(migration.version)
+        if checksum is None:
+            pending.append(migration)
+        elif checksum != migration.checksum:
+            # Applied migrations are history, changes go in a new migration
+            log.warning(
+                f"Migration {migration.version}_{migration.name} changed since it was applied"
+            )
+            metrics.incr("error_count", tags=["type:migration_changed"])
+    return pending
+
+
+def apply_migration(mysql_cursor, migration):
+    for statement in migration.statements():
+        try:
+            mysql_cursor.execute(statement)
+        except Error as err:
+            if err.args and err.args[0] in ALREADY_APPLIED_ERRORS:
+                log.info(f"Already applied, skipping: {err}")
+                continue
+            raise
+    mysql_cursor.execute(
+        "INSERT INTO schema_version (version, name, checksum, applied) "
+        "VALUES (%s, %s, %s, %s)",
+        (
+            migration.version,
+            migration.name,
+            migration.checksum,
+            datetime.datetime.utcnow(),
+        ),
+    )
+
+
+@traced("mysql.migrate")
+def migrate(mysql_conn, directory=MIGRATIONS_DIR, dry_run=False):
+    """
+    Applies pending migrations. Returns the migrations applied, or pending on a dry run.
+    Raises MigrationError if one fails or the migration lock couldn't be taken.
+    """
+    migrations = load_migrations(directory)
+    with mysql_conn.cursor() as mysql_cursor:
+        try:
+            if dry_run:
+                pending = pending_migrations(migrations, applied_versions(mysql_cursor))
+                for migration in pending:
+                    log.info(
+                        f"Dry run, not applying {migration.version}_{migration.name}"
+                    )
+                return pending
+
+            mysql_cursor.execute("SELECT GET_LOCK(%s, %s)", (LOCK_NAME, LOCK_TIMEOUT))
+            if mysql_cursor.fetchone()[0] != 1:
+                raise MigrationError("Timed out waiting for the migration lock")
+            try:
+                create_version_table(mysql_cursor)
+                # Read after taking the lock, another manager may have just migrated
+                pending = pending_migrations(migrations, applied_versions(mysql_cursor))
+                for migration in pending:
+                    log.info(f"Applying migration {migration.version}_{migration.name}")
+                    apply_migration(mysql_cursor, migration)
+                    metrics.incr("migration_applied_count")
+            finally:
+                mysql_cursor.execute("SELECT RELEASE_LOCK(%s)", (LOCK_NAME,))
+        except Error as err:
+            metrics.incr("error_count", tags=["type:sql_migration_err"])
+            raise MigrationError(f"Migration failed: {err}") from err
+
+    log.info(f"Schema up to date, {len(pending)} migrations applied")
+    return pending
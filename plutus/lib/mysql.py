@@ -1,23 +1,36 @@
 import datetime
-import google.auth
 import logging
 import markus
 import re
-import sys
+import uuid
 
 from plutus.lib.constants import APP
+from plutus.lib.exceptions import ProjectError
+from plutus.lib.gcp_helper import API_RESOURCE_MANAGER
+from plutus.lib.tracing import traced
 from pymysql.err import DatabaseError, Error, OperationalError
-from googleapiclient import discovery
 from google.protobuf.json_format import MessageToDict
 
 log = logging.getLogger(f"{APP}.mysql")
 metrics = markus.get_metrics(f"{APP}.mysql")
 
 
+def sql_string(value):
+    """Returns value as a quoted sql string literal, or NULL for None."""
+    return "NULL" if value is None else f"'{value}'"
+
+
+@traced("mysql.upsert_budget")
 def upsert_budget(
-    mysql_cursor, budget, project_id, config_type, alert_emails, alert_slack_channel_id
+    mysql_cursor,
+    gcp,
+    budget,
+    project_id,
+    config_type,
+    alert_emails,
+    alert_slack_channel_id,
 ):
-    """Upserts a row in the budgets mysql table."""
+    """Upserts a row in the budgets mysql table. gcp is the GcpHelper for the IAM lookup."""
 
     budget_dict = MessageToDict(
         budget.__class__.pb(budget), preserving_proto_field_name=True
@@ -48,14 +61,14 @@ def upsert_budget(
                 f"config_type:{config_type}",
             ],
         )
-        sys.exit(1)
+        raise ProjectError(f"Budget {budget_id} is not for a single project")
 
     if "services" in budget_dict["budget_filter"]:
         products = ",".join(budget_dict["budget_filter"]["services"])
     else:
         products = "ALL"
 
-    owner_emails = get_owner_emails_for_project(project_id, alert_emails)
+    owner_emails = get_owner_emails_for_project(gcp, project_id, alert_emails)
 
     if budget_dict["amount"].get("specified_amount") is None:
         budget_type = "LASTMONTH"
@@ -88,7 +101,7 @@ def upsert_budget(
 
     if budget_dict["notifications_rule"].get("pubsub_topic") is None:
         pubsub = "FALSE"
-        pubsub_topic = "NA"
+        pubsub_topic = None
     else:
         pubsub = "TRUE"
         pubsub_topic = budget_dict["notifications_rule"]["pubsub_topic"]
@@ -127,12 +140,12 @@ VALUES
 {budget_amount},
 {include_credits},
 {pubsub},
-'{pubsub_topic}',
-'{owner_emails}',
+{sql_string(pubsub_topic)},
+{sql_string(owner_emails)},
 '{created_date}',
 '{last_modified}',
 '{config_type}',
-'{alert_slack_channel_id}'
+{sql_string(alert_slack_channel_id)}
 )
 ON DUPLICATE KEY UPDATE
 display_name = '{display_name}',
@@ -143,11 +156,11 @@ budget_type = '{budget_type}',
 budget_amount = {budget_amount},
 include_credits = {include_credits},
 pubsub = {pubsub},
-pubsub_topic = '{pubsub_topic}',
-owner_emails = '{owner_emails}',
+pubsub_topic = {sql_string(pubsub_topic)},
+owner_emails = {sql_string(owner_emails)},
 last_modified = '{last_modified}',
 config_type = '{config_type}',
-alert_slack_channel_id = '{alert_slack_channel_id}'
+alert_slack_channel_id = {sql_string(alert_slack_channel_id)}
 """
 
     try:
@@ -166,6 +179,7 @@ alert_slack_channel_id = '{alert_slack_channel_id}'
                 f"config_type:{config_type}",
             ],
         )
+        raise ProjectError(f"Error recording budget: {err}") from err
     except DatabaseError as err:
         log.fatal(f"Database error while running query: {sql}. Error: {err}")
         metrics.incr(
@@ -176,6 +190,7 @@ alert_slack_channel_id = '{alert_slack_channel_id}'
                 f"config_type:{config_type}",
             ],
         )
+        raise ProjectError(f"Error recording budget: {err}") from err
     except Error as err:
         log.fatal(f"Exception while running query: {sql}. Error: {err}")
         metrics.incr(
@@ -186,10 +201,12 @@ alert_slack_channel_id = '{alert_slack_channel_id}'
                 f"config_type:{config_type}",
             ],
         )
+        raise ProjectError(f"Error recording budget: {err}") from err
 
 
+@traced("iam.get_owner_emails")
 def get_owner_emails_for_project(
-    project_id, alert_emails, default="dataops@mozilla.com"
+    gcp, project_id, alert_emails, default="dataops@mozilla.com"
 ):
     """Returns a string representation of the Union of:
     1. The @mozilla.com users(emails) with 'roles/owner' permission on the project id
@@ -197,32 +214,27 @@ def get_owner_emails_for_project(
     or returns default otherwise.
     """
 
-    credentials, _ = google.auth.default(
-        scopes=["https://www.googleapis.com/auth/cloud-platform"]
-    )
-
-    service = discovery.build(
-        "cloudresourcemanager", "v1", credentials=credentials, cache_discovery=False
-    )
-
     pattern = re.compile("^user:(.*@mozilla.com)$")
 
-    policy_request = service.projects().getIamPolicy(resource=project_id, body={})
-    policy_response = policy_request.execute()
+    # The shared resource manager client, within the call's deadline and circuit breaker
+    policy = gcp.call(
+        API_RESOURCE_MANAGER,
+        "get_iam_policy",
+        gcp.resource_manager_client.get_iam_policy,
+        request={"resource": f"projects/{project_id}"},
+    )
     metrics.incr(
         "gcp_api_request_count",
         tags=["type:resource_manager.getIamPolicy", f"project_id:{project_id}"],
     )
 
     members = set()
-    if policy_response.get("bindings"):
-        # Because the api is unreliable that this key will always exist
-        for binding in policy_response["bindings"]:
-            if binding["role"] == "roles/owner":
-                for user in binding["members"]:
-                    match = pattern.match(user)
-                    if match:
-                        members.add(match.group(1))
+    for binding in policy.bindings:
+        if binding.role == "roles/owner":
+            for user in binding.members:
+                match = pattern.match(user)
+                if match:
+                    members.add(match.group(1))
 
     # Add alert emails to the set
     members.update(alert_emails)
@@ -235,6 +247,7 @@ def get_owner_emails_for_project(
     return owner_emails
 
 
+@traced("mysql.count_budgets")
 def count_budgets(mysql_cursor):
     sql = f"SELECT COUNT(*) as cnt FROM budgets"
     try:
@@ -251,3 +264,189 @@ def count_budgets(mysql_cursor):
     except Error as err:
         log.fatal(f"Exception while running query: {sql}. Error: {err}")
         metrics.incr("error_count", tags=["type:sql_exception"])
+
+
+def start_or_resume_run(mysql_cursor, config_hash, resume_window):
+    """
+    Returns (run_id, resumed). Resumes the latest run that never finished if it started
+    within resume_window seconds using the same config, otherwise starts a new run.
+    """
+    now = datetime.datetime.utcnow()
+    cutoff = now - datetime.timedelta(seconds=resume_window)
+
+    sql = """SELECT run_id FROM reconcile_runs
+WHERE status = 'running' AND config_hash = %s AND started > %s
+ORDER BY started DESC LIMIT 1"""
+    try:
+        mysql_cursor.execute(sql, (config_hash, cutoff))
+        row = mysql_cursor.fetchone()
+        if row is not None:
+            return row[0], True
+
+        run_id = uuid.uuid4().hex
+        sql = """INSERT INTO reconcile_runs (run_id, config_hash, started, status)
+VALUES (%s, %s, %s, 'running')"""
+        mysql_cursor.execute(sql, (run_id, config_hash, now))
+        return run_id, False
+    except Error as err:
+        log.error(f"Error while starting run, checkpointing disabled: {err}")
+        metrics.incr("error_count", tags=["type:sql_checkpoint_err"])
+        return uuid.uuid4().hex, False
+
+
+def finish_run(mysql_cursor, run_id, status):
+    sql = "UPDATE reconcile_runs SET status = %s, finished = %s WHERE run_id = %s"
+    try:
+        mysql_cursor.execute(sql, (status, datetime.datetime.utcnow(), run_id))
+    except Error as err:
+        log.error(f"Error while finishing run {run_id}: {err}")
+        metrics.incr("error_count", tags=["type:sql_checkpoint_err"])
+
+
+def get_reconcile_states(mysql_cursor):
+    """
+    Returns a dict of (config_type, project_id) -> (last_run_id, status, attempts, next_attempt)
+    for every project the manager has checkpointed.
+    """
+    sql = """SELECT config_type, project_id, last_run_id, status, attempts, next_attempt
+FROM reconcile_state"""
+    states = {}
+    try:
+        mysql_cursor.execute(sql)
+        for row in mysql_cursor.fetchall():
+            states[(row[0], row[1])] = tuple(row[2:])
+    except Error as err:
+        log.error(f"Error while loading reconcile state: {err}")
+        metrics.incr("error_count", tags=["type:sql_checkpoint_err"])
+    return states
+
+
+def get_reconcile_priorities(mysql_cursor):
+    """
+    Returns a dict of (config_type, project_id) -> (entry_hash, verified), the hash of the
+    config entry each project was last reconciled with and when, for the reconcile scheduler.
+    """
+    sql = """SELECT config_type, project_id, entry_hash, verified FROM reconcile_state"""
+    priorities = {}
+    try:
+        mysql_cursor.execute(sql)
+        for row in mysql_cursor.fetchall():
+            priorities[(row[0], row[1])] = tuple(row[2:])
+    except Error as err:
+        log.error(f"Error while loading reconcile priorities: {err}")
+        metrics.incr("error_count", tags=["type:sql_checkpoint_err"])
+    return priorities
+
+
+def upsert_reconcile_state(
+    mysql_cursor,
+    run_id,
+    project_id,
+    config_type,
+    status,
+    attempts,
+    last_error=None,
+    next_attempt=None,
+    entry_hash=None,
+):
+    """
+    Checkpoints the outcome of reconciling one project in the reconcile_state table. Pass
+    entry_hash, the hash of the project's config entry, when it was reconciled successfully.
+    """
+
+    sql = """INSERT INTO reconcile_state (
+config_type, project_id, last_run_id, status, attempts, last_error, next_attempt, last_modified,
+entry_hash, verified
+)
+VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+ON DUPLICATE KEY UPDATE
+last_run_id = VALUES(last_run_id),
+status = VALUES(status),
+attempts = VALUES(attempts),
+last_error = VALUES(last_error),
+next_attempt = VALUES(next_attempt),
+last_modified = VALUES(last_modified),
+entry_hash = COALESCE(VALUES(entry_hash), entry_hash),
+verified = COALESCE(VALUES(verified), verified)
+"""
+    if last_error is not None:
+        last_error = last_error[:1024]
+
+    now = datetime.datetime.utcnow()
+    try:
+        mysql_cursor.execute(
+            sql,
+            (
+                config_type,
+                project_id,
+                run_id,
+                status,
+                attempts,
+                last_error,
+                next_attempt,
+                now,
+                entry_hash,
+                now if entry_hash is not None else None,
+            ),
+        )
+    except Error as err:
+        log.error(f"Error while checkpointing {project_id}: {err}")
+        metrics.incr(
+            "error_count",
+            tags=["type:sql_checkpoint_err", f"project_id:{project_id}"],
+        )
+
+
+def acquire_lease(mysql_cursor, name, holder, ttl):
+    """
+    Takes the run_locks lease name for holder for ttl seconds, unless another holder's lease
+    hasn't expired yet. Renews it if holder already has it. Returns (holder, expires) of the
+    lease afterwards, or None if the lease table couldn't be used.
+    """
+    # holder is assigned first: mysql evaluates the update assignments left to right, so
+    # the later ones see whether this holder got the lease
+    sql = """INSERT INTO run_locks (name, holder, acquired, expires)
+VALUES (%s, %s, UTC_TIMESTAMP(), UTC_TIMESTAMP() + INTERVAL %s SECOND)
+ON DUPLICATE KEY UPDATE
+holder = IF(expires < UTC_TIMESTAMP() OR holder = VALUES(holder), VALUES(holder), holder),
+acquired = IF(holder = VALUES(holder) AND expires < UTC_TIMESTAMP(), VALUES(acquired), acquired),
+expires = IF(holder = VALUES(holder), VALUES(expires), expires)"""
+    try:
+        mysql_cursor.execute(sql, (name, holder, ttl))
+        mysql_cursor.execute(
+            "SELECT holder, expires FROM run_locks WHERE name = %s", (name,)
+        )
+        return mysql_cursor.fetchone()
+    except Error as err:
+        log.error(f"Error while taking lease {name}: {err}")
+        metrics.incr("error_count", tags=["type:sql_lock_err"])
+        return None
+
+
+def renew_lease(mysql_cursor, name, holder, ttl):
+    """Extends holder's lease by ttl seconds. Returns False if holder lost the lease."""
+    sql = """UPDATE run_locks SET expires = UTC_TIMESTAMP() + INTERVAL %s SECOND
+WHERE name = %s AND holder = %s"""
+    try:
+        if mysql_cursor.execute(sql, (ttl, name, holder)):
+            return True
+        # No row changed, either the lease is gone or expires didn't move within a second
+        mysql_cursor.execute("SELECT holder FROM run_locks WHERE name = %s", (name,))
+        row = mysql_cursor.fetchone()
+        return row is not None and row[0] == holder
+    except Error as err:
+        # Retried on the next heartbeat, well before the lease expires
+        log.error(f"Error while renewing lease {name}: {err}")
+        metrics.incr("error_count", tags=["type:sql_lock_err"])
+        return True
+
+
+def release_lease(mysql_cursor, name, holder):
+    try:
+        mysql_cursor.execute(
+            "DELETE FROM run_locks WHERE name = %s AND holder = %s", (name, holder)
+        )
+    except Error as err:
+        # The lease expires on its own
+        log.error(f"Error while releasing lease {name}: {err}")
+        metrics.incr("error_count", tags=["type:sql_lock_err"])
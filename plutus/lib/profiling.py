@@ -0,0 +1,135 @@
+"""
+Per phase cpu and memory profiling for budget manager runs.
+
+Each phase (config load, expansion, reconcile, mysql, gc) gets its own cProfile.Profile.
+Phases nest: entering an inner phase pauses the outer phase's profiler, so time is only
+ever attributed to the innermost phase. tracemalloc tracks the peak memory of each phase,
+and a snapshot is kept from the point where that phase reached its highest peak.
+"""
+
+from plutus.lib.constants import APP
+import contextlib
+import cProfile
+import logging
+import os
+import pstats
+import time
+import tracemalloc
+
+log = logging.getLogger(f"{APP}.profiling")
+
+PHASE_CONFIG_LOAD = "config_load"
+PHASE_EXPANSION = "expansion"
+PHASE_RECONCILE = "reconcile"
+PHASE_MYSQL = "mysql"
+PHASE_GC = "gc"
+
+# Only take a new snapshot when a phase beats its previous peak by this many bytes,
+# so phases entered once per project don't snapshot on every call.
+SNAPSHOT_MIN_GROWTH = 1024 * 1024
+
+
+class _PhaseStats:
+    def __init__(self, name):
+        self.name = name
+        self.profile = cProfile.Profile()
+        self.calls = 0
+        self.wall_seconds = 0.0
+        self.peak_bytes = 0
+        self.snapshot = None
+
+
+class PhaseProfiler:
+    """Profiles named phases of a run. Does nothing until start() is called."""
+
+    def __init__(self):
+        self.enabled = False
+        self.output_dir = None
+        self._phases = {}
+        self._stack = []
+
+    def start(self, output_dir):
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+        self.enabled = True
+        tracemalloc.start()
+        log.info(f"Profiling enabled. Writing profiles to {output_dir}")
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        stats = self._phases.get(name)
+        if stats is None:
+            stats = self._phases[name] = _PhaseStats(name)
+
+        if self._stack:
+            self._pause(self._stack[-1])
+        self._stack.append(stats)
+        stats.calls += 1
+        started = time.perf_counter()
+        self._resume(stats)
+        try:
+            yield
+        finally:
+            self._pause(stats)
+            stats.wall_seconds += time.perf_counter() - started
+            self._stack.pop()
+            if self._stack:
+                self._resume(self._stack[-1])
+
+    def _resume(self, stats):
+        tracemalloc.reset_peak()
+        stats.profile.enable()
+
+    def _pause(self, stats):
+        stats.profile.disable()
+        _, peak = tracemalloc.get_traced_memory()
+        if peak > stats.peak_bytes:
+            if stats.snapshot is None or peak - stats.peak_bytes >= SNAPSHOT_MIN_GROWTH:
+                stats.snapshot = tracemalloc.take_snapshot()
+            stats.peak_bytes = peak
+
+    def stop(self):
+        """Writes a .prof and .snapshot per phase plus a summary.txt to output_dir."""
+        if not self.enabled:
+            return
+
+        self.enabled = False
+        tracemalloc.stop()
+
+        summary_path = os.path.join(self.output_dir, "summary.txt")
+        with open(summary_path, "w") as summary:
+            summary.write(
+                f"{'phase':<12} {'calls':>8} {'wall_s':>10} {'peak_mb':>10}\n"
+            )
+            for stats in self._phases.values():
+                summary.write(
+                    f"{stats.name:<12} {stats.calls:>8} {stats.wall_seconds:>10.2f} "
+                    f"{stats.peak_bytes / 1024 / 1024:>10.2f}\n"
+                )
+
+            for stats in self._phases.values():
+                stats.profile.dump_stats(
+                    os.path.join(self.output_dir, f"{stats.name}.prof")
+                )
+
+                summary.write(f"\n== {stats.name}: top functions by cumulative time\n")
+                pstats.Stats(stats.profile, stream=summary).sort_stats(
+                    "cumulative"
+                ).print_stats(15)
+
+                if stats.snapshot is not None:
+                    stats.snapshot.dump(
+                        os.path.join(self.output_dir, f"{stats.name}.snapshot")
+                    )
+                    summary.write(f"== {stats.name}: top allocations at peak\n")
+                    for stat in stats.snapshot.statistics("lineno")[:10]:
+                        summary.write(f"{stat}\n")
+
+        log.info(f"Profiles written to {self.output_dir}. See {summary_path}")
+
+
+profiler = PhaseProfiler()
@@ -0,0 +1,163 @@
+"""
+Rollups of the spend_history table the budget monitor appends every budget notification to.
+
+spend_hourly and spend_daily hold one row per budget per hour/day, so dashboards and
+alerting read a few rows per budget instead of scanning raw notifications. Rollups are
+recomputed for the last few buckets on every run, which picks up late rows and makes the
+job safe to rerun. spend_history is partitioned by day, and partitions older than the
+retention are dropped.
+"""
+
+from plutus.lib.constants import APP
+from pymysql.err import Error
+import datetime
+import logging
+import markus
+import re
+
+log = logging.getLogger(f"{APP}.spend_history")
+metrics = markus.get_metrics(f"{APP}.spend_history")
+
+# Buckets recomputed on each run, to absorb late and batched monitor writes
+HOURLY_LOOKBACK = datetime.timedelta(hours=3)
+DAILY_LOOKBACK = datetime.timedelta(days=2)
+# Daily partitions created ahead of time, so rows never land in the catch all partition
+PARTITIONS_AHEAD = 3
+
+PARTITION_FUTURE = "p_future"
+PARTITION_NAME = re.compile(r"^p(\d{8})$")
+
+
+def partition_name(day):
+    return f"p{day:%Y%m%d}"
+
+
+def partition_day(name):
+    """Returns the day a spend_history partition holds, or None for p_future."""
+    match = PARTITION_NAME.match(name)
+    if match is None:
+        return None
+    return datetime.datetime.strptime(match.group(1), "%Y%m%d").date()
+
+
+def plan_partitions(existing, today, retention_days):
+    """
+    Returns (to_add, to_drop): the days missing a partition between the newest existing one
+    and today + PARTITIONS_AHEAD, and the partition names older than retention_days.
+    """
+    days = sorted(d for d in map(partition_day, existing) if d is not None)
+    last_day = today + datetime.timedelta(days=PARTITIONS_AHEAD)
+    first_new = days[-1] + datetime.timedelta(days=1) if days else today
+
+    to_add = []
+    day = first_new
+    while day <= last_day:
+        to_add.append(day)
+        day += datetime.timedelta(days=1)
+
+    oldest_kept = today - datetime.timedelta(days=retention_days)
+    to_drop = [partition_name(d) for d in days if d < oldest_kept]
+    return to_add, to_drop
+
+
+def maintain_partitions(mysql_cursor, today, retention_days):
+    """Adds daily spend_history partitions ahead of today and drops expired ones."""
+    sql = """SELECT partition_name FROM information_schema.partitions
+WHERE table_schema = DATABASE() AND table_name = 'spend_history'"""
+    try:
+        mysql_cursor.execute(sql)
+        existing = [row[0] for row in mysql_cursor.fetchall() if row[0] is not None]
+        to_add, to_drop = plan_partitions(existing, today, retention_days)
+
+        if to_add:
+            # New days are split off the catch all partition, which holds no rows as
+            # long as partitions are kept ahead of today
+            partitions = ", ".join(
+                f"PARTITION {partition_name(day)} VALUES LESS THAN "
+                f"(TO_DAYS('{day + datetime.timedelta(days=1):%Y-%m-%d}'))"
+                for day in to_add
+            )
+            mysql_cursor.execute(
+                f"ALTER TABLE spend_history REORGANIZE PARTITION {PARTITION_FUTURE} INTO "
+                f"({partitions}, PARTITION {PARTITION_FUTURE} VALUES LESS THAN MAXVALUE)"
+            )
+        if to_drop:
+            mysql_cursor.execute(
+                f"ALTER TABLE spend_history DROP PARTITION {', '.join(to_drop)}"
+            )
+
+        log.info(
+            f"spend_history partitions: {len(to_add)} added, {len(to_drop)} dropped"
+        )
+    except Error as err:
+        log.error(f"Error while maintaining spend_history partitions: {err}")
+        metrics.incr("error_count", tags=["type:sql_spend_history_err"])
+
+
+def rollup_hourly(mysql_cursor, since):
+    """Recomputes spend_hourly for every hour starting at or after since."""
+    sql = """INSERT INTO spend_hourly (
+budget_id, bucket, period_start, notifications, min_cost, max_cost, budget_amount,
+max_threshold
+)
+SELECT budget_id, DATE_FORMAT(received, '%%Y-%%m-%%d %%H:00:00') AS hour,
+MAX(period_start), COUNT(*), MIN(cost_amount), MAX(cost_amount), MAX(budget_amount),
+MAX(threshold)
+FROM spend_history
+WHERE received >= %s
+GROUP BY budget_id, hour
+ON DUPLICATE KEY UPDATE
+period_start = VALUES(period_start),
+notifications = VALUES(notifications),
+min_cost = VALUES(min_cost),
+max_cost = VALUES(max_cost),
+budget_amount = VALUES(budget_amount),
+max_threshold = VALUES(max_threshold)
+"""
+    return _rollup(mysql_cursor, "hourly", sql, since.replace(minute=0, second=0))
+
+
+def rollup_daily(mysql_cursor, since):
+    """Recomputes spend_daily from spend_hourly for every day starting at or after since."""
+    sql = """INSERT INTO spend_daily (
+budget_id, bucket, period_start, notifications, min_cost, max_cost, budget_amount,
+max_threshold
+)
+SELECT budget_id, DATE(bucket) AS day,
+MAX(period_start), SUM(notifications), MIN(min_cost), MAX(max_cost), MAX(budget_amount),
+MAX(max_threshold)
+FROM spend_hourly
+WHERE bucket >= %s
+GROUP BY budget_id, day
+ON DUPLICATE KEY UPDATE
+period_start = VALUES(period_start),
+notifications = VALUES(notifications),
+min_cost = VALUES(min_cost),
+max_cost = VALUES(max_cost),
+budget_amount = VALUES(budget_amount),
+max_threshold = VALUES(max_threshold)
+"""
+    return _rollup(
+        mysql_cursor, "daily", sql, since.replace(hour=0, minute=0, second=0)
+    )
+
+
+def _rollup(mysql_cursor, granularity, sql, since):
+    try:
+        rows = mysql_cursor.execute(sql, (since.replace(microsecond=0),))
+        metrics.incr("rollup_rows_count", value=rows, tags=[f"type:{granularity}"])
+        return rows
+    except Error as err:
+        log.error(f"Error while rolling up {granularity} spend: {err}")
+        metrics.incr("error_count", tags=["type:sql_spend_history_err"])
+        return 0
+
+
+def rollup_spend_history(mysql_conn, retention_days, now=None):
+    """Refreshes the hourly and daily rollups and maintains spend_history partitions."""
+    now = now or datetime.datetime.utcnow()
+    with mysql_conn.cursor() as mysql_cursor:
+        maintain_partitions(mysql_cursor, now.date(), retention_days)
+        # Daily reads hourly, so hourly goes first
+        rollup_hourly(mysql_cursor, now - HOURLY_LOOKBACK)
+        rollup_daily(mysql_cursor, now - DAILY_LOOKBACK)
@@ -0,0 +1,360 @@
+"""
+Lightweight span based tracing for budget manager runs.
+
+Spans nest as run -> config section -> project -> rpc and are handed to an exporter
+when they finish. Exporters write either JSON lines to a local file or OTLP/JSON to a
+collector. With no exporter configured spans are still timed but never recorded, so
+instrumented code costs next to nothing when tracing is off.
+"""
+
+from plutus.lib.constants import APP
+import functools
+import json
+import logging
+import os
+import threading
+import time
+import urllib.request
+
+log = logging.getLogger(f"{APP}.tracing")
+
+# Span names used by the budget manager. The report tooling keys off of these.
+SPAN_RUN = "run"
+SPAN_SECTION = "section"
+SPAN_PROJECT = "project"
+
+
+class Span:
+    """A single timed operation within a trace."""
+
+    def __init__(self, name, trace_id, parent_id=None, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.status = "ok"
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "duration_ms": (self.end_ns - self.start_ns) / 1e6,
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+
+class JsonLinesExporter:
+    """Appends one json object per finished span to a local file."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, "a")
+
+    def export(self, span):
+        line = json.dumps(span.to_dict(), default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+
+    def shutdown(self):
+        with self._lock:
+            self._file.close()
+
+
+class OtlpHttpExporter:
+    """
+    Buffers finished spans and posts them as OTLP/JSON to a collector, e.g.
+    http://localhost:4318/v1/traces. Spans are sent in batches of batch_size and on shutdown.
+    """
+
+    def __init__(self, endpoint, service_name=APP, batch_size=512, timeout=10):
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._buffer = []
+
+    def export(self, span):
+        with self._lock:
+            self._buffer.append(span)
+            if len(self._buffer) < self.batch_size:
+                return
+            batch, self._buffer = self._buffer, []
+        self._post(batch)
+
+    def shutdown(self):
+        with self._lock:
+            batch, self._buffer = self._buffer, []
+        if batch:
+            self._post(batch)
+
+    def _post(self, spans):
+        body = json.dumps(self.to_otlp(spans)).encode("utf-8")
+        request = urllib.request.Request(
+            self.endpoint, data=body, headers={"Content-Type": "application/json"}
+        )
+        try:
+            urllib.request.urlopen(request, timeout=self.timeout).close()
+        except Exception as err:
+            # Tracing must never fail a run
+            log.warning(
+                f"Failed exporting {len(spans)} spans to {self.endpoint}: {err}"
+            )
+
+    def to_otlp(self, spans):
+        def attribute(key, value):
+            if isinstance(value, bool):
+                return {"key": key, "value": {"boolValue": value}}
+            if isinstance(value, int):
+                return {"key": key, "value": {"intValue": str(value)}}
+            if isinstance(value, float):
+                return {"key": key, "value": {"doubleValue": value}}
+            return {"key": key, "value": {"stringValue": str(value)}}
+
+        otlp_spans = []
+        for span in spans:
+            otlp_span = {
+                "traceId": span.trace_id,
+                "spanId": span.span_id,
+                "name": span.name,
+                # SPAN_KIND_INTERNAL
+                "kind": 1,
+                "startTimeUnixNano": str(span.start_ns),
+                "endTimeUnixNano": str(span.end_ns),
+                "attributes": [attribute(k, v) for k, v in span.attributes.items()],
+                # STATUS_CODE_OK or STATUS_CODE_ERROR
+                "status": {"code": 1 if span.status == "ok" else 2},
+            }
+            if span.parent_id is not None:
+                otlp_span["parentSpanId"] = span.parent_id
+            otlp_spans.append(otlp_span)
+
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [attribute("service.name", self.service_name)]
+                    },
+                    "scopeSpans": [{"scope": {"name": APP}, "spans": otlp_spans}],
+                }
+            ]
+        }
+
+
+class _SpanContext:
+    def __init__(self, tracer, name, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.span = None
+
+    def __enter__(self):
+        self.span = self.tracer.start_span(self.name, self.attributes)
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.span.status = "error"
+            self.span.set_attribute("error", f"{exc_type.__name__}: {exc}")
+        self.tracer.end_span(self.span)
+        return False
+
+
+class Tracer:
+    """
+    Creates spans and tracks the currently active span per thread so that nested
+    `with tracer.span(...)` blocks are parented automatically.
+    """
+
+    def __init__(self, exporter=None):
+        self.exporter = exporter
+        self.trace_id = os.urandom(16).hex()
+        self._local = threading.local()
+
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def current_span(self):
+        stack = self._stack()
+        return stack[-1] if stack else None
+
+    def span(self, name, **attributes):
+        return _SpanContext(self, name, attributes)
+
+    def start_span(self, name, attributes=None):
+        parent = self.current_span()
+        span = Span(
+            name,
+            self.trace_id,
+            parent_id=parent.span_id if parent is not None else None,
+            attributes=attributes,
+        )
+        self._stack().append(span)
+        return span
+
+    def end_span(self, span):
+        span.end_ns = time.time_ns()
+        stack = self._stack()
+        if stack and stack[-1] is span:
+            stack.pop()
+        if self.exporter is not None:
+            try:
+                self.exporter.export(span)
+            except Exception as err:
+                log.warning(f"Failed exporting span {span.name}: {err}")
+
+    def shutdown(self):
+        if self.exporter is not None:
+            self.exporter.shutdown()
+
+
+tracer = Tracer()
+
+
+def configure_tracing(trace_file=None, otlp_endpoint=None):
+    """Points the module tracer at a jsonl file or an OTLP collector and starts a new trace."""
+    if trace_file is not None:
+        exporter = JsonLinesExporter(trace_file)
+    elif otlp_endpoint is not None:
+        exporter = OtlpHttpExporter(otlp_endpoint)
+    else:
+        exporter = None
+
+    tracer.exporter = exporter
+    tracer.trace_id = os.urandom(16).hex()
+    return tracer
+
+
+def traced(name):
+    """Decorator wrapping a function call in a span named name."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with tracer.span(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def load_spans(path, trace_id=None):
+    """
+    Loads the spans of one trace, i.e. one run, written by JsonLinesExporter. Returns a
+    list of dicts. The exporter appends, so a file can hold several runs; the latest one
+    is loaded unless trace_id is given.
+    """
+    spans = []
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                spans.append(json.loads(line))
+
+    if trace_id is None:
+        trace_id = latest_trace_id(spans)
+    return [s for s in spans if s["trace_id"] == trace_id]
+
+
+def latest_trace_id(spans):
+    """Returns the trace id of the trace that started last, or None if there are no spans."""
+    started = {}
+    for span in spans:
+        trace_id = span["trace_id"]
+        started[trace_id] = min(
+            started.get(trace_id, span["start_ns"]), span["start_ns"]
+        )
+    return max(started, key=started.get) if started else None
+
+
+def slowest_projects(spans, limit=20):
+    """
+    Returns the `limit` slowest project spans as (project_id, section, duration_ms) tuples.
+    Project spans carry the config section that queued them, as they all run in the
+    reconcile section; spans without it take their parent section's.
+    """
+    by_id = {s["span_id"]: s for s in spans}
+    projects = []
+    for span in spans:
+        if span["name"] != SPAN_PROJECT:
+            continue
+        section = span["attributes"].get("section")
+        parent = by_id.get(span["parent_id"])
+        if section is None and parent is not None:
+            section = parent["attributes"].get("section")
+        projects.append(
+            (span["attributes"].get("project_id"), section, span["duration_ms"])
+        )
+
+    projects.sort(key=lambda p: p[2], reverse=True)
+    return projects[:limit]
+
+
+def _children_by_parent(spans):
+    children = {}
+    for span in spans:
+        children.setdefault(span["parent_id"], []).append(span)
+    return children
+
+
+def critical_path(spans, root=None):
+    """
+    Returns the chain of spans that gated completion of root (the run span by default).
+    At each level the last finishing child is taken, then the last child that finished
+    before it started, and so on, before descending into each chosen child.
+    """
+    children = _children_by_parent(spans)
+    if root is None:
+        roots = children.get(None, [])
+        if not roots:
+            return []
+        root = max(roots, key=lambda s: s["duration_ms"])
+
+    path = [root]
+    remaining = sorted(
+        children.get(root["span_id"], []), key=lambda s: s["end_ns"], reverse=True
+    )
+    chosen = []
+    cutoff = root["end_ns"]
+    for child in remaining:
+        if child["end_ns"] <= cutoff:
+            chosen.append(child)
+            cutoff = child["start_ns"]
+
+    for child in reversed(chosen):
+        path.extend(critical_path(spans, root=child))
+    return path
+
+
+def self_time_breakdown(spans):
+    """
+    Returns a list of (name, self_ms, count) sorted by self time, where self time is a
+    span's duration minus the time covered by its children. RPC span names identify the
+    step (number lookup, budget listing, diff, write, iam lookup, sql).
+    """
+    children = _children_by_parent(spans)
+    totals = {}
+    for span in spans:
+        child_ms = sum(c["duration_ms"] for c in children.get(span["span_id"], []))
+        self_ms = max(span["duration_ms"] - child_ms, 0.0)
+        total, count = totals.get(span["name"], (0.0, 0))
+        totals[span["name"]] = (total + self_ms, count + 1)
+
+    breakdown = [(name, ms, count) for name, (ms, count) in totals.items()]
+    breakdown.sort(key=lambda b: b[1], reverse=True)
+    return breakdown
@@ -0,0 +1,4 @@
+-- Secondary indexes for lookups and reports by project, and for changes per config type.
+ALTER TABLE budgets ADD INDEX project_id_idx (project_id);
+ALTER TABLE budgets ADD INDEX project_number_idx (project_number);
+ALTER TABLE budgets ADD INDEX config_type_modified_idx (config_type, last_modified);
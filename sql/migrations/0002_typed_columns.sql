@@ -0,0 +1,18 @@
+-- Booleans that were written as strings become proper booleans, and the 'None'/'NA'
+-- placeholder strings for missing values become NULL. The columns are compared as strings,
+-- so this is a no-op on databases created with them BOOLEAN already, rather than a
+-- strict mode error comparing a number to 'TRUE'.
+UPDATE budgets SET
+       include_credits = IF(CAST(include_credits AS CHAR) IN ('1', 'TRUE', 'true'), 1, 0),
+       pubsub = IF(CAST(pubsub AS CHAR) IN ('1', 'TRUE', 'true'), 1, 0);
+ALTER TABLE budgets
+       MODIFY include_credits BOOLEAN NOT NULL,
+       MODIFY pubsub BOOLEAN NOT NULL;
+
+UPDATE budgets SET alert_slack_channel_id = NULL WHERE alert_slack_channel_id = 'None';
+UPDATE budgets SET owner_emails = NULL WHERE owner_emails = 'None';
+UPDATE budgets SET pubsub_topic = NULL WHERE pubsub_topic = 'NA';
+
+UPDATE projects SET deprecated = IF(CAST(deprecated AS CHAR) IN ('1', 'TRUE', 'true'), 1, 0)
+WHERE deprecated IS NOT NULL;
+ALTER TABLE projects MODIFY deprecated BOOLEAN;
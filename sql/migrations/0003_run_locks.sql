@@ -0,0 +1,8 @@
+-- Leases held by budget manager runs, so overlapping runs don't reconcile the same projects.
+-- A holder renews its lease while running, and a lease past expires is free to take.
+CREATE TABLE IF NOT EXISTS run_locks (
+       name VARCHAR(64) PRIMARY KEY NOT NULL,
+       holder VARCHAR(255) NOT NULL,
+       acquired DATETIME NOT NULL,
+       expires DATETIME NOT NULL
+);
@@ -0,0 +1,103 @@
+-- Tables added after the baseline schema, for databases created from the original
+-- sql/tables.sql. Same definitions as tables.sql, which creates them on new databases.
+
+-- One row per budget manager run. Runs left 'running' were interrupted and can be resumed.
+CREATE TABLE IF NOT EXISTS reconcile_runs (
+       run_id VARCHAR(64) PRIMARY KEY NOT NULL,
+       config_hash VARCHAR(64) NOT NULL,
+       started DATETIME NOT NULL,
+       finished DATETIME,
+       status VARCHAR(32) NOT NULL
+);
+
+-- Last reconcile outcome per configured project, used to resume runs and back off failures
+CREATE TABLE IF NOT EXISTS reconcile_state (
+       config_type VARCHAR(255) NOT NULL,
+       project_id VARCHAR(255) NOT NULL,
+       last_run_id VARCHAR(64) NOT NULL,
+       status VARCHAR(32) NOT NULL,
+       attempts INT NOT NULL DEFAULT 0,
+       last_error VARCHAR(1024),
+       next_attempt DATETIME,
+       last_modified DATETIME NOT NULL,
+       PRIMARY KEY (config_type, project_id)
+);
+
+-- Last pagerduty trigger per budget. The budget monitor only triggers again when a higher
+-- threshold is exceeded within the same budget period, or a new period starts.
+CREATE TABLE IF NOT EXISTS incidents (
+       budget_id VARCHAR(255) PRIMARY KEY NOT NULL,
+       period_start DATETIME NOT NULL,
+       threshold DOUBLE NOT NULL,
+       triggered DATETIME NOT NULL
+);
+
+-- Pubsub message ids the budget monitor fully handled, so redeliveries are acked without
+-- being handled again. The monitor deletes rows older than MESSAGE_ID_TTL_DAYS.
+CREATE TABLE IF NOT EXISTS processed_messages (
+       message_id VARCHAR(64) PRIMARY KEY NOT NULL,
+       processed DATETIME NOT NULL,
+       INDEX processed_idx (processed)
+);
+
+-- Every budget notification the budget monitor received, when SPEND_HISTORY=1. Partitioned
+-- by day so expired history is dropped a partition at a time. The budget manager adds
+-- partitions ahead of time and drops old ones with --spend-rollup.
+CREATE TABLE IF NOT EXISTS spend_history (
+       id BIGINT NOT NULL AUTO_INCREMENT,
+       budget_id VARCHAR(255) NOT NULL,
+       received DATETIME NOT NULL,
+       period_start DATETIME NOT NULL,
+       cost_amount DOUBLE NOT NULL,
+       budget_amount DOUBLE NOT NULL,
+       threshold DOUBLE,
+       PRIMARY KEY (id, received),
+       INDEX budget_received_idx (budget_id, received)
+)
+PARTITION BY RANGE (TO_DAYS(received)) (
+       PARTITION p_future VALUES LESS THAN MAXVALUE
+);
+
+-- Per budget rollups of spend_history, one row per hour and per day. Dashboards and alert
+-- queries should read these rather than spend_history.
+CREATE TABLE IF NOT EXISTS spend_hourly (
+       budget_id VARCHAR(255) NOT NULL,
+       bucket DATETIME NOT NULL,
+       period_start DATETIME NOT NULL,
+       notifications INT NOT NULL,
+       min_cost DOUBLE NOT NULL,
+       max_cost DOUBLE NOT NULL,
+       budget_amount DOUBLE NOT NULL,
+       max_threshold DOUBLE,
+       PRIMARY KEY (budget_id, bucket)
+);
+
+CREATE TABLE IF NOT EXISTS spend_daily (
+       budget_id VARCHAR(255) NOT NULL,
+       bucket DATETIME NOT NULL,
+       period_start DATETIME NOT NULL,
+       notifications INT NOT NULL,
+       min_cost DOUBLE NOT NULL,
+       max_cost DOUBLE NOT NULL,
+       budget_amount DOUBLE NOT NULL,
+       max_threshold DOUBLE,
+       PRIMARY KEY (budget_id, bucket)
+);
+
+-- Month end spend projection and burn rate per budget, written by the budget manager's
+-- forecast.py from spend_hourly. alerted is set when the budget monitor alerted on the
+-- forecast, and cleared when a new budget period starts.
+CREATE TABLE IF NOT EXISTS spend_forecasts (
+       budget_id VARCHAR(255) PRIMARY KEY NOT NULL,
+       period_start DATETIME NOT NULL,
+       computed DATETIME NOT NULL,
+       cost_amount DOUBLE NOT NULL,
+       budget_amount DOUBLE NOT NULL,
+       burn_rate DOUBLE NOT NULL,
+       baseline_rate DOUBLE NOT NULL,
+       projected_cost DOUBLE NOT NULL,
+       anomaly BOOLEAN NOT NULL,
+       points INT NOT NULL,
+       alerted DATETIME,
+       INDEX alerted_idx (alerted)
+);
@@ -0,0 +1,5 @@
+-- What the reconcile scheduler orders work by: the hash of the config entry a project was
+-- last reconciled with, and when its budget was last verified. Both are only set on success.
+ALTER TABLE reconcile_state
+       ADD COLUMN entry_hash VARCHAR(64),
+       ADD COLUMN verified DATETIME;
@@ -0,0 +1,33 @@
+-- The budget monitor's claim_alert stored procedure. Dropped first so a rerun, or a later
+-- migration changing it, creates it again.
+DROP PROCEDURE IF EXISTS claim_alert;
+
+DELIMITER //
+
+-- Claims the alert slot for a budget and returns its routing in one round trip.
+-- The alerts row is claimed (inserted, or last_alert moved to p_now) only if no alert was
+-- sent since p_cutoff. Concurrent calls serialize on the row lock, so only one can claim it.
+-- Returns a single row: (claimed, last_alert, owner_emails, alert_slack_channel_id,
+-- project_id). last_alert is the alerts row after the claim, so callers can cache it. The
+-- routing columns are NULL when the budget is not in the budgets table.
+-- Relies on affected rows being 0 for an unchanged row, i.e. connections must not set
+-- CLIENT_FOUND_ROWS (pymysql doesn't by default).
+CREATE PROCEDURE claim_alert(
+       IN p_budget_id VARCHAR(255),
+       IN p_now DATETIME,
+       IN p_cutoff DATETIME
+)
+BEGIN
+       DECLARE v_claimed BOOLEAN;
+
+       INSERT INTO alerts (budget_id, last_alert) VALUES (p_budget_id, p_now)
+       ON DUPLICATE KEY UPDATE last_alert = IF(last_alert < p_cutoff, p_now, last_alert);
+       SET v_claimed = ROW_COUNT() > 0;
+
+       SELECT v_claimed, a.last_alert, b.owner_emails, b.alert_slack_channel_id, b.project_id
+       FROM alerts a
+       LEFT JOIN budgets b ON b.budget_id = a.budget_id
+       WHERE a.budget_id = p_budget_id;
+END //
+
+DELIMITER ;
@@ -0,0 +1,298 @@
+import json
+import os
+import subprocess
+import sys
+
+from plutus.budget_monitor.bench_cold_start import (
+    COLD_START,
+    ENV,
+    HEAVY_MODULES,
+    MYSQL_LATENCY,
+    SPEND_HISTORY_START,
+)
+
+MONITOR_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "plutus",
+    "budget_monitor",
+)
+
+# Pages through a pagerduty stand-in whose first send fails, then redelivers the alert
+FAILED_PAGE = """
+import base64, json
+import main, subscriber
+from local_mysql import LocalMySQL
+from loadtest import Faults, LocalPagerDuty, LocalSlack, faulty_ses
+
+class FlakyPagerDuty(LocalPagerDuty):
+    def create(self, data):
+        if self.faults.error_rate:
+            self.faults.error_rate = 0
+            raise RuntimeError("pagerduty: injected error")
+        super().create(data)
+
+db = LocalMySQL()
+class LocalPool(main.ConnectionPool):
+    def _connect(self):
+        return db.connect()
+main.mysql_pool = LocalPool(1, 60)
+main.slack_client = LocalSlack(Faults())
+main.ses_client = faulty_ses(Faults())
+main.pagerduty_events = FlakyPagerDuty(Faults(error_rate=1))
+
+attrs = {"billingAccountId": "test", "budgetId": "budget"}
+data = {
+    "budgetDisplayName": "plutus-test",
+    "costAmount": 150.0,
+    "budgetAmount": 100.0,
+    "alertThresholdExceeded": 1.0,
+    "costIntervalStart": "2020-06-01T00:00:00Z",
+}
+results = []
+for attempt in range(2):
+    try:
+        if %(mode)r == "function":
+            main.process_pubsub(
+                {"attributes": attrs, "data": base64.b64encode(json.dumps(data).encode())},
+                type("Context", (), {"event_id": "message-1"}),
+            )
+        else:
+            assert not subscriber.process_batch([main.build_alert(attrs, data)])
+        results.append("ok")
+    except Exception as err:
+        results.append(type(err).__name__)
+print(json.dumps({"results": results, "pages": len(main.pagerduty_events.events)}))
+"""
+
+# Alerts a budget twice, moving it to another slack channel in between. The alert window is
+# negative, so the second notification alerts again even within the same second
+ROUTING_CHANGE = """
+import base64, json
+from datetime import timedelta
+import main, subscriber
+from local_mysql import LocalMySQL
+from loadtest import Faults, LocalPagerDuty, LocalSlack, faulty_ses
+
+budget_id = "billingAccounts/test/budgets/budget"
+db = LocalMySQL()
+class LocalPool(main.ConnectionPool):
+    def _connect(self):
+        return db.connect()
+main.mysql_pool = LocalPool(1, 60)
+main.slack_client = LocalSlack(Faults())
+main.ses_client = faulty_ses(Faults())
+main.pagerduty_events = LocalPagerDuty(Faults())
+main.ALERT_WINDOW = timedelta(seconds=-1)
+
+attrs = {"billingAccountId": "test", "budgetId": "budget"}
+data = {
+    "budgetDisplayName": "plutus-test",
+    "costAmount": 60.0,
+    "budgetAmount": 100.0,
+    "alertThresholdExceeded": 0.5,
+    "costIntervalStart": "2020-06-01T00:00:00Z",
+}
+for message_id, slack_channel in [("message-1", "before"), ("message-2", "after")]:
+    db.add_budget(budget_id, "owner@example.com", slack_channel, "project")
+    if %(mode)r == "function":
+        main.process_pubsub(
+            {"attributes": attrs, "data": base64.b64encode(json.dumps(data).encode())},
+            type("Context", (), {"event_id": message_id}),
+        )
+    else:
+        assert not subscriber.process_batch([main.build_alert(attrs, data)])
+posted = main.slack_client.posted
+print(json.dumps({"channels": [c for c, _ in posted if c != main.DEFAULT_CHANNEL_ID]}))
+"""
+
+# Checks forecasts twice, with every slack post of the first check failing
+FAILED_FORECAST = """
+import json
+import main
+from local_mysql import LocalMySQL
+from loadtest import Faults, LocalSlack, faulty_ses
+
+db = LocalMySQL()
+db.add_budget("budget", "owner@example.com", "None", "project")
+db.add_forecast("budget", 150.0, 100.0, 50.0, 2.0, 1.0)
+class LocalPool(main.ConnectionPool):
+    def _connect(self):
+        return db.connect()
+main.mysql_pool = LocalPool(1, 60)
+main.ses_client = faulty_ses(Faults())
+
+class FlakySlack(LocalSlack):
+    def chat_postMessage(self, channel, text):
+        # Only the alerts fail, the failure report goes through
+        self.faults.error_rate = int(self.failing and not text.startswith("Plutus"))
+        super().chat_postMessage(channel, text)
+
+slack = main.slack_client = FlakySlack(Faults())
+slack.failing = True
+alerted = [main.alert_forecasts()]
+slack.failing = False
+alerted += [main.alert_forecasts(), main.alert_forecasts()]
+print(json.dumps({"alerted": alerted, "emails": len(main.ses_client.sent)}))
+"""
+
+
+def test_routine_notification_skips_heavy_imports():
+    # A fresh interpreter, so modules imported by other tests don't count
+    result = subprocess.run(
+        [sys.executable, "-c", COLD_START % {"heavy": HEAVY_MODULES}],
+        cwd=MONITOR_DIR,
+        env=dict(os.environ, **ENV),
+        stdout=subprocess.PIPE,
+        check=True,
+        universal_newlines=True,
+    )
+    cold_start = json.loads(result.stdout.strip().splitlines()[-1])
+    assert cold_start["heavy_loaded"] == []
+
+
+def test_routine_notification_records_spend_history_in_one_flush():
+    result = subprocess.run(
+        [sys.executable, "-c", SPEND_HISTORY_START % {"latency": MYSQL_LATENCY}],
+        cwd=MONITOR_DIR,
+        env=dict(os.environ, **ENV),
+        stdout=subprocess.PIPE,
+        check=True,
+        universal_newlines=True,
+    )
+    cold_start = json.loads(result.stdout.strip().splitlines()[-1])
+    # Claiming the message id, the hourly expired ids cleanup and the history insert
+    assert cold_start["round_trips"] == 3
+    assert cold_start["redelivery_round_trips"] == 0
+    assert cold_start["history_rows"] == 1
+
+
+# Runs the server's and the subscriber's forecast loops while slack is down, so that both
+# the forecast alerts and the report of their failure fail
+FORECAST_LOOPS = """
+import json, os, threading, time
+os.environ["FORECAST_ALERT_INTERVAL"] = "0.01"
+import main, server, subscriber
+from local_mysql import LocalMySQL
+from local_pubsub import LocalSubscriber
+from loadtest import Faults, LocalSlack, faulty_ses
+
+db = LocalMySQL()
+db.add_budget("budget", "owner@example.com", "None", "project")
+db.add_forecast("budget", 150.0, 100.0, 50.0, 2.0, 1.0)
+class LocalPool(main.ConnectionPool):
+    def _connect(self):
+        return db.connect()
+main.mysql_pool = LocalPool(1, 60)
+main.ses_client = faulty_ses(Faults())
+main.slack_client = LocalSlack(Faults(error_rate=1))
+
+def checks():
+    return db.round_trips["select_forecasts"]
+
+stop = threading.Event()
+client = LocalSubscriber()
+loops = {
+    "server": threading.Thread(target=server.alert_forecasts_periodically, args=(stop,)),
+    "subscriber": threading.Thread(
+        target=subscriber.run, args=(client, "test"), kwargs={"stop": stop}
+    ),
+}
+result = {}
+for name, loop in loops.items():
+    started = checks()
+    loop.start()
+    time.sleep(0.5)
+    result[name] = {"alive": loop.is_alive(), "checks": checks() - started}
+    stop.set()
+    loop.join()
+    stop.clear()
+result["pulls"] = client.calls["pull"]
+print(json.dumps(result))
+"""
+
+
+def replay(tmp_path, *args):
+    report = tmp_path / "report.json"
+    subprocess.run(
+        [
+            sys.executable,
+            "loadtest.py",
+            "--messages=500",
+            "--budgets=50",
+            "--duplicate-rate=0.1",
+            "--mysql-latency=0",
+            "--slack-latency=0",
+            "--ses-latency=0",
+            "--pagerduty-latency=0",
+            f"--json={report}",
+            *args,
+        ],
+        cwd=MONITOR_DIR,
+        env=dict(os.environ, **ENV),
+        stdout=subprocess.DEVNULL,
+        check=True,
+    )
+    return json.loads(report.read_text())
+
+
+def test_replay_sends_no_duplicate_alerts(tmp_path):
+    result = replay(tmp_path, "--mysql-error-rate=0.05", "--slack-error-rate=0.05")
+    assert result["given_up"] == 0
+    assert result["alerts"]["pagerduty"] > 0
+    assert result["duplicate_alerts"] == {"slack": 0, "email": 0, "pagerduty": 0}
+
+
+def test_replay_records_each_message_once(tmp_path):
+    for mode in ["function", "batch"]:
+        result = replay(
+            tmp_path,
+            f"--mode={mode}",
+            "--spend-history",
+            "--slack-error-rate=0.1",
+            "--ack-deadline=0.5",
+        )
+        assert result["deliveries"] > result["messages"]
+        assert result["spend_history_rows"] == result["messages"]
+
+
+def run_monitor(code):
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=MONITOR_DIR,
+        env=dict(os.environ, **ENV),
+        stdout=subprocess.PIPE,
+        check=True,
+        universal_newlines=True,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def test_failed_page_is_sent_on_redelivery():
+    result = run_monitor(FAILED_PAGE % {"mode": "function"})
+    assert result == {"results": ["DeliveryError", "ok"], "pages": 1}
+
+
+def test_failed_batch_page_is_sent_by_the_next_batch():
+    result = run_monitor(FAILED_PAGE % {"mode": "batch"})
+    assert result == {"results": ["AssertionError", "ok"], "pages": 1}
+
+
+def test_routing_changes_apply_to_the_next_alert():
+    # Only last alert times are cached, each claim reads the budget's routing
+    for mode in ["function", "batch"]:
+        result = run_monitor(ROUTING_CHANGE % {"mode": mode})
+        assert result == {"channels": ["before", "after"]}
+
+
+def test_failed_forecast_alert_is_sent_by_the_next_check():
+    result = run_monitor(FAILED_FORECAST)
+    # The first check's email went out, but its slack alerts didn't
+    assert result == {"alerted": [0, 1, 0], "emails": 2}
+
+
+def test_forecast_loops_survive_a_failing_failure_report():
+    result = run_monitor(FORECAST_LOOPS)
+    for loop in ["server", "subscriber"]:
+        assert result[loop]["alive"]
+        assert result[loop]["checks"] > 1
+    assert result["pulls"] > 1
@@ -0,0 +1,91 @@
+import datetime
+
+from plutus.budget_manager.checkpoint import (
+    config_hash,
+    ReconcileRun,
+    STATUS_DONE,
+    STATUS_FAILED,
+)
+from plutus.budget_manager.project_budget import ProjectBudget
+from plutus.lib.constants import PLUTUS_CONFIG_TYPE_PROJECT
+from pytest import fixture
+
+
+@fixture
+def project():
+    project_dict = {
+        "project_id": "some-project-id",
+        "budget_type": "AMT",
+        "budget_amount": 1000,
+    }
+    return ProjectBudget(
+        project_dict, PLUTUS_CONFIG_TYPE_PROJECT, "foo-bar-123", "some-topic"
+    )
+
+
+def gen_run(states, resumed=False):
+    run = ReconcileRun(None, {})
+    run.run_id = "run-1"
+    run.resumed = resumed
+    run.states = states
+    return run
+
+
+def test_config_hash_is_stable():
+    assert config_hash({"a": 1, "b": [1, 2]}) == config_hash({"b": [1, 2], "a": 1})
+    assert config_hash({"a": 1}) != config_hash({"a": 2})
+
+
+def test_no_state_is_not_skipped(project):
+    run = gen_run({})
+    assert run.should_skip(project) is None
+
+
+def test_resumed_run_skips_done_projects(project):
+    key = (PLUTUS_CONFIG_TYPE_PROJECT, "some-project-id")
+    state = ("run-1", STATUS_DONE, 0, None)
+
+    assert gen_run({key: state}, resumed=True).should_skip(project) is not None
+    # A new run reconciles the project again
+    assert gen_run({key: state}, resumed=False).should_skip(project) is None
+    # Only projects done by the resumed run are skipped
+    state = ("run-0", STATUS_DONE, 0, None)
+    assert gen_run({key: state}, resumed=True).should_skip(project) is None
+
+
+def test_failed_projects_back_off(project):
+    key = (PLUTUS_CONFIG_TYPE_PROJECT, "some-project-id")
+    later = datetime.datetime.utcnow() + datetime.timedelta(minutes=5)
+    earlier = datetime.datetime.utcnow() - datetime.timedelta(minutes=5)
+
+    run = gen_run({key: ("run-0", STATUS_FAILED, 2, later)})
+    assert run.should_skip(project) is not None
+    assert run.skipped[0][:2] == key
+
+    run = gen_run({key: ("run-0", STATUS_FAILED, 2, earlier)})
+    assert run.should_skip(project) is None
+
+
+def test_report(project):
+    run = gen_run({})
+    run.record_success(project)
+    assert run.finish() is True
+
+    run.record_failure(project, Exception("boom"))
+    run.record_config_error(PLUTUS_CONFIG_TYPE_PROJECT, None, "bad config")
+    assert len(run.failed) == 2
+    assert run.failed[0] == (PLUTUS_CONFIG_TYPE_PROJECT, "some-project-id", "boom")
+    assert run.finish() is False
+
+
+def test_run_deadline_skips_remaining_projects(project):
+    run = ReconcileRun(None, {}, deadline=0.01)
+    assert run.should_skip(project) is None
+
+    run.deadline -= 1
+    assert run.should_skip(project) == "run deadline reached"
+    assert run.skipped == [
+        (PLUTUS_CONFIG_TYPE_PROJECT, "some-project-id", "run deadline reached")
+    ]
+    # Skipped projects aren't failures
+    assert run.finish()
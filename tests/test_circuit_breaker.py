@@ -0,0 +1,102 @@
+import pytest
+
+from types import SimpleNamespace
+
+from google.api_core.exceptions import NotFound, ServiceUnavailable
+
+from plutus.lib.circuit_breaker import CircuitBreaker
+from plutus.lib.exceptions import CircuitOpenError
+from plutus.lib.gcp_helper import (
+    API_BILLING,
+    API_RESOURCE_MANAGER,
+    DEFAULT_DEADLINES,
+    GcpHelper,
+    parse_deadlines,
+)
+from plutus.lib.mysql import get_owner_emails_for_project
+
+
+def failing(error):
+    def call():
+        raise error
+
+    return call
+
+
+def test_opens_after_consecutive_failures():
+    breaker = CircuitBreaker("billing", threshold=2)
+    for _ in range(2):
+        with pytest.raises(ServiceUnavailable):
+            breaker.call(failing(ServiceUnavailable("down")))
+
+    assert breaker.open
+    with pytest.raises(CircuitOpenError):
+        breaker.call(lambda: "never called")
+
+
+def test_success_resets_the_failure_count():
+    breaker = CircuitBreaker("billing", threshold=2)
+    with pytest.raises(ServiceUnavailable):
+        breaker.call(failing(ServiceUnavailable("down")))
+    assert breaker.call(lambda: "ok") == "ok"
+    with pytest.raises(ServiceUnavailable):
+        breaker.call(failing(ServiceUnavailable("down")))
+
+    assert not breaker.open
+
+
+def test_client_errors_dont_count():
+    breaker = CircuitBreaker("billing", threshold=1)
+    with pytest.raises(NotFound):
+        breaker.call(failing(NotFound("no such budget")))
+
+    assert not breaker.open
+
+
+def test_probes_again_after_cooldown():
+    breaker = CircuitBreaker("billing", threshold=1, cooldown=0)
+    with pytest.raises(ServiceUnavailable):
+        breaker.call(failing(ServiceUnavailable("down")))
+
+    assert breaker.call(lambda: "ok") == "ok"
+    assert breaker.failures == 0
+
+
+def test_gcp_calls_get_method_deadlines():
+    calls = []
+
+    def list_budgets(**kwargs):
+        calls.append(kwargs)
+        return iter(["a", "b"])
+
+    gcp = GcpHelper(None, None, deadlines=parse_deadlines("list_budgets=5"))
+    result = gcp.call(API_BILLING, "list_budgets", list_budgets, paged=True, parent="p")
+
+    assert result == ["a", "b"]
+    assert calls[0]["timeout"] == 5
+    assert calls[0]["parent"] == "p"
+
+
+def test_unknown_deadline_override_is_rejected():
+    with pytest.raises(ValueError):
+        parse_deadlines("list_budget=5")
+
+
+def test_iam_lookup_goes_through_the_breaker():
+    class ResourceManager:
+        def get_iam_policy(self, request, retry, timeout):
+            assert timeout == DEFAULT_DEADLINES["get_iam_policy"]
+            binding = SimpleNamespace(
+                role="roles/owner", members=["user:a@mozilla.com", "group:x@y.com"]
+            )
+            return SimpleNamespace(bindings=[binding])
+
+    gcp = GcpHelper(None, ResourceManager(), breaker_threshold=1)
+    assert (
+        get_owner_emails_for_project(gcp, "p", ["b@x.com"]) == "a@mozilla.com,b@x.com"
+    )
+
+    with pytest.raises(ServiceUnavailable):
+        gcp.breakers[API_RESOURCE_MANAGER].call(failing(ServiceUnavailable("down")))
+    with pytest.raises(CircuitOpenError):
+        get_owner_emails_for_project(gcp, "p", [])
@@ -0,0 +1,74 @@
+from concurrent import futures
+
+import grpc
+import pytest
+
+from plutus.lib import clients
+
+
+@pytest.fixture
+def echo_server():
+    peers = []
+
+    def echo(request, context):
+        peers.append(context.peer())
+        if request == b"fail":
+            context.abort(grpc.StatusCode.UNAVAILABLE, "down")
+        return request
+
+    handler = grpc.method_handlers_generic_handler(
+        "test.Echo", {"Echo": grpc.unary_unary_rpc_method_handler(echo)}
+    )
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=4))
+    server.add_generic_rpc_handlers((handler,))
+    port = server.add_insecure_port("localhost:0")
+    server.start()
+    yield port, peers
+    server.stop(None)
+
+
+@pytest.fixture
+def pool_factory(echo_server, monkeypatch):
+    port, _ = echo_server
+
+    class Transport:
+        @classmethod
+        def create_channel(cls, credentials=None, options=None):
+            return grpc.insecure_channel(f"localhost:{port}", options=options)
+
+    monkeypatch.setattr(clients, "_pools", {})
+    monkeypatch.setattr(clients, "_settings", dict(clients._settings))
+    monkeypatch.setattr(clients, "credentials", lambda: (None, None))
+
+    def create(pool_size):
+        clients.configure(pool_size=pool_size)
+        return clients.channel_pool("echo", Transport)
+
+    return create
+
+
+def test_pool_spreads_calls_over_connections(pool_factory, echo_server):
+    _, peers = echo_server
+    pool = pool_factory(pool_size=2)
+    echo = pool.unary_unary("/test.Echo/Echo")
+
+    assert [echo(b"hi", timeout=5) for _ in range(4)] == [b"hi"] * 4
+    # Each channel is its own connection, from its own local port
+    assert len(set(peers)) == 2
+    assert pool.stats.calls == 4
+    assert pool is clients.channel_pool("echo", None)
+    pool.close()
+
+
+def test_failed_calls_are_counted(pool_factory):
+    pool = pool_factory(pool_size=1)
+    echo = pool.unary_unary("/test.Echo/Echo")
+
+    with pytest.raises(grpc.RpcError):
+        echo(b"fail", timeout=5)
+
+    assert pool.stats.calls == 1
+    assert pool.stats.in_flight == 0
+    clients.report_channel_stats()
+    assert pool.stats.calls == 0
+    pool.close()
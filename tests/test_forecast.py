@@ -0,0 +1,88 @@
+import datetime
+
+from plutus.lib.forecast import forecast, forecast_rows, Series
+from pytest import approx
+
+NOW = datetime.datetime(2020, 6, 11, 0, 0)
+JUNE = datetime.datetime(2020, 6, 1)
+MAY = datetime.datetime(2020, 5, 1)
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def seconds(time):
+    return int((time - EPOCH).total_seconds())
+
+
+def hourly(budget_id, costs, period_start=JUNE, budget_amount=1000.0):
+    """Rows for the last len(costs) hours before NOW, oldest first."""
+    return [
+        (
+            budget_id,
+            seconds(NOW - datetime.timedelta(hours=len(costs) - i)),
+            seconds(period_start),
+            cost,
+            budget_amount,
+        )
+        for i, cost in enumerate(costs)
+    ]
+
+
+def test_steady_spend_is_projected_to_period_end():
+    # 10 days into june at 1/hour
+    result = forecast(Series(hourly("b", [236.0, 237.0, 238.0, 239.0, 240.0])), NOW)
+
+    assert result.burn_rate[0] == approx(1.0)
+    assert result.baseline_rate[0] == approx(1.0)
+    assert result.cost_amount[0] == 240.0
+    # 20 days left in june
+    assert result.projected_cost[0] == approx(240.0 + 20 * 24)
+    assert not result.anomaly[0]
+
+
+def test_spike_is_an_anomaly():
+    result = forecast(Series(hourly("b", [240.0, 250.0, 260.0, 270.0])), NOW)
+
+    assert result.burn_rate[0] == approx(10.0)
+    assert result.anomaly[0]
+    assert result.projected_cost[0] > 1000.0
+
+
+def test_budgets_are_forecast_independently():
+    rows = hourly("a", [10.0, 20.0, 30.0]) + hourly("b", [5.0, 5.0])
+    result = forecast(Series(rows), NOW)
+
+    assert list(result.budget_ids) == ["a", "b"]
+    assert list(result.burn_rate) == approx([10.0, 0.0])
+    assert list(result.points) == [3, 2]
+
+
+def test_only_latest_period_is_fit():
+    # Costs restart at 0 when june starts, may's costs must not pull the slope down
+    rows = hourly("b", [900.0, 950.0], period_start=MAY)[:1] + hourly(
+        "b", [1.0, 2.0, 3.0]
+    )
+    result = forecast(Series(sorted(rows, key=lambda row: row[1])), NOW)
+
+    assert result.period_start[0] == JUNE
+    assert result.burn_rate[0] == approx(1.0)
+    assert result.points[0] == 3
+
+
+def test_single_point_has_no_burn_rate():
+    result = forecast(Series(hourly("b", [100.0])), NOW)
+    assert result.burn_rate[0] == 0.0
+    assert not result.anomaly[0]
+
+
+def test_no_rows():
+    assert forecast(Series([]), NOW) is None
+
+
+def test_rows_are_plain_python():
+    result = forecast(Series(hourly("b", [1.0, 2.0, 3.0])), NOW)
+    (row,) = forecast_rows(result, NOW)
+
+    assert row[:3] == ("b", JUNE, NOW)
+    assert all(
+        type(value) in (str, datetime.datetime, float, bool, int) for value in row
+    )
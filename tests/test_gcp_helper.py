@@ -1,3 +1,6 @@
+from google.api_core.exceptions import BadRequest
+from plutus.budget_manager.checkpoint import ReconcileRun
+from plutus.budget_manager.main import reconcile_project, reconcile_project_budget
 from plutus.lib.constants import PLUTUS_CONFIG_TYPE_PROJECT
 from plutus.lib.gcp_helper import GcpHelper
 from plutus.budget_manager.project_budget import ProjectBudget
@@ -249,3 +252,23 @@ def test_toggle_pubsub_false(project):
     )
     assert same is False
     assert returned_budget["notifications_rule"] == {}
+
+
+class FailingBilling:
+    def common_billing_account_path(self, billing_account_id):
+        return f"billingAccounts/{billing_account_id}"
+
+    def create_budget(self, **kwargs):
+        raise BadRequest("invalid budget")
+
+
+def test_failed_create_fails_the_project(project, monkeypatch):
+    gcp = GcpHelper(FailingBilling(), None)
+    monkeypatch.setattr(gcp, "get_project_number", lambda project_id: "12345")
+    monkeypatch.setattr(gcp, "get_budgets_by_project", lambda *args: [])
+
+    run = ReconcileRun(None, {})
+    reconcile_project(run, project, reconcile_project_budget, gcp, None, project, False)
+
+    assert run.succeeded == []
+    assert run.failed[0][:2] == (PLUTUS_CONFIG_TYPE_PROJECT, "some-project-id")
@@ -0,0 +1,76 @@
+from markus.backends import BackendBase
+from markus.main import MetricsRecord
+from plutus.lib.metrics import BufferedMetrics, TagCardinalityFilter
+
+
+class ListMetrics(BackendBase):
+    """Markus backend that collects emitted records in a list."""
+
+    records = []
+
+    def emit(self, record):
+        ListMetrics.records.append(
+            (record.stat_type, record.key, record.value, record.tags)
+        )
+
+
+def gen_buffered(**options):
+    ListMetrics.records = []
+    options["backend"] = {"class": ListMetrics}
+    return BufferedMetrics(options=options)
+
+
+def test_tag_filter_drops_non_allowlisted_tags():
+    tag_filter = TagCardinalityFilter(allowlist=["type"])
+    tags = tag_filter.filter_tags(["type:misconfig", "project_id:foo"])
+    assert tags == ["type:misconfig"]
+
+
+def test_tag_filter_hash_buckets():
+    tag_filter = TagCardinalityFilter(allowlist=["type"], buckets=4)
+    tags = tag_filter.filter_tags(["type:misconfig", "project_id:foo"])
+    assert tags[1].startswith("type:")
+    assert tags[0] in [f"project_id:bucket-{i}" for i in range(4)]
+    # Buckets are stable across calls
+    assert tag_filter.filter_tags(["project_id:foo"]) == [tags[0]]
+
+
+def test_counters_are_aggregated():
+    buffered = gen_buffered()
+    for project_id in ("a", "b", "c"):
+        buffered.emit(
+            MetricsRecord(
+                "incr",
+                "upsert_count",
+                1,
+                ["config_type:PROJECT", f"project_id:{project_id}"],
+            )
+        )
+    buffered.emit(MetricsRecord("gauge", "budget_count", 5, []))
+    buffered.emit(MetricsRecord("gauge", "budget_count", 7, []))
+    assert ListMetrics.records == []
+
+    buffered.flush()
+    assert ListMetrics.records == [
+        ("incr", "upsert_count", 3, ["config_type:PROJECT"]),
+        ("gauge", "budget_count", 7, []),
+    ]
+
+    # Buffer is emptied on flush
+    ListMetrics.records = []
+    buffered.flush()
+    assert ListMetrics.records == []
+
+
+def test_timings_are_summarized():
+    buffered = gen_buffered()
+    for value in range(1, 101):
+        buffered.emit(MetricsRecord("timing", "latency", value, []))
+    buffered.flush()
+
+    assert ListMetrics.records == [
+        ("incr", "latency.count", 100, []),
+        ("gauge", "latency.avg", 50.5, []),
+        ("gauge", "latency.max", 100, []),
+        ("gauge", "latency.p95", 95, []),
+    ]
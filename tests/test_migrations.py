@@ -0,0 +1,237 @@
+import os
+import pytest
+import re
+
+from pymysql.err import OperationalError, ProgrammingError
+
+from plutus.lib.exceptions import MigrationError
+from plutus.lib.migrations import load_migrations, migrate, Migration, MIGRATIONS_DIR
+
+BASELINE_SCHEMA = os.path.join(
+    os.path.dirname(__file__), "files", "baseline_tables.sql"
+)
+CURRENT_SCHEMA = os.path.join(os.path.dirname(MIGRATIONS_DIR), "tables.sql")
+
+
+class FakeCursor:
+    def __init__(self, applied=None, errors=None, lock=1):
+        self.applied = dict(applied or {})
+        self.errors = dict(errors or {})
+        self.lock = lock
+        self.executed = []
+        self.result = []
+
+    def execute(self, sql, args=None):
+        self.executed.append(sql)
+        for statement, error in self.errors.items():
+            if sql.startswith(statement):
+                raise error
+        if sql.startswith("SELECT GET_LOCK"):
+            self.result = [(self.lock,)]
+        elif sql.startswith("SELECT version"):
+            self.result = list(self.applied.items())
+        elif sql.startswith("INSERT INTO schema_version"):
+            self.applied[args[0]] = args[2]
+        return 1
+
+    def fetchone(self):
+        return self.result[0]
+
+    def fetchall(self):
+        return self.result
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class SchemaCursor(FakeCursor):
+    """
+    Keeps track of the tables (with their columns and indexes) and procedures statements
+    create, and fails like mysql on a missing table or a change that was already made.
+    """
+
+    def __init__(self, schema_file):
+        super().__init__()
+        self.tables = {}
+        self.procedures = set()
+        with open(schema_file) as f:
+            for statement in Migration(0, "schema", f.read()).statements():
+                self.execute(statement)
+
+    def table(self, name):
+        if name not in self.tables:
+            raise ProgrammingError(1146, f"Table 'plutus.{name}' doesn't exist")
+        return self.tables[name]
+
+    def execute(self, sql, args=None):
+        words = sql.split()
+        if sql.startswith(("SELECT", "INSERT INTO schema_version")):
+            return super().execute(sql, args)
+        self.executed.append(sql)
+
+        if sql.startswith("CREATE TABLE IF NOT EXISTS"):
+            columns, indexes = set(), set()
+            for line in sql.splitlines()[1:]:
+                first = line.split()[0]
+                if first.startswith(")"):
+                    break
+                if first == "INDEX":
+                    indexes.add(line.split()[1])
+                elif first not in ("PRIMARY", "KEY", "UNIQUE"):
+                    columns.add(first)
+            self.tables.setdefault(words[5], {"columns": columns, "indexes": indexes})
+        elif sql.startswith("ALTER TABLE"):
+            table = self.table(words[2])
+            for column in re.findall(r"ADD COLUMN (\w+)", sql):
+                if column in table["columns"]:
+                    raise OperationalError(1060, f"Duplicate column name '{column}'")
+                table["columns"].add(column)
+            for column in re.findall(r"MODIFY (\w+)", sql):
+                if column not in table["columns"]:
+                    raise OperationalError(1054, f"Unknown column '{column}'")
+            for index in re.findall(r"ADD INDEX (\w+)", sql):
+                if index in table["indexes"]:
+                    raise OperationalError(1061, f"Duplicate key name '{index}'")
+                table["indexes"].add(index)
+            for index in re.findall(r"DROP INDEX (\w+)", sql):
+                if index not in table["indexes"]:
+                    raise OperationalError(1091, f"Can't DROP '{index}'")
+                table["indexes"].remove(index)
+        elif sql.startswith("UPDATE"):
+            self.table(words[1])
+        elif sql.startswith("DROP PROCEDURE IF EXISTS"):
+            self.procedures.discard(words[4])
+        elif sql.startswith("CREATE PROCEDURE"):
+            self.procedures.add(words[2].split("(")[0])
+        elif not sql.startswith(("CREATE DATABASE", "USE")):
+            raise AssertionError(f"SchemaCursor can't run: {sql[:80]}")
+        return 0
+
+
+class FakeConnection:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def cursor(self):
+        return self._cursor
+
+
+def write_migrations(tmp_path):
+    (tmp_path / "0002_second.sql").write_text(
+        "-- Second\nALTER TABLE t ADD INDEX b_idx (b);\nUPDATE t SET a = 1;\n"
+    )
+    (tmp_path / "0001_first.sql").write_text("ALTER TABLE t\n  ADD INDEX a_idx (a);\n")
+    (tmp_path / "README.md").write_text("Not a migration")
+    return tmp_path
+
+
+def test_repo_migrations_load_in_order():
+    versions = [m.version for m in load_migrations(MIGRATIONS_DIR)]
+    assert versions == sorted(versions)
+    assert versions[:2] == [1, 2]
+
+
+def test_statements_are_split_without_comments(tmp_path):
+    first, second = load_migrations(write_migrations(tmp_path))
+    assert first.statements() == ["ALTER TABLE t\n  ADD INDEX a_idx (a)"]
+    assert second.statements() == [
+        "ALTER TABLE t ADD INDEX b_idx (b)",
+        "UPDATE t SET a = 1",
+    ]
+
+
+def test_only_pending_migrations_are_applied(tmp_path):
+    migrations = load_migrations(write_migrations(tmp_path))
+    cursor = FakeCursor(applied={1: migrations[0].checksum})
+
+    applied = migrate(FakeConnection(cursor), str(tmp_path))
+
+    assert [m.version for m in applied] == [2]
+    assert "ALTER TABLE t\n  ADD INDEX a_idx (a)" not in cursor.executed
+    assert "UPDATE t SET a = 1" in cursor.executed
+    assert cursor.applied[2] == migrations[1].checksum
+    assert cursor.executed[-1].startswith("SELECT RELEASE_LOCK")
+
+
+def test_dry_run_applies_nothing(tmp_path):
+    cursor = FakeCursor(
+        errors={"SELECT version": ProgrammingError(1146, "Table doesn't exist")}
+    )
+
+    pending = migrate(FakeConnection(cursor), str(write_migrations(tmp_path)), True)
+
+    assert [m.version for m in pending] == [1, 2]
+    assert cursor.executed == ["SELECT version, checksum FROM schema_version"]
+
+
+def test_already_applied_statements_are_skipped(tmp_path):
+    cursor = FakeCursor(
+        errors={"ALTER TABLE t\n": OperationalError(1061, "Duplicate key name 'a_idx'")}
+    )
+
+    applied = migrate(FakeConnection(cursor), str(write_migrations(tmp_path)))
+
+    assert [m.version for m in applied] == [1, 2]
+    assert set(cursor.applied) == {1, 2}
+
+
+def test_failed_migration_is_not_recorded(tmp_path):
+    cursor = FakeCursor(
+        errors={"UPDATE t": OperationalError(1205, "Lock wait timeout")}
+    )
+
+    with pytest.raises(MigrationError):
+        migrate(FakeConnection(cursor), str(write_migrations(tmp_path)))
+
+    assert set(cursor.applied) == {1}
+    assert cursor.executed[-1].startswith("SELECT RELEASE_LOCK")
+
+
+def test_lock_timeout_raises(tmp_path):
+    cursor = FakeCursor(lock=0)
+
+    with pytest.raises(MigrationError):
+        migrate(FakeConnection(cursor), str(write_migrations(tmp_path)))
+
+    assert cursor.applied == {}
+
+
+def test_boolean_columns_are_compared_as_strings():
+    # Comparing a BOOLEAN (TINYINT) column to 'TRUE' is an error in strict mode
+    typed = [m for m in load_migrations(MIGRATIONS_DIR) if m.name == "typed_columns"][0]
+    for column in ("include_credits", "pubsub", "deprecated"):
+        assert f"{column} IN" not in typed.sql
+        assert f"CAST({column} AS CHAR) IN" in typed.sql
+
+
+@pytest.mark.parametrize("schema", [BASELINE_SCHEMA, CURRENT_SCHEMA])
+def test_repo_migrations_apply(schema):
+    # Existing databases were created from the original tables.sql, new ones from today's
+    cursor = SchemaCursor(schema)
+
+    applied = migrate(FakeConnection(cursor))
+
+    assert [m.version for m in applied] == [m.version for m in load_migrations()]
+    for name, table in SchemaCursor(CURRENT_SCHEMA).tables.items():
+        assert table["columns"] <= cursor.tables[name]["columns"]
+        assert table["indexes"] <= cursor.tables[name]["indexes"]
+    assert cursor.procedures == {"claim_alert"}
+
+
+def test_procedure_statements_use_their_delimiter(tmp_path):
+    (tmp_path / "0001_proc.sql").write_text(
+        "DROP PROCEDURE IF EXISTS p;\n"
+        "DELIMITER //\n"
+        "CREATE PROCEDURE p()\nBEGIN\n  SELECT 1;\n  SELECT 2;\nEND //\n"
+        "DELIMITER ;\n"
+        "SELECT 3;\n"
+    )
+    (migration,) = load_migrations(tmp_path)
+    assert migration.statements() == [
+        "DROP PROCEDURE IF EXISTS p",
+        "CREATE PROCEDURE p()\nBEGIN\n  SELECT 1;\n  SELECT 2;\nEND",
+        "SELECT 3",
+    ]
@@ -0,0 +1,31 @@
+import os
+
+from plutus.lib.profiling import PhaseProfiler
+
+
+def test_disabled_profiler_is_noop(tmp_path):
+    profiler = PhaseProfiler()
+    with profiler.phase("reconcile"):
+        pass
+    profiler.stop()
+    assert os.listdir(tmp_path) == []
+
+
+def test_nested_phases(tmp_path):
+    profiler = PhaseProfiler()
+    profiler.start(str(tmp_path))
+    with profiler.phase("reconcile"):
+        for _ in range(3):
+            with profiler.phase("mysql"):
+                sum(range(1000))
+    profiler.stop()
+
+    files = os.listdir(tmp_path)
+    for name in ("reconcile", "mysql"):
+        assert f"{name}.prof" in files
+        assert f"{name}.snapshot" in files
+    assert "summary.txt" in files
+
+    with open(tmp_path / "summary.txt") as f:
+        rows = {line.split()[0]: line.split()[1] for line in f.readlines()[1:3]}
+    assert rows == {"reconcile": "1", "mysql": "3"}
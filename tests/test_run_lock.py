@@ -0,0 +1,123 @@
+import datetime
+import time
+
+from pymysql.err import ProgrammingError
+
+from plutus.budget_manager.run_lock import RunLock
+
+
+class FakeLeases:
+    """Stand-in for the run_locks table, with the upsert's take-if-expired semantics."""
+
+    def __init__(self, error=None):
+        self.leases = {}
+        self.error = error
+
+    def connect(self):
+        return FakeConnection(self)
+
+
+class FakeConnection:
+    def __init__(self, db):
+        self.db = db
+
+    def cursor(self):
+        return FakeCursor(self.db)
+
+    def close(self):
+        pass
+
+
+class FakeCursor:
+    def __init__(self, db):
+        self.db = db
+        self.row = None
+
+    def execute(self, sql, args):
+        if self.db.error is not None:
+            raise self.db.error
+        now = datetime.datetime.utcnow()
+        leases = self.db.leases
+        if sql.startswith("INSERT INTO run_locks"):
+            name, holder, ttl = args
+            current = leases.get(name)
+            if current is None or current[1] < now or current[0] == holder:
+                leases[name] = (holder, now + datetime.timedelta(seconds=ttl))
+        elif sql.startswith("SELECT"):
+            self.row = leases.get(args[0])
+        elif sql.startswith("UPDATE run_locks"):
+            ttl, name, holder = args
+            if leases.get(name, (None,))[0] == holder:
+                leases[name] = (holder, now + datetime.timedelta(seconds=ttl))
+                return 1
+        elif sql.startswith("DELETE FROM run_locks"):
+            if leases.get(args[0], (None,))[0] == args[1]:
+                del leases[args[0]]
+        return 0
+
+    def fetchone(self):
+        return self.row
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+def test_second_run_is_skipped_until_release():
+    db = FakeLeases()
+    first = RunLock(db.connect)
+    second = RunLock(db.connect)
+
+    assert first.acquire()
+    assert not second.acquire()
+
+    first.release()
+    assert second.acquire()
+    second.release()
+    assert db.leases == {}
+
+
+def test_expired_lease_is_taken_over():
+    db = FakeLeases()
+    db.leases["budget_manager"] = ("crashed", datetime.datetime(2020, 1, 1))
+    lock = RunLock(db.connect)
+
+    assert lock.acquire()
+    assert db.leases["budget_manager"][0] == lock.holder
+    lock.release()
+
+
+def test_waits_for_the_holder():
+    db = FakeLeases()
+    db.leases["budget_manager"] = (
+        "other",
+        datetime.datetime.utcnow() + datetime.timedelta(seconds=0.2),
+    )
+    lock = RunLock(db.connect, poll_interval=0.1)
+
+    assert lock.acquire(wait=5)
+    lock.release()
+
+
+def test_heartbeat_notices_a_lost_lease():
+    db = FakeLeases()
+    lock = RunLock(db.connect, ttl=0.2)
+    assert lock.acquire()
+
+    db.leases["budget_manager"] = ("other", datetime.datetime(2100, 1, 1))
+    assert lock.lost.wait(2)
+    lock.release()
+    # The other holder's lease is left alone
+    assert db.leases["budget_manager"][0] == "other"
+
+
+def test_runs_unlocked_without_the_table():
+    db = FakeLeases(error=ProgrammingError(1146, "Table 'run_locks' doesn't exist"))
+    lock = RunLock(db.connect)
+
+    started = time.monotonic()
+    assert lock.acquire(wait=60)
+    assert time.monotonic() - started < 1
+    assert not lock.acquired
@@ -0,0 +1,106 @@
+import datetime
+
+from plutus.budget_manager.checkpoint import ReconcileRun
+from plutus.budget_manager.main import run_scheduled
+from plutus.budget_manager.project_budget import ProjectBudget
+from plutus.budget_manager.scheduler import (
+    PRIORITY_CHANGED,
+    PRIORITY_FRESH,
+    PRIORITY_NEW,
+    PRIORITY_STALE,
+    ReconcileScheduler,
+)
+from plutus.lib.constants import PLUTUS_CONFIG_TYPE_PARENT, PLUTUS_CONFIG_TYPE_PROJECT
+
+NOW = datetime.datetime(2026, 1, 10)
+PROJECT = PLUTUS_CONFIG_TYPE_PROJECT
+PARENT = PLUTUS_CONFIG_TYPE_PARENT
+
+
+def gen_project(project_id, config_type=PLUTUS_CONFIG_TYPE_PROJECT, amount=1000):
+    project_dict = {
+        "project_id": project_id,
+        "budget_type": "AMT",
+        "budget_amount": amount,
+    }
+    if config_type == PLUTUS_CONFIG_TYPE_PARENT:
+        project_dict["parent_folder_id"] = "1234"
+    return ProjectBudget(project_dict, config_type, "foo-bar-123", "some-topic")
+
+
+def verified_state(project, days_ago):
+    return project.entry_hash, NOW - datetime.timedelta(days=days_ago)
+
+
+def gen_scheduler(projects, priorities):
+    scheduler = ReconcileScheduler(priorities, stale_after=86400, now=NOW)
+    for project in projects:
+        scheduler.add(project, None)
+    return scheduler
+
+
+def test_priorities():
+    fresh, stale, changed, new = [gen_project(p) for p in ("a", "b", "c", "d")]
+    priorities = {
+        (PROJECT, "a"): verified_state(fresh, 0.5),
+        (PROJECT, "b"): verified_state(stale, 2),
+        (PROJECT, "c"): verified_state(gen_project("c", amount=50), 0.5),
+    }
+    scheduler = gen_scheduler([fresh, stale, changed, new], priorities)
+
+    assert scheduler.priority(fresh)[0] == PRIORITY_FRESH
+    assert scheduler.priority(stale)[0] == PRIORITY_STALE
+    assert scheduler.priority(changed)[0] == PRIORITY_CHANGED
+    assert scheduler.priority(new) == (PRIORITY_NEW, None)
+    assert [w.project.project_id for w in scheduler.ordered()] == ["d", "c", "b", "a"]
+
+
+def test_state_without_hash_is_not_changed():
+    project = gen_project("a")
+    scheduler = gen_scheduler([], {(PROJECT, "a"): (None, None)})
+    assert scheduler.priority(project)[0] == PRIORITY_STALE
+
+
+def test_least_recently_verified_first_then_config_order():
+    projects = [gen_project(p) for p in ("a", "b", "c", "d")]
+    priorities = {
+        (PROJECT, "a"): verified_state(projects[0], 3),
+        (PROJECT, "b"): verified_state(projects[1], 5),
+    }
+    scheduler = gen_scheduler(projects, priorities)
+    order = [w.project.project_id for w in scheduler.ordered()]
+    assert order == ["c", "d", "b", "a"]
+
+
+def test_project_work_runs_together_in_config_order():
+    own = gen_project("a")
+    in_folder = gen_project("a", PLUTUS_CONFIG_TYPE_PARENT)
+    other = gen_project("b")
+    priorities = {
+        (PROJECT, "a"): verified_state(own, 0),
+        (PROJECT, "b"): verified_state(other, 2),
+    }
+    # The folder entry for a is new, which brings a's own budget forward with it
+    scheduler = gen_scheduler([own, other, in_folder], priorities)
+    order = [(w.project.config_type, w.project.project_id) for w in scheduler.ordered()]
+    assert order == [(PROJECT, "a"), (PARENT, "a"), (PROJECT, "b")]
+
+
+def test_run_deadline_leaves_least_urgent_work_undone():
+    projects = [gen_project(p) for p in ("a", "b", "c")]
+    priorities = {(PROJECT, "a"): verified_state(projects[0], 0)}
+    scheduler = ReconcileScheduler(priorities, now=NOW)
+    run = ReconcileRun(None, {}, deadline=60)
+
+    reconciled = []
+
+    def reconcile(project):
+        reconciled.append(project.project_id)
+        run.deadline -= 60
+
+    for project in projects:
+        scheduler.add(project, reconcile, project)
+    run_scheduled(run, scheduler)
+
+    assert reconciled == ["b"]
+    assert [s[1] for s in run.skipped] == ["c", "a"]
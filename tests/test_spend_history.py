@@ -0,0 +1,80 @@
+import datetime
+
+from plutus.lib.spend_history import (
+    maintain_partitions,
+    plan_partitions,
+    rollup_spend_history,
+)
+
+TODAY = datetime.date(2020, 6, 10)
+
+
+class FakeCursor:
+    def __init__(self, partitions=()):
+        self.partitions = partitions
+        self.executed = []
+
+    def execute(self, sql, args=None):
+        self.executed.append((sql, args))
+        return 1
+
+    def fetchall(self):
+        return [(name,) for name in self.partitions]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class FakeConnection:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def cursor(self):
+        return self._cursor
+
+
+def test_new_table_gets_partitions_from_today():
+    to_add, to_drop = plan_partitions(["p_future"], TODAY, 35)
+    assert to_add == [TODAY + datetime.timedelta(days=i) for i in range(4)]
+    assert to_drop == []
+
+
+def test_existing_partitions_are_only_extended():
+    to_add, _ = plan_partitions(["p20200612", "p20200611", "p_future"], TODAY, 35)
+    assert to_add == [datetime.date(2020, 6, 13)]
+    to_add, _ = plan_partitions(["p20200613", "p_future"], TODAY, 35)
+    assert to_add == []
+
+
+def test_expired_partitions_are_dropped():
+    existing = ["p20200505", "p20200506", "p20200507", "p20200613", "p_future"]
+    _, to_drop = plan_partitions(existing, TODAY, 35)
+    assert to_drop == ["p20200505"]
+
+
+def test_maintain_partitions_reorganizes_catch_all_partition():
+    cursor = FakeCursor(["p20200505", "p20200612", "p_future"])
+    maintain_partitions(cursor, TODAY, 35)
+
+    reorganize, drop = [sql for sql, _ in cursor.executed[1:]]
+    assert reorganize.startswith(
+        "ALTER TABLE spend_history REORGANIZE PARTITION p_future"
+    )
+    assert "PARTITION p20200613 VALUES LESS THAN (TO_DAYS('2020-06-14'))" in reorganize
+    assert reorganize.endswith("PARTITION p_future VALUES LESS THAN MAXVALUE)")
+    assert drop == "ALTER TABLE spend_history DROP PARTITION p20200505"
+
+
+def test_rollups_recompute_whole_buckets():
+    cursor = FakeCursor(["p20200613", "p_future"])
+    now = datetime.datetime(2020, 6, 10, 14, 25, 31, 500)
+    rollup_spend_history(FakeConnection(cursor), 35, now=now)
+
+    (hourly, hourly_args), (daily, daily_args) = cursor.executed[1:]
+    assert hourly.startswith("INSERT INTO spend_hourly")
+    assert hourly_args == (datetime.datetime(2020, 6, 10, 11, 0),)
+    assert daily.startswith("INSERT INTO spend_daily")
+    assert daily_args == (datetime.datetime(2020, 6, 8),)
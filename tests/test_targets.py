@@ -0,0 +1,133 @@
+import copy
+from types import SimpleNamespace
+
+import pytest
+
+from plutus.budget_manager.checkpoint import ReconcileRun
+from plutus.budget_manager.main import reconcile_targets
+from plutus.budget_manager.scheduler import ReconcileScheduler
+from plutus.budget_manager.targets import (
+    folder_id,
+    matching_entries,
+    parse_label_selector,
+    select_entries,
+    TargetProject,
+)
+from plutus.lib.circuit_breaker import CircuitBreaker
+from tests.test_watch import CONFIG
+
+
+class FakeResourceManager:
+    def __init__(self, projects, folders):
+        self.projects = projects
+        self.folders = folders
+
+    def get_project(self, name):
+        return self.projects[name.split("/")[1]]
+
+    def list_projects(self, parent):
+        return [SimpleNamespace(project_id=p) for p in self.folders[parent]]
+
+
+class FakeGcp:
+    def __init__(self, projects=None, folders=None):
+        self.resource_manager_client = FakeResourceManager(
+            projects or {}, folders or {}
+        )
+        self.breakers = {
+            api: CircuitBreaker(api) for api in ("billing", "resourcemanager", "asset")
+        }
+
+    def call(self, api, method, func, paged=False, **kwargs):
+        return func(**kwargs)
+
+
+def gcp_project(project_id, parent="folders/1234", labels=None, state="ACTIVE"):
+    return SimpleNamespace(
+        project_id=project_id,
+        parent=parent,
+        labels=labels or {},
+        state=SimpleNamespace(name=state),
+    )
+
+
+def queued(project_ids=(), folder_ids=(), labels=None, gcp=None):
+    run = ReconcileRun(None, {})
+    scheduler = ReconcileScheduler({})
+    reconcile_targets(
+        run,
+        scheduler,
+        # Parent folder and label entries get each of their projects' project_id set
+        copy.deepcopy(CONFIG),
+        project_ids,
+        folder_ids,
+        labels or {},
+        gcp or FakeGcp(),
+        None,
+        "0-0-0",
+        "t",
+        True,
+    )
+    work = [(w.project.config_type, w.project.project_id) for w in scheduler.ordered()]
+    sections = [w.span_attributes["section"] for w in scheduler.ordered()]
+    return work, sections, run
+
+
+def test_parse_label_selector():
+    assert parse_label_selector(["team=data", "env=prod"]) == {
+        "team": "data",
+        "env": "prod",
+    }
+    with pytest.raises(ValueError):
+        parse_label_selector(["team"])
+
+
+def test_folder_id():
+    assert folder_id("folders/1234") == "1234"
+    assert folder_id("organizations/1") is None
+
+
+def test_select_entries():
+    selected = select_entries(CONFIG, ["1234"], {"team": "data"})
+    assert selected["projects"] == []
+    assert selected["parent_folders"] == CONFIG["parent_folders"]
+    assert selected["labels"] == CONFIG["labels"]
+
+    selected = select_entries(CONFIG, [], {"team": "ops"})
+    assert selected["parent_folders"] == selected["labels"] == []
+
+
+def test_matching_entries():
+    project = TargetProject("moz-fx-one", "1234", {"team": "data", "env": "prod"})
+    assert [t for t, _ in matching_entries(CONFIG, project)] == [
+        "PROJECT",
+        "PARENT",
+        "LABEL",
+    ]
+    assert matching_entries(CONFIG, TargetProject("other", "999", {})) == []
+
+
+def test_only_project_is_looked_up_and_matched_without_sweeps():
+    gcp = FakeGcp(
+        projects={"moz-fx-one": gcp_project("moz-fx-one", labels={"team": "data"})}
+    )
+    work, sections, run = queued(project_ids=["moz-fx-one"], gcp=gcp)
+    # Not every project in folder 1234, only this one
+    assert work == [("PROJECT", "moz-fx-one"), ("PARENT", "moz-fx-one")]
+    assert sections == ["projects", "parent_folders"]
+    assert not run.failed
+
+
+def test_only_folder_expands_only_that_folder():
+    gcp = FakeGcp(folders={"folders/1234": ["a", "b"]})
+    work, sections, run = queued(folder_ids=["1234", "999"], gcp=gcp)
+    assert work == [("PARENT", "a"), ("PARENT", "b")]
+    assert sections == ["parent_folders", "parent_folders"]
+    assert run.failed == [("PARENT", "999", "No budget configured")]
+
+
+def test_unknown_or_inactive_projects_fail():
+    gcp = FakeGcp(projects={"gone": gcp_project("gone", state="DELETE_REQUESTED")})
+    work, _, run = queued(project_ids=["gone", "missing"], gcp=gcp)
+    assert work == []
+    assert [f[1] for f in run.failed] == ["gone", "missing"]
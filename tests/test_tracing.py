@@ -0,0 +1,117 @@
+import json
+
+from plutus.lib.tracing import (
+    critical_path,
+    JsonLinesExporter,
+    load_spans,
+    self_time_breakdown,
+    slowest_projects,
+    Tracer,
+)
+
+
+def gen_span(name, span_id, parent_id, start, end, **attributes):
+    return {
+        "name": name,
+        "trace_id": "t",
+        "span_id": span_id,
+        "parent_id": parent_id,
+        "start_ns": start,
+        "end_ns": end,
+        "duration_ms": (end - start) / 1e6,
+        "status": "ok",
+        "attributes": attributes,
+    }
+
+
+def gen_spans():
+    ms = 1000000
+    return [
+        gen_span("run", "r", None, 0, 100 * ms),
+        gen_span("section", "s1", "r", 0, 60 * ms, section="projects"),
+        gen_span("project", "p1", "s1", 0, 10 * ms, project_id="fast"),
+        gen_span("project", "p2", "s1", 10 * ms, 60 * ms, project_id="slow"),
+        gen_span("gcp.list_budgets", "c1", "p2", 10 * ms, 50 * ms),
+        gen_span("section", "s2", "r", 60 * ms, 100 * ms, section="labels"),
+    ]
+
+
+def test_nested_spans_are_parented(tmp_path):
+    trace_file = str(tmp_path / "trace.jsonl")
+    tracer = Tracer(JsonLinesExporter(trace_file))
+    with tracer.span("run"):
+        with tracer.span("project", project_id="foo"):
+            pass
+    tracer.shutdown()
+
+    spans = load_spans(trace_file)
+    # Spans are exported when they finish, so the child comes first
+    assert [s["name"] for s in spans] == ["project", "run"]
+    assert spans[0]["parent_id"] == spans[1]["span_id"]
+    assert spans[1]["parent_id"] is None
+    assert spans[0]["attributes"] == {"project_id": "foo"}
+
+
+def test_reused_trace_file_loads_one_run(tmp_path):
+    trace_file = str(tmp_path / "trace.jsonl")
+    trace_ids = []
+    for project_id in ("first", "second"):
+        tracer = Tracer(JsonLinesExporter(trace_file))
+        with tracer.span("run"):
+            with tracer.span("project", project_id=project_id):
+                pass
+        tracer.shutdown()
+        trace_ids.append(tracer.trace_id)
+
+    spans = load_spans(trace_file)
+    assert len(spans) == 2
+    assert spans[0]["attributes"] == {"project_id": "second"}
+
+    spans = load_spans(trace_file, trace_id=trace_ids[0])
+    assert spans[0]["attributes"] == {"project_id": "first"}
+
+
+def test_span_records_error(tmp_path):
+    trace_file = str(tmp_path / "trace.jsonl")
+    tracer = Tracer(JsonLinesExporter(trace_file))
+    try:
+        with tracer.span("run"):
+            raise ValueError("boom")
+    except ValueError:
+        pass
+    tracer.shutdown()
+
+    with open(trace_file) as f:
+        span = json.loads(f.readline())
+    assert span["status"] == "error"
+    assert span["attributes"]["error"] == "ValueError: boom"
+    assert tracer.current_span() is None
+
+
+def test_slowest_projects():
+    projects = slowest_projects(gen_spans())
+    assert projects == [("slow", "projects", 50.0), ("fast", "projects", 10.0)]
+    assert slowest_projects(gen_spans(), limit=1) == [("slow", "projects", 50.0)]
+
+
+def test_critical_path():
+    path = [s["span_id"] for s in critical_path(gen_spans())]
+    assert path == ["r", "s1", "p1", "p2", "c1", "s2"]
+
+
+def test_self_time_breakdown():
+    breakdown = {name: ms for name, ms, _ in self_time_breakdown(gen_spans())}
+    assert breakdown["gcp.list_budgets"] == 40.0
+    # 50ms project minus 40ms listing, plus 10ms for the fast project
+    assert breakdown["project"] == 20.0
+    assert breakdown["run"] == 0.0
+
+
+def test_slowest_projects_keep_the_section_that_queued_them():
+    ms = 1000000
+    spans = [
+        gen_span("section", "s1", None, 0, 30 * ms, section="reconcile"),
+        gen_span("project", "p1", "s1", 0, 10 * ms, project_id="a", section="labels"),
+        gen_span("project", "p2", "s1", 10 * ms, 30 * ms, project_id="b"),
+    ]
+    assert slowest_projects(spans) == [("b", "reconcile", 20.0), ("a", "labels", 10.0)]
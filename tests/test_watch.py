@@ -0,0 +1,226 @@
+import threading
+
+from types import SimpleNamespace
+
+from plutus.budget_manager import watch
+from plutus.budget_monitor.local_pubsub import LocalSubscriber
+
+CONFIG = {
+    "projects": [
+        {
+            "project_id": "moz-fx-one",
+            "budget_type": "AMT",
+            "budget_amount": 100,
+            "alert_emails": [],
+            "threshold_rules": [
+                {"threshold_percent": 0.5, "spend_basis": "CURRENT_SPEND"}
+            ],
+            "include_credits": True,
+            "pubsub": True,
+        }
+    ],
+    "parent_folders": [
+        {
+            "parent_folder_id": 1234,
+            "budget_type": "AMT",
+            "budget_amount": 50,
+            "alert_emails": [],
+            "threshold_rules": [
+                {"threshold_percent": 0.5, "spend_basis": "CURRENT_SPEND"}
+            ],
+            "include_credits": True,
+            "pubsub": True,
+        }
+    ],
+    "labels": [
+        {
+            "label_list": [{"team": "data"}, {"env": "prod"}],
+            "budget_type": "AMT",
+            "budget_amount": 10,
+            "alert_emails": [],
+            "threshold_rules": [
+                {"threshold_percent": 0.5, "spend_basis": "CURRENT_SPEND"}
+            ],
+            "include_credits": True,
+            "pubsub": True,
+        }
+    ],
+}
+
+
+def project_asset(project_id, number, folder="999", labels=None, state="ACTIVE"):
+    return {
+        "name": f"//cloudresourcemanager.googleapis.com/projects/{number}",
+        "assetType": watch.PROJECT_ASSET_TYPE,
+        "resource": {
+            "data": {
+                "projectId": project_id,
+                "projectNumber": number,
+                "lifecycleState": state,
+                "labels": labels or {},
+                "parent": {"type": "folder", "id": folder},
+            }
+        },
+    }
+
+
+def feed_message(asset, prior=None, deleted=False, time="2023-01-01T00:00:00Z"):
+    message = {"asset": asset, "window": {"startTime": time}}
+    if prior is not None:
+        message["priorAsset"] = prior
+        message["priorAssetState"] = "PRESENT"
+    if deleted:
+        message["deleted"] = True
+    return message
+
+
+class FakeBilling:
+    def __init__(self, budgets):
+        self.budgets = budgets
+
+    def list_budgets(self, parent):
+        return self.budgets
+
+
+class FakeGcp:
+    def __init__(self, budgets=()):
+        self.billing_client = FakeBilling(list(budgets))
+        self.deleted = []
+
+    def delete_budget(self, budget_id):
+        self.deleted.append(budget_id)
+
+    def call(self, api, method, func, paged=False, **kwargs):
+        return func(**kwargs)
+
+
+def reconciler(monkeypatch, gcp=None, fail=()):
+    calls = []
+
+    def record(config_type):
+        def reconcile(gcp, mysql_conn, project, *args):
+            if project.project_id in fail:
+                raise Exception("not searchable yet")
+            calls.append((config_type, project.project_id, project.display_name))
+
+        return reconcile
+
+    monkeypatch.setattr(watch, "reconcile_project_budget", record("project"))
+    monkeypatch.setattr(watch, "reconcile_parent_project_budget", record("parent"))
+    monkeypatch.setattr(watch, "reconcile_label_project_budget", record("label"))
+    return (
+        watch.ChangeReconciler(gcp or FakeGcp(), None, lambda: CONFIG, "0-0-0", "t"),
+        calls,
+    )
+
+
+def run_once(client, reconciler):
+    stop = threading.Event()
+    original = reconciler.handle
+
+    def handle(received):
+        stop.set()
+        return original(received)
+
+    reconciler.handle = handle
+    reconciler.mysql_conn = SimpleNamespace(ping=lambda reconnect: None)
+    watch.run(client, "sub", reconciler, stop=stop)
+
+
+def test_new_project_matches_every_config_type(monkeypatch):
+    rec, calls = reconciler(monkeypatch)
+    asset = project_asset(
+        "moz-fx-one", "111", folder="1234", labels={"team": "data", "env": "prod"}
+    )
+
+    rec.reconcile(watch.parse_change(feed_message(asset)))
+
+    assert calls == [
+        ("project", "moz-fx-one", "plutus-moz-fx-one"),
+        ("parent", "moz-fx-one", "plutus-1234-moz-fx-one"),
+        ("label", "moz-fx-one", "plutus-labels-moz-fx-one"),
+    ]
+
+
+def test_labels_must_all_match(monkeypatch):
+    rec, calls = reconciler(monkeypatch)
+    asset = project_asset("moz-fx-two", "222", labels={"team": "data", "env": "dev"})
+
+    rec.reconcile(watch.parse_change(feed_message(asset)))
+
+    assert calls == []
+
+
+def test_irrelevant_updates_are_skipped():
+    prior = project_asset("moz-fx-two", "222", folder="1234")
+    renamed = project_asset("moz-fx-two", "222", folder="1234")
+    renamed["resource"]["data"]["name"] = "New name"
+    moved = project_asset("moz-fx-two", "222", folder="5678")
+
+    assert watch.parse_change(feed_message(renamed, prior)) is None
+    change = watch.parse_change(feed_message(moved, prior))
+    assert (change.change, change.parent_id) == (watch.CHANGE_UPDATED, "5678")
+
+
+def test_deleted_project_budgets_are_deleted(monkeypatch):
+    budgets = [
+        SimpleNamespace(
+            name="billingAccounts/0/budgets/a",
+            display_name="plutus-1234-moz-fx-two",
+            budget_filter=SimpleNamespace(projects=["projects/222"]),
+        ),
+        SimpleNamespace(
+            name="billingAccounts/0/budgets/b",
+            display_name="plutus-moz-fx-three",
+            budget_filter=SimpleNamespace(projects=["projects/333"]),
+        ),
+        SimpleNamespace(
+            name="billingAccounts/0/budgets/c",
+            display_name="manual",
+            budget_filter=SimpleNamespace(projects=["projects/222"]),
+        ),
+    ]
+    gcp = FakeGcp(budgets)
+    rec, _ = reconciler(monkeypatch, gcp)
+    prior = project_asset("moz-fx-two", "222", folder="1234")
+    asset = {"name": prior["name"], "assetType": watch.PROJECT_ASSET_TYPE}
+
+    rec.reconcile(watch.parse_change(feed_message(asset, prior, deleted=True)))
+
+    assert gcp.deleted == ["billingAccounts/0/budgets/a"]
+
+
+def test_failed_changes_are_redelivered(monkeypatch):
+    rec, calls = reconciler(monkeypatch, fail={"moz-fx-new"})
+    client = LocalSubscriber()
+    client.publish(feed_message(project_asset("moz-fx-new", "444", folder="1234")))
+    client.publish(feed_message(project_asset("moz-fx-one", "111")))
+    client.publish(b"not json")
+
+    run_once(client, rec)
+
+    assert calls == [("project", "moz-fx-one", "plutus-moz-fx-one")]
+    assert len(client.acked) == 2
+    client.redeliver()
+    assert len(client.queue) == 1
+
+
+def test_changes_to_one_project_are_reconciled_once(monkeypatch):
+    rec, calls = reconciler(monkeypatch)
+    client = LocalSubscriber()
+    prior = project_asset("moz-fx-two", "222", folder="999")
+    client.publish(
+        feed_message(project_asset("moz-fx-two", "222", folder="5678"), prior)
+    )
+    client.publish(
+        feed_message(
+            project_asset("moz-fx-two", "222", folder="1234"),
+            prior,
+            time="2023-01-01T00:01:00Z",
+        )
+    )
+
+    run_once(client, rec)
+
+    assert calls == [("parent", "moz-fx-two", "plutus-1234-moz-fx-two")]
+    assert len(client.acked) == 2
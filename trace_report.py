@@ -0,0 +1,46 @@
+import click
+
+from plutus.lib.tracing import (
+    critical_path,
+    load_spans,
+    self_time_breakdown,
+    slowest_projects,
+    SPAN_PROJECT,
+)
+
+
+# Summarize a budget manager trace written with --trace-file
+@click.command()
+@click.argument("trace_file")
+@click.option("--limit", default=20, help="Number of slowest projects to print")
+@click.option(
+    "--trace-id", default=None, help="Run to summarize, the latest by default"
+)
+def main(trace_file, limit, trace_id):
+    spans = load_spans(trace_file, trace_id=trace_id)
+    if not spans:
+        print(f"No spans found in {trace_file}.")
+        return
+    print(f"Trace {spans[0]['trace_id']}\n")
+
+    print(f"Slowest {limit} projects:")
+    for project_id, section, duration_ms in slowest_projects(spans, limit=limit):
+        print(f"  {duration_ms:10.1f} ms  {section}  {project_id}")
+
+    path = critical_path(spans)
+    run_ms = path[0]["duration_ms"]
+    print(f"\nCritical path ({run_ms:.1f} ms total):")
+    for span in path:
+        if span["name"] == SPAN_PROJECT:
+            continue
+        label = span["attributes"].get("section") or span["name"]
+        print(f"  {span['duration_ms']:10.1f} ms  {label}")
+
+    print("\nSelf time by step:")
+    for name, self_ms, count in self_time_breakdown(spans):
+        pct = 100 * self_ms / run_ms if run_ms else 0
+        print(f"  {self_ms:10.1f} ms  {pct:5.1f}%  {count:6d}x  {name}")
+
+
+if __name__ == "__main__":
+    main()